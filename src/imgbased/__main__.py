@@ -24,6 +24,9 @@ import sys
 import logging
 import argparse
 from . import config
+from . import ledger
+from . import tracing
+from . import cassette
 from .imgbase import ImageLayers, ExternalBinary
 from .hooks import Hooks
 from . import plugins
@@ -74,6 +77,21 @@ if __name__ == '__main__':
     parser.add_argument("--dry", action="store_true")
     parser.add_argument("--experimental", action="store_true",
                         help="Enable experimental functionality")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print a summary of all external commands")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="Write all external commands to a JSON file")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Print the time of each phase and write them "
+                        "to a Chrome trace file")
+    tape_group = parser.add_mutually_exclusive_group()
+    tape_group.add_argument("--record", metavar="FILE",
+                            help="Record all external commands to FILE")
+    tape_group.add_argument("--replay", metavar="FILE",
+                            help="Do not run external commands, but replay "
+                            "them, the configuration and remote indexes "
+                            "from FILE (other files, mounts and image "
+                            "downloads are not replayed)")
 
     app.hooks.emit("pre-arg-parse", parser, subparsers)
 
@@ -91,9 +109,31 @@ if __name__ == '__main__':
 
     ExternalBinary.dry = args.dry
 
+    if args.profile or args.profile_json:
+        ledger.enable()
+    if args.trace:
+        tracing.enable()
+    if args.record:
+        cassette.record()
+    elif args.replay:
+        cassette.replay(args.replay)
+
     #
     # Now let the plugins check if they need to run something
     #
-    app.hooks.emit("post-arg-parse", args)
+    try:
+        with tracing.span("imgbase %s" % args.command), app.imgbase.mounts:
+            app.hooks.emit("post-arg-parse", args)
+    finally:
+        if args.record:
+            cassette.current().save(args.record)
+        if tracing.current():
+            sys.stderr.write(tracing.current().summary() + "\n")
+            tracing.current().write_chrome_trace(args.trace)
+        if ledger.current():
+            if args.profile:
+                sys.stderr.write(ledger.current().table() + "\n")
+            if args.profile_json:
+                ledger.current().write_json(args.profile_json)
 
 # vim: et sts=4 sw=4:
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+import json
+import time
+import base64
+import logging
+import collections
+
+from . import ledger
+
+
+log = logging.getLogger(__package__)
+
+
+class Cassette(object):
+    """Records external commands, to replay them later without running
+
+    Commands are looked up by their argv, in the order they were
+    recorded. If an argv is not found (e.g. because it contains a
+    random temporary path), the next unplayed command of the same
+    binary is used.
+
+    The external commands are replayed, not what they do: a replayed
+    mount mounts nothing. Of the other reads of the host, only the
+    configuration and the small remote files (like an index) are
+    replayed (see taped), files, sysfs and image downloads are still
+    read from the local host.
+
+    >>> tape = Cassette("record")
+    >>> tape.run(["lvs", "-o", "lv_name"], lambda: (0, b"Image-0.0"))
+    (0, b'Image-0.0')
+    >>> tape.run(["mount", "/tmp/tmp1234", "/mnt"], lambda: (0, None))
+    (0, None)
+    >>> tape.run(["false"], lambda: (1, b""))
+    (1, b'')
+
+    >>> tape = Cassette.loads(tape.dumps())
+    >>> tape.mode
+    'replay'
+    >>> tape.run(["lvs", "-o", "lv_name"], None, text=True)
+    (0, 'Image-0.0')
+    >>> tape.run(["mount", "/tmp/tmp5678", "/mnt"], None)
+    (0, None)
+    >>> tape.run(["lvs", "-o", "lv_name"], None)
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Command not in cassette: ['lvs', '-o', 'lv_name']
+    """
+    mode = None
+    entries = None
+
+    _played = None
+    _by_argv = None
+    _by_binary = None
+
+    def __init__(self, mode, entries=None):
+        assert mode in ("record", "replay")
+        self.mode = mode
+        self.entries = entries or []
+        self._played = set()
+        # Queues of entry indices, in recording order
+        self._by_argv = collections.defaultdict(collections.deque)
+        self._by_binary = collections.defaultdict(collections.deque)
+        for idx, entry in enumerate(self.entries):
+            self._by_argv[tuple(entry["argv"])].append(idx)
+            self._by_binary[entry["argv"][0]].append(idx)
+
+    def __repr__(self):
+        return "<Cassette %s %d commands />" % (self.mode, len(self.entries))
+
+    def run(self, argv, func, text=False):
+        """Run a command or replay it, returns (status, stdout)
+
+        func runs the command and also returns (status, stdout).
+        """
+        argv = [str(a) for a in argv]
+        if self.mode == "record":
+            begin = time.time()
+            status, stdout = func()
+            self._record(argv, status, stdout, time.time() - begin)
+        else:
+            status, stdout = self._replay(argv, text)
+        return status, stdout
+
+    def _record(self, argv, status, stdout, wall):
+        entry = {"argv": argv, "status": status, "wall": wall}
+        if stdout is not None:
+            if isinstance(stdout, bytes):
+                try:
+                    entry["stdout"] = stdout.decode("utf-8")
+                except UnicodeDecodeError:
+                    entry["stdout_b64"] = \
+                        base64.b64encode(stdout).decode("ascii")
+            else:
+                entry["stdout"] = stdout
+        self.entries.append(entry)
+
+    def _next(self, queue):
+        while queue and queue[0] in self._played:
+            queue.popleft()
+        return queue.popleft() if queue else None
+
+    def _find(self, argv):
+        idx = self._next(self._by_argv[tuple(argv)])
+        if idx is None:
+            idx = self._next(self._by_binary[argv[0]])
+            if idx is None:
+                raise RuntimeError("Command not in cassette: %s" % argv)
+            log.debug("Replaying %s for %s" %
+                      (self.entries[idx]["argv"], argv))
+        return idx
+
+    def _replay(self, argv, text):
+        idx = self._find(argv)
+        self._played.add(idx)
+        entry = self.entries[idx]
+        ledger.record(argv, entry["wall"], None, entry["status"],
+                      len(entry.get("stdout", "")))
+        if "stdout_b64" in entry:
+            stdout = base64.b64decode(entry["stdout_b64"])
+            stdout = stdout.decode("utf-8", "replace") if text else stdout
+        elif "stdout" in entry:
+            stdout = entry["stdout"]
+            stdout = stdout if text else stdout.encode("utf-8")
+        else:
+            stdout = None
+        return entry["status"], stdout
+
+    def dumps(self):
+        return json.dumps({"commands": self.entries}, indent=2)
+
+    def save(self, path):
+        log.debug("Saving %d commands to %s" % (len(self.entries), path))
+        with open(path, "w") as dst:
+            dst.write(self.dumps())
+
+    @staticmethod
+    def loads(data):
+        return Cassette("replay", json.loads(data)["commands"])
+
+    @staticmethod
+    def load(path):
+        with open(path) as src:
+            return Cassette.loads(src.read())
+
+
+# The active cassette, None if commands are just run
+_cassette = None
+
+
+def record():
+    """Start recording all external commands
+    """
+    global _cassette
+    _cassette = Cassette("record")
+    return _cassette
+
+
+def replay(path):
+    """Replay the commands from a cassette file instead of running them
+    """
+    global _cassette
+    _cassette = Cassette.load(path)
+    return _cassette
+
+
+def eject():
+    global _cassette
+    _cassette = None
+
+
+def current():
+    return _cassette
+
+
+def taped(name, func, *args):
+    """Call func(*args), or replay what it returned
+
+    This is for the reads of a host which are not external commands,
+    like fetching an index or reading the configuration. func returns
+    text or None, IOError and OSError are replayed as IOError.
+
+    >>> tape = record()
+    >>> taped("fetch", lambda url: "Hi", "http://example.com/index")
+    'Hi'
+    >>> import os, tempfile
+    >>> path = tempfile.mkstemp()[1]
+    >>> tape.save(path)
+    >>> _ = replay(path)
+    >>> taped("fetch", None, "http://example.com/index")
+    'Hi'
+    >>> eject()
+    >>> os.unlink(path)
+    """
+    tape = current()
+    if tape is None:
+        return func(*args)
+
+    errors = []
+
+    def run():
+        try:
+            return 0, func(*args)
+        except (IOError, OSError) as e:
+            errors.append(e)
+            return 1, str(e)
+
+    status, result = tape.run([name] + list(args), run, text=True)
+    if errors:
+        raise errors[0]
+    if status:
+        raise IOError(result)
+    return result
+
+# vim: sw=4 et sts=4:
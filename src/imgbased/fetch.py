@@ -0,0 +1,1051 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+import os
+import json
+import errno
+import time
+import fcntl
+import hashlib
+import contextlib
+import collections
+import logging
+import tempfile
+import threading
+
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlopen, url2pathname, Request
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.http_client import HTTPException
+
+from . import tracing
+from . import cassette
+
+
+log = logging.getLogger(__package__)
+
+
+class UrlCache(object):
+    """Fetches small remote files (like an index) at most once
+
+    Each URL is fetched once per UrlCache. With a cache directory the
+    contents are also kept on disk and revalidated with the ETag and
+    Last-Modified of the previous response, so an unchanged file costs
+    a single 304 round trip. If the server can not be reached, the
+    copy on disk is used.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> with open(tmpdir + "/index", "w") as dst:
+    ...     _ = dst.write("Hi")
+    >>> with _TestServer(tmpdir) as server:
+    ...     cache = UrlCache(tmpdir + "/cache")
+    ...     cache.get(server.url + "/index")
+    ...     cache.get(server.url + "/index")
+    ...     UrlCache(tmpdir + "/cache").get(server.url + "/index")
+    ...     server.statuses
+    'Hi'
+    'Hi'
+    'Hi'
+    [200, 304]
+    >>> UrlCache(tmpdir + "/cache").get(server.url + "/index")
+    'Hi'
+    >>> UrlCache().get("file://" + tmpdir + "/index")
+    'Hi'
+
+    A sidecar of a file (like the checksums of an index) is only
+    fetched again if that file changed. A missing sidecar is None, and
+    that is remembered as well:
+
+    >>> with _TestServer(tmpdir) as server:
+    ...     for n in range(2):
+    ...         cache = UrlCache(tmpdir + "/cache")
+    ...         _ = cache.get(server.url + "/index")
+    ...         print(cache.get(server.url + "/index.sha256",
+    ...                         sidecar_of=server.url + "/index"))
+    ...     server.statuses
+    None
+    None
+    [200, 404, 304]
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    """
+    cachedir = None
+    timeout = 60
+
+    _contents = None
+    _lock = None
+    # The urls which did not change since they were cached
+    _unchanged = None
+
+    def __init__(self, cachedir=None):
+        self.cachedir = cachedir
+        self._contents = {}
+        self._lock = threading.Lock()
+        self._unchanged = set()
+
+    def get(self, url, sidecar_of=None):
+        """The contents of url as text
+
+        If url is a sidecar_of another url, it is None if it does not
+        exist, and the cached copy is used as long as the other url
+        did not change. The other url needs to be fetched first.
+        """
+        with self._lock:
+            if url not in self._contents:
+                with tracing.span("fetch", url=url):
+                    # Fetched through the cassette to replay the remote
+                    self._contents[url] = cassette.taped(
+                        "fetch", self._fetch, url, sidecar_of)
+            return self._contents[url]
+
+    def invalidate(self, url=None):
+        """Fetch url (or all) again on the next get
+        """
+        with self._lock:
+            if url:
+                self._contents.pop(url, None)
+            else:
+                self._contents.clear()
+
+    def _fetch(self, url, sidecar_of=None):
+        meta, data = self._load(url)
+        if sidecar_of in self._unchanged and data is not None:
+            log.debug("Using the cached %s, %s did not change" %
+                      (url, sidecar_of))
+            return None if meta.get("missing") else data
+        request = Request(url)
+        if data is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                request.add_header("If-Modified-Since",
+                                   meta["last_modified"])
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304 and data is not None:
+                log.debug("Not modified: %s" % url)
+                self._unchanged.add(url)
+                return data
+            if e.code == 404 and sidecar_of:
+                log.debug("No sidecar %s" % url)
+                self._store(url, {"url": url, "missing": True}, "",
+                            sidecar=True)
+                return None
+            raise
+        except URLError as e:
+            if sidecar_of and url.startswith("file://"):
+                return None
+            if data is None:
+                raise
+            log.warning("Using the cached copy of %s: %s" % (url, e))
+            self._unchanged.add(url)
+            return None if meta.get("missing") else data
+
+        log.debug("Fetching: %s" % url)
+        data = response.read().decode()
+        headers = response.info()
+        self._store(url, {"url": url,
+                          "etag": headers.get("ETag"),
+                          "last_modified": headers.get("Last-Modified")},
+                    data, sidecar=bool(sidecar_of))
+        return data
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cachedir, key)
+        return base + ".json", base + ".data"
+
+    def _load(self, url):
+        if not self.cachedir or url.startswith("file://"):
+            return None, None
+        metapath, datapath = self._paths(url)
+        try:
+            with open(metapath) as src:
+                meta = json.load(src)
+            with open(datapath) as src:
+                return meta, src.read()
+        except (IOError, OSError, ValueError):
+            return None, None
+
+    def _store(self, url, meta, data, sidecar=False):
+        if not self.cachedir or url.startswith("file://"):
+            return
+        if not sidecar and not meta["etag"] and not meta["last_modified"]:
+            # Nothing to revalidate with, sidecars are tied to their file
+            return
+        metapath, datapath = self._paths(url)
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # The data first, the metadata marks it as complete
+            _write_atomic(datapath, data)
+            _write_atomic(metapath, json.dumps(meta))
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM):
+                raise
+            log.debug("Can not cache %s: %s" % (url, e))
+
+
+def _write_atomic(path, data):
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as dst:
+            dst.write(data)
+        os.rename(tmppath, path)
+    except Exception:
+        os.unlink(tmppath)
+        raise
+
+
+def download(url, path, sha256=None, blocksize=1024 * 1024, segments=1):
+    """Download url to path, resuming an earlier partial download
+
+    The data goes to path.part, which is renamed to path once it is
+    complete and matches sha256 (if given). If path.part already
+    exists, only the missing data is requested (with a Range request
+    for http(s)). The checksum is calculated while the data is
+    written, so the file is not read a second time.
+
+    With segments > 1 a http(s) download is split up into concurrent
+    Range requests, see SegmentedDownload. The checksum is then
+    calculated once the download is complete.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> with open(tmpdir + "/image", "wb") as dst:
+    ...     _ = dst.write(b"0123456789" * 1000)
+    >>> digest = hashlib.sha256(b"0123456789" * 1000).hexdigest()
+
+    An interrupted download is continued, if the file did not change
+    meanwhile:
+
+    >>> from email.utils import formatdate
+    >>> def interrupted(name, data):
+    ...     with open(tmpdir + "/" + name + ".part", "wb") as dst:
+    ...         _ = dst.write(data)
+    ...     with open(tmpdir + "/" + name + ".part.validator", "w") as dst:
+    ...         mtime = os.path.getmtime(tmpdir + "/image")
+    ...         _ = dst.write(formatdate(mtime, usegmt=True))
+    >>> interrupted("dst", b"0123456789" * 300)
+    >>> with _TestServer(tmpdir) as server:
+    ...     _ = download(server.url + "/image", tmpdir + "/dst", digest)
+    ...     server.ranges, server.statuses
+    (['bytes=3000-'], [206])
+    >>> sorted(os.listdir(tmpdir))
+    ['dst', 'image']
+
+    >>> interrupted("changed", b"9876543210" * 300)
+    >>> os.utime(tmpdir + "/image", (0, 0))
+    >>> with _TestServer(tmpdir) as server:
+    ...     _ = download(server.url + "/image", tmpdir + "/changed")
+    ...     server.statuses
+    [200]
+    >>> open(tmpdir + "/changed", "rb").read() == b"0123456789" * 1000
+    True
+
+    Also for local files, the part is not trusted if the result is
+    broken:
+
+    >>> with open(tmpdir + "/other.part", "wb") as dst:
+    ...     _ = dst.write(b"garbage")
+    >>> with open(tmpdir + "/other.part.validator", "w") as dst:
+    ...     st = os.stat(tmpdir + "/image")
+    ...     _ = dst.write("%r %d" % (st.st_mtime, st.st_size))
+    >>> download("file://" + tmpdir + "/image", tmpdir + "/other",
+    ...          digest)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Checksum mismatch for file://.../image: Expected ...
+    >>> sorted(os.listdir(tmpdir))
+    ['changed', 'dst', 'image']
+    >>> _ = download("file://" + tmpdir + "/image", tmpdir + "/other", digest)
+    >>> open(tmpdir + "/other", "rb").read() == b"0123456789" * 1000
+    True
+
+    >>> with _TestServer(tmpdir) as server:
+    ...     _ = download(server.url + "/image", tmpdir + "/third", digest,
+    ...                  segments=4)
+    >>> open(tmpdir + "/third", "rb").read() == b"0123456789" * 1000
+    True
+
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    """
+    if os.path.exists(path) and not os.path.isfile(path):
+        # Like a device, which can not be renamed into
+        with open(path, "wb") as dst:
+            _transfer(url, dst, sha256, blocksize)
+        return path
+
+    partpath = path + ".part"
+    if segments > 1 and not url.startswith("file://"):
+        size, validator, ranges = _probe(url)
+        if ranges and size is not None:
+            SegmentedDownload(url, partpath, size, segments,
+                              validator).run()
+            digest = hashlib.sha256()
+            with open(partpath, "rb") as src:
+                for data in iter(lambda: src.read(blocksize), b""):
+                    digest.update(data)
+            try:
+                _verify(url, digest, sha256)
+            except RuntimeError:
+                _remove_part(partpath)
+                raise
+            os.rename(partpath, path)
+            _remove_part(partpath)
+            return path
+        log.info("No ranges supported by %s, using one connection" % url)
+
+    if os.path.exists(partpath + ".chunks"):
+        # The part of a segmented download has holes, it can not be
+        # continued from it's end
+        _remove_part(partpath)
+
+    with open(partpath, "ab") as dst:
+        try:
+            _transfer(url, dst, sha256, blocksize, partpath + ".validator")
+        except RuntimeError:
+            # The data is broken, there is nothing to resume from
+            _remove_part(partpath)
+            raise
+        os.fsync(dst.fileno())
+    os.rename(partpath, path)
+    _remove_part(partpath)
+    return path
+
+
+def _remove_part(partpath):
+    """Remove a partial download and what is kept about it
+    """
+    for suffix in ["", ".chunks", ".validator"]:
+        if os.path.exists(partpath + suffix):
+            os.unlink(partpath + suffix)
+
+
+def _transfer(url, dst, sha256, blocksize, validatorpath=None):
+    """Append the missing data of url to dst, and verify it all
+
+    The validator of url (see _validator) is kept in validatorpath, the
+    data in dst is only continued if url still has the same validator.
+    """
+    digest = hashlib.sha256()
+    offset = dst.tell()
+    validator = None
+    if offset and validatorpath and os.path.exists(validatorpath):
+        with open(validatorpath) as src:
+            validator = src.read()
+    if offset and validator:
+        log.info("Resuming download of %s at %d MiB" % (url, offset >> 20))
+        with open(dst.name, "rb") as part:
+            for data in iter(lambda: part.read(blocksize), b""):
+                digest.update(data)
+    elif offset:
+        log.info("Can not tell if %s changed, not resuming" % url)
+        offset = None
+
+    begin = time.time()
+    src, start, validator = _open_at(url, offset or 0, validator)
+    with tracing.span("download", url=url, offset=start):
+        try:
+            if start != offset:
+                if offset:
+                    log.info("Restarting download of %s" % url)
+                dst.truncate(0)
+                digest = hashlib.sha256()
+            if start == 0 and validatorpath:
+                if validator:
+                    _write_atomic(validatorpath, validator)
+                elif os.path.exists(validatorpath):
+                    os.unlink(validatorpath)
+            for data in iter(lambda: src.read(blocksize), b""):
+                dst.write(data)
+                digest.update(data)
+        finally:
+            src.close()
+        dst.flush()
+
+    size = dst.tell()
+    duration = max(time.time() - begin, 0.001)
+    log.info("Downloaded %d MiB in %.1f s (%.1f MiB/s)" %
+             ((size - start) >> 20, duration,
+              (size - start) / duration / (1 << 20)))
+
+    _verify(url, digest, sha256)
+
+
+def _verify(url, digest, sha256):
+    if sha256 is None:
+        log.debug("No checksum for %s, not verifying it" % url)
+    elif digest.hexdigest() != sha256.lower():
+        raise RuntimeError("Checksum mismatch for %s: Expected %s, got %s" %
+                           (url, sha256, digest.hexdigest()))
+
+
+def _validator(headers):
+    """What tells if the file behind a response changed, for If-Range
+
+    A strong ETag, or else the Last-Modified date. None if there is
+    neither.
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def _open_at(url, offset, validator=None):
+    """Open url for reading at offset, returns (stream, start, validator)
+
+    start is 0 instead of offset if the source can only be read from
+    the beginning, or if it does not match validator anymore.
+    """
+    if url.startswith("file://"):
+        src = open(url2pathname(urlparse(url).path), "rb")
+        st = os.fstat(src.fileno())
+        current = "%r %d" % (st.st_mtime, st.st_size)
+        if current == validator:
+            src.seek(offset)
+        return src, src.tell(), current
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%d-" % offset)
+        if validator:
+            # A changed file is sent as a whole instead
+            request.add_header("If-Range", validator)
+    try:
+        response = urlopen(request, timeout=UrlCache.timeout)
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        # The part is as large as the file, or larger
+        total = e.headers.get("Content-Range", "").rpartition("/")[2]
+        if total == str(offset) and _validator(e.headers) == validator:
+            return _EmptyStream(), offset, validator
+        response = urlopen(url, timeout=UrlCache.timeout)
+        return response, 0, _validator(response.info())
+    if offset and response.getcode() == 206:
+        return response, offset, validator
+    return response, 0, _validator(response.info())
+
+
+def _probe(url):
+    """Returns (size, validator, ranges) of url
+
+    size is None if it is unknown, ranges tells if the server supports
+    Range requests. See _validator.
+    """
+    request = Request(url)
+    request.add_header("Range", "bytes=0-0")
+    response = urlopen(request, timeout=UrlCache.timeout)
+    try:
+        headers = response.info()
+        ranges = response.getcode() == 206
+        if ranges:
+            size = headers.get("Content-Range", "").rpartition("/")[2]
+        else:
+            size = headers.get("Content-Length", "")
+        size = int(size) if size.isdigit() else None
+        return size, _validator(headers), ranges
+    finally:
+        response.close()
+
+
+class SegmentedDownload(object):
+    """Downloads a file with several concurrent Range requests
+
+    A single connection over a link with a high latency often only
+    gets a fraction of the bandwidth. Here the file is split into
+    chunks, which are fetched by a number of workers and written in
+    place (with pwrite) into a sparse file of the final size.
+
+    A failed chunk is retried on it's own. The finished chunks are
+    kept in <path>.chunks, so that an interrupted download can be
+    resumed.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> data = b"".join(b"%05d" % n for n in range(20000))
+    >>> with open(tmpdir + "/image", "wb") as dst:
+    ...     _ = dst.write(data)
+
+    >>> with _TestServer(tmpdir) as server:
+    ...     server.failures = 2
+    ...     dl = SegmentedDownload(server.url + "/image", tmpdir + "/dst",
+    ...                            len(data), 3)
+    ...     dl.chunksize = 16384
+    ...     dl.retry_delay = 0
+    ...     dl.run()
+    ...     len(server.ranges), server.statuses.count(503)
+    (9, 2)
+    >>> open(tmpdir + "/dst", "rb").read() == data
+    True
+
+    Chunks which are already there are not fetched again, if the file
+    still has the same validator:
+
+    >>> from email.utils import formatdate
+    >>> validator = formatdate(os.path.getmtime(tmpdir + "/image"),
+    ...                        usegmt=True)
+    >>> with open(tmpdir + "/dst.chunks", "w") as dst:
+    ...     json.dump({"size": len(data), "chunksize": 16384,
+    ...                "validator": validator,
+    ...                "done": [0, 32768, 65536]}, dst)
+    >>> with _TestServer(tmpdir) as server:
+    ...     dl = SegmentedDownload(server.url + "/image", tmpdir + "/dst",
+    ...                            len(data), 3, validator)
+    ...     dl.chunksize = 16384
+    ...     dl.run()
+    ...     sorted(server.ranges)
+    ['bytes=16384-32767', 'bytes=49152-65535', 'bytes=81920-98303', \
+'bytes=98304-99999']
+    >>> os.path.exists(tmpdir + "/dst.chunks")
+    False
+
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    """
+    url = None
+    path = None
+    size = None
+    segments = None
+    # See _validator, chunks are only reused if it did not change
+    validator = None
+
+    chunksize = 32 * 1024 * 1024
+    blocksize = 1024 * 1024
+    retries = 3
+    retry_delay = 2
+    # Seconds between progress reports
+    report_interval = 10
+
+    _lock = None
+    _todo = None
+    _done = None
+    _errors = None
+    _fetched = 0
+
+    def __init__(self, url, path, size, segments, validator=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.segments = segments
+        self.validator = validator
+        self._lock = threading.Lock()
+        self._errors = []
+
+    @property
+    def _statepath(self):
+        return self.path + ".chunks"
+
+    def _load_state(self):
+        """The offsets of the chunks which are already in the file
+        """
+        try:
+            with open(self._statepath) as src:
+                state = json.load(src)
+            if state["size"] == self.size and \
+                    state["chunksize"] == self.chunksize and \
+                    self.validator and \
+                    state["validator"] == self.validator:
+                return set(state["done"])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        if os.path.exists(self._statepath) or not self.validator:
+            return set()
+        # A part of a download with one connection has no holes
+        try:
+            with open(self.path + ".validator") as src:
+                if src.read() != self.validator:
+                    return set()
+        except (IOError, OSError):
+            return set()
+        have = os.path.getsize(self.path) \
+            if os.path.exists(self.path) else 0
+        return set(offset for offset in range(0, self.size, self.chunksize)
+                   if min(offset + self.chunksize, self.size) <= have)
+
+    def _save_state(self):
+        _write_atomic(self._statepath, json.dumps({
+            "size": self.size,
+            "chunksize": self.chunksize,
+            "validator": self.validator,
+            "done": sorted(self._done)}))
+
+    def run(self):
+        self._done = self._load_state()
+        self._todo = collections.deque(
+            offset for offset in range(0, self.size, self.chunksize)
+            if offset not in self._done)
+        self._fetched = 0
+        if self._done:
+            log.info("Resuming download of %s, %d of %d MiB are there" %
+                     (self.url, (self.size - len(self._todo) *
+                                 self.chunksize) >> 20, self.size >> 20))
+        # Written before the file grows, which could look complete
+        self._save_state()
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        begin = time.time()
+        try:
+            os.ftruncate(fd, self.size)
+            workers = [threading.Thread(target=self._worker, args=(fd,))
+                       for n in range(min(self.segments, len(self._todo)))]
+            with tracing.span("download", url=self.url,
+                              segments=len(workers)):
+                for worker in workers:
+                    worker.daemon = True
+                    worker.start()
+                for worker in workers:
+                    while worker.is_alive():
+                        worker.join(self.report_interval)
+                        if worker.is_alive():
+                            self._report(begin)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if self._errors:
+            raise RuntimeError("Failed to download %s: %s" %
+                               (self.url, self._errors[0]))
+        self._report(begin)
+        os.unlink(self._statepath)
+
+    def _report(self, begin):
+        duration = max(time.time() - begin, 0.001)
+        with self._lock:
+            fetched = self._fetched
+            missing = sum(min(self.chunksize, self.size - offset)
+                          for offset in self._todo)
+        log.info("Downloaded %d MiB of %s in %.1f s (%.1f MiB/s), "
+                 "%d MiB missing" %
+                 (fetched >> 20, self.url, duration,
+                  fetched / duration / (1 << 20), missing >> 20))
+
+    def _worker(self, fd):
+        while True:
+            with self._lock:
+                if not self._todo or self._errors:
+                    return
+                offset = self._todo.popleft()
+            try:
+                self._fetch_chunk(fd, offset)
+            except Exception as e:
+                with self._lock:
+                    self._todo.appendleft(offset)
+                    self._errors.append(e)
+                return
+            # The chunk must be on disk before the state says so, else
+            # it could stay a hole after a crash
+            os.fdatasync(fd)
+            with self._lock:
+                self._done.add(offset)
+                self._save_state()
+
+    def _fetch_chunk(self, fd, offset):
+        end = min(offset + self.chunksize, self.size)
+        for attempt in range(1, self.retries + 1):
+            pos = offset
+            try:
+                request = Request(self.url)
+                request.add_header("Range", "bytes=%d-%d" % (offset, end - 1))
+                if self.validator:
+                    request.add_header("If-Range", self.validator)
+                response = urlopen(request, timeout=UrlCache.timeout)
+                try:
+                    if response.getcode() != 206:
+                        raise RuntimeError("Got no range of %s, it changed "
+                                           "or ranges are not supported" %
+                                           self.url)
+                    while pos < end:
+                        data = response.read(min(self.blocksize, end - pos))
+                        if not data:
+                            raise IOError("Short read at %d" % pos)
+                        view = memoryview(data)
+                        while view:
+                            n = os.pwrite(fd, view, pos)
+                            view = view[n:]
+                            pos += n
+                        with self._lock:
+                            self._fetched += len(data)
+                finally:
+                    response.close()
+                return
+            except (IOError, OSError, HTTPException) as e:
+                with self._lock:
+                    self._fetched -= pos - offset
+                if attempt == self.retries:
+                    raise
+                log.warning("Failed to fetch %s at %d (attempt %d of %d): "
+                            "%s" % (self.url, offset, attempt,
+                                    self.retries, e))
+                time.sleep(attempt * self.retry_delay)
+
+
+class ImageCache(object):
+    """A size bounded cache of downloaded images, shared by all pools
+
+    Images are kept by their sha256 if it is known, or else by their
+    url, size and validator (see _probe). When the cache would grow
+    larger than maxsize, the least recently used images are removed.
+    The time an image was last used is kept in it's .json file.
+
+    Several processes can use the cache: An image is locked
+    exclusively while it is downloaded, and shared while it is used,
+    an image which is locked is not removed.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> for name in ["a", "b", "c"]:
+    ...     with open(tmpdir + "/" + name, "wb") as dst:
+    ...         _ = dst.write(name.encode() * 8192)
+
+    >>> cache = ImageCache(tmpdir + "/cache", 30000)
+    >>> with _TestServer(tmpdir) as server:
+    ...     with cache.get(server.url + "/a") as path:
+    ...         open(path, "rb").read(3)
+    ...     with cache.get(server.url + "/b") as path:
+    ...         pass
+    ...     with cache.get(server.url + "/a") as path:
+    ...         pass
+    ...     server.statuses.count(200)
+    b'aaa'
+    2
+
+    The least recently used image is removed to make room:
+
+    >>> [e["url"].rpartition("/")[2] for e in cache.entries()]
+    ['b', 'a']
+    >>> with _TestServer(tmpdir) as server:
+    ...     with cache.get(server.url + "/c") as path:
+    ...         pass
+    >>> [e["url"].rpartition("/")[2] for e in cache.entries()]
+    ['a', 'c']
+
+    >>> [e["url"].rpartition("/")[2] for e in cache.prune(0)]
+    ['a', 'c']
+    >>> sorted(os.listdir(tmpdir + "/cache"))
+    []
+
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    """
+    path = None
+    maxsize = None
+
+    # The keys of the images this process uses
+    _inuse = None
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self._inuse = set()
+
+    def _key(self, url, sha256):
+        """Returns (key, probe), probe is the result of _probe or None
+        """
+        if sha256:
+            return "sha256-%s" % sha256.lower(), None
+        probe = _probe(url)
+        key = "%s %s %s" % (url, probe[1], probe[0])
+        return ("url-%s" % hashlib.sha256(key.encode("utf-8")).hexdigest(),
+                probe)
+
+    def _touch(self, path, url, sha256):
+        _write_atomic(path + ".json", json.dumps({"url": url,
+                                                  "sha256": sha256,
+                                                  "last_used": time.time()}))
+
+    def _lock(self, key, operation):
+        """Lock an image, returns the fd of the lock
+
+        The lock file is removed together with the image, so it is
+        checked that it is still there once the lock is taken.
+        """
+        lockpath = os.path.join(self.path, key + ".lock")
+        while True:
+            fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, operation)
+                if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                    return fd
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def get(self, url, sha256=None, segments=1):
+        """Yields the path to the image of url, downloads it if needed
+
+        The image is not removed from the cache while it is used.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        key, probe = self._key(url, sha256)
+        path = os.path.join(self.path, key)
+        fd = self._lock(key, fcntl.LOCK_EX)
+        self._inuse.add(key)
+        try:
+            if os.path.exists(path):
+                log.info("Using the cached image of %s" % url)
+            else:
+                self._make_room(url, path, probe)
+                download(url, path, sha256, segments=segments)
+            self._touch(path, url, sha256)
+            # Converting the lock is atomic, nobody can take it between
+            fcntl.lockf(fd, fcntl.LOCK_SH)
+            self.prune()
+            yield path
+        finally:
+            self._inuse.discard(key)
+            os.close(fd)
+
+    def _make_room(self, url, path, probe):
+        """Prune the cache, so that the image of url fits in
+        """
+        size = (probe or _probe(url))[0]
+        if size is None:
+            self.prune()
+            return
+        # What is already there of a partial download
+        for suffix in [".part", ".part.chunks", ".part.validator"]:
+            if os.path.exists(path + suffix):
+                size -= os.stat(path + suffix).st_blocks * 512
+        self.prune(max(self.maxsize - max(size, 0), 0))
+
+    def entries(self):
+        """The images in the cache, least recently used first
+
+        Partial downloads are included, their size is the space they
+        currently use.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        entries = {}
+        for filename in os.listdir(self.path):
+            key, sep, suffix = filename.partition(".")
+            if suffix == "lock" or key.startswith("tmp"):
+                continue
+            entry = entries.setdefault(key, {"key": key, "url": None,
+                                             "sha256": None, "size": 0,
+                                             "last_used": 0,
+                                             "complete": False})
+            try:
+                st = os.stat(os.path.join(self.path, filename))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            entry["size"] += st.st_blocks * 512
+            if suffix == "json":
+                with open(os.path.join(self.path, filename)) as src:
+                    entry.update(json.load(src))
+                entry["complete"] = True
+            elif not entry["complete"]:
+                # Partial downloads have no .json yet
+                entry["last_used"] = max(entry["last_used"], st.st_mtime)
+        return sorted(entries.values(),
+                      key=lambda e: (e["last_used"], e["key"]))
+
+    def prune(self, maxsize=None):
+        """Remove the least recently used images until the cache is not
+        larger than maxsize (or self.maxsize), returns the removed ones
+
+        Images which are in use are skipped.
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        removed = []
+        for entry in entries:
+            if total <= maxsize:
+                break
+            if entry["key"] in self._inuse:
+                continue
+            try:
+                fd = self._lock(entry["key"], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                log.debug("Not removing %s, it is in use" % entry["key"])
+                continue
+            try:
+                log.info("Removing cached image %s (%d MiB)" %
+                         (entry["url"] or entry["key"], entry["size"] >> 20))
+                base = os.path.join(self.path, entry["key"])
+                for suffix in ["", ".json", ".part", ".part.chunks",
+                               ".part.validator", ".lock"]:
+                    if os.path.exists(base + suffix):
+                        os.unlink(base + suffix)
+            finally:
+                os.close(fd)
+            total -= entry["size"]
+            removed.append(entry)
+        return removed
+
+
+class _EmptyStream(object):
+    def read(self, size=-1):
+        return b""
+
+    def close(self):
+        pass
+
+
+class _TestServer(object):
+    """A local HTTP server for a directory, to be used in tests
+
+    It serves Last-Modified and answers If-Modified-Since with a 304.
+    Range requests for a single range (and If-Range with the
+    Last-Modified date) are supported. The status and Range header of
+    each request are kept in statuses and ranges.
+    The next failures Range requests fail with a 503.
+    """
+    path = None
+    url = None
+    statuses = None
+    ranges = None
+    failures = 0
+
+    _server = None
+    _thread = None
+
+    def __init__(self, path):
+        self.path = path
+        self.statuses = []
+        self.ranges = []
+
+    def __enter__(self):
+        from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+        statuses = self.statuses
+        ranges = self.ranges
+        root = self.path
+        server = self
+        lock = threading.Lock()
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(root, path.split("?")[0].lstrip("/"))
+
+            def do_GET(self):
+                byterange = self.headers.get("Range")
+                if not byterange:
+                    return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(
+                        self)
+                with lock:
+                    ranges.append(byterange)
+                    fail = server.failures > 0
+                    server.failures -= 1 if fail else 0
+                if fail:
+                    self.send_error(503)
+                    return
+                path = self.translate_path(self.path)
+                size = os.path.getsize(path)
+                modified = self.date_time_string(os.path.getmtime(path))
+                if self.headers.get("If-Range", modified) != modified:
+                    return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(
+                        self)
+                first, sep, last = byterange.split("=", 1)[1].partition("-")
+                first = int(first)
+                last = min(int(last or size - 1), size - 1)
+                if first >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Last-Modified", modified)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Last-Modified", modified)
+                self.send_header("Content-Range", "bytes %d-%d/%d" %
+                                 (first, last, size))
+                self.send_header("Content-Length", str(last - first + 1))
+                self.end_headers()
+                with open(path, "rb") as src:
+                    src.seek(first)
+                    self.wfile.write(src.read(last - first + 1))
+
+            def send_response(self, code, *args):
+                statuses.append(int(code))
+                SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(
+                    self, code, *args)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+# Where fetched files are kept between invocations
+cachedir = "/var/cache/imgbased/remote"
+
+# Where images are downloaded to, partial downloads are kept here
+downloaddir = "/var/tmp/imgbased"
+
+# Where the image cache is kept, see use_image_cache
+imagecachedir = "/var/cache/imgbased/images"
+
+# The cache used by get, created on first use
+_url_cache = None
+
+
+def get(url, sidecar_of=None):
+    """The contents of url, fetched at most once per invocation
+
+    See UrlCache.get
+    """
+    global _url_cache
+    if _url_cache is None:
+        _url_cache = UrlCache(cachedir)
+    return _url_cache.get(url, sidecar_of)
+
+
+# The cache for downloaded images, None if it is disabled
+_image_cache = None
+
+
+def use_image_cache(maxsize):
+    """Keep up to maxsize bytes of downloaded images, 0 disables it
+    """
+    global _image_cache
+    _image_cache = ImageCache(imagecachedir, maxsize) if maxsize else None
+
+
+def image_cache():
+    return _image_cache
+
+# vim: sw=4 et sts=4:
@@ -21,6 +21,7 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 import logging
+from . import tracing
 
 
 log = logging.getLogger(__package__)
@@ -114,8 +115,30 @@ class Hooks(object):
         specific = self.hooks.get(name, set())
         all_cbs = wildcard.union(specific)
 
-        for cb in all_cbs:
-            log.debug("Triggering: %s (%s, %s)" % (cb, self.context, args))
-            cb(self.context, *args)
+        tracer = tracing.current()
+        with tracing.span("hook %s" % name):
+            for cb in all_cbs:
+                log.debug("Triggering: %s (%s, %s)" %
+                          (cb, self.context, args))
+                if tracer is None:
+                    cb(self.context, *args)
+                    continue
+                with tracer.span(_callback_name(cb)):
+                    cb(self.context, *args)
+
+
+def _callback_name(cb):
+    """The name of a callback in a trace
+
+    >>> _callback_name(_callback_name)
+    'imgbased.hooks._callback_name'
+    >>> import functools
+    >>> _callback_name(functools.partial(_callback_name))[:18]
+    'functools.partial('
+    """
+    name = getattr(cb, "__name__", None)
+    if name is None:
+        return repr(cb)
+    return "%s.%s" % (getattr(cb, "__module__", None), name)
 
 # vim: sw=4 et sts=4:
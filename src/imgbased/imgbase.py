@@ -20,15 +20,18 @@
 #
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
-import subprocess
 import os
 import re
-import io
+import subprocess
 from .hooks import Hooks
 from . import naming
 from .utils import ExternalBinary, mounted, find_mount_source, \
-    Rsync, augtool
+    tree_sync, use_sync_engine, augtool, spawn, MountManager, \
+    write_sparse, size_of_fstree
 from .lvm import LVM
+from .local import Configuration
+from . import tracing
+from . import fetch
 
 import logging
 
@@ -52,7 +55,20 @@ class ImageLayers(object):
 
     naming = None
 
+    # Shares the mounts during an operation, see MountManager
+    mounts = None
+
+    config = None
+
+    _readonly = False
+
     def __init__(self):
+        self.config = self._core_config()
+        LVM.use_backend(self.config.lvm_backend)
+        LVM.use_inventory_source(self.config.inventory_source)
+        use_sync_engine(self.config.sync_engine)
+        fetch.use_image_cache(int(self.config.image_cache_size) << 20)
+
         self.hooks = Hooks(self)
 
         # A default wildcard hook is to also trigger
@@ -89,10 +105,32 @@ class ImageLayers(object):
                           ("lv_fullname",))
 
         self.run = ExternalBinary()
+        self.mounts = MountManager()
         self.naming = naming.NvrLikeNaming()
         self.naming.vg = self._vg
         self.naming.names = self._lvs
 
+        # The naming tree is cached, drop it whenever LVs come or go.
+        # new-snapshot-added is emitted before new-layer-added, so the
+        # tree is fresh when the new-layer-added handlers run.
+        def _invalidate_naming_1(app, lv):
+            self.naming.invalidate()
+
+        def _invalidate_naming_2(app, previous_lv, new_lv):
+            self.naming.invalidate()
+
+        for hook in ["new-base-added", "base-removed", "layer-removed"]:
+            self.hooks.connect(hook, _invalidate_naming_1)
+        for hook in ["new-snapshot-added", "new-layer-added"]:
+            self.hooks.connect(hook, _invalidate_naming_2)
+
+    def _core_config(self):
+        try:
+            return Configuration().core()
+        except RuntimeError:
+            log.debug("No core configuration found, using defaults")
+            return Configuration.CoreSection()
+
     def _vg(self):
         vg = LVM.VG.from_tag(self.vg_tag)
         log.debug("VG candidate: %s" % vg)
@@ -104,13 +142,25 @@ class ImageLayers(object):
         log.debug("Thinpool candidate: %s" % pool)
         return pool
 
+    def prefer_readonly(self):
+        """Declare that only read-only queries follow
+
+        If configured, LVs are then enumerated without taking the VG
+        lock, see LVM.readonly_lv_names.
+        """
+        if self.config.readonly_enumeration == "readonly":
+            log.debug("Enumerating LVs without the VG lock")
+            self._readonly = True
+            self.naming.invalidate()
+
     def _lvs(self):
         log.debug("Querying for LVs")
-        cmd = ["--noheadings", "-o", "lv_name"]
-        raw = self.run.lvs(cmd)
-        lvs = [n.strip() for n in raw.splitlines()]
+        if self._readonly:
+            lvs = LVM.readonly_lv_names()
+        else:
+            lvs = LVM.inventory().lv_names()
         log.debug("Found lvs: %s" % lvs)
-        return sorted(lvs)
+        return lvs
 
     def _lvs_tree(self, lvs=None):
         return self.naming.tree()
@@ -131,6 +181,9 @@ class ImageLayers(object):
     def layout(self, lvs=None):
         return self.naming.layout(lvs)
 
+    def layout_lines(self, lvs=None):
+        return self.naming.layout_lines(lvs)
+
     def add_layer_on_latest(self):
         previous_layer = self.latest_layer()
         return self.add_layer(previous_layer)
@@ -151,22 +204,31 @@ class ImageLayers(object):
         new_layer = self.naming.suggest_next_layer(previous_layer)
         log.info("New layer will be: %s" % new_layer)
 
-        self._add_snapshot(previous_layer.lvm, new_layer.lvm)
+        with self.mounts:
+            self._add_snapshot(previous_layer.lvm, new_layer.lvm)
 
-        self.hooks.emit("new-layer-added",
-                        previous_layer.lvm.lvm_name,
-                        new_layer.lvm.lvm_name)
+            self.hooks.emit("new-layer-added",
+                            previous_layer.lvm.lvm_name,
+                            new_layer.lvm.lvm_name)
 
     def _add_snapshot(self, prev_lv, new_lv):
+        def is_base(lv):
+            # FIXME do a correct check if it's a base
+            return lv.lv_name.endswith(".0")
+
         try:
             # If an error is raised here, then:
             # https://bugzilla.redhat.com/show_bug.cgi?id=1227046
             # is not fixed yet.
-            prev_lv.activate(True, True)
-
-            prev_lv.create_snapshot(new_lv.lvm_name)
-            new_lv.activate(True, True)
-            new_lv.addtag(self.lv_layer_tag)
+            with prev_lv.transaction() as tx:
+                tx.activate(True, True)
+                tx.setactivationskip(is_base(prev_lv))
+
+            with new_lv.transaction() as tx:
+                tx.create_snapshot(prev_lv)
+                tx.addtag(self.lv_layer_tag)
+                tx.setactivationskip(is_base(new_lv))
+                tx.activate(True, True)
         except:
             log.error("Failed to create a new layer")
             log.debug("Snapshot creation failed", exc_info=True)
@@ -176,14 +238,6 @@ class ImageLayers(object):
         self.run.tune2fs(["-U", "random",
                           new_lv.path])
 
-        # Handle the previous layer
-        # FIXME do a correct check if it's a base
-        skip_if_is_base = new_lv.lv_name.endswith(".0")
-        new_lv.setactivationskip(skip_if_is_base)
-
-        skip_if_is_base = prev_lv.lv_name.endswith(".0")
-        prev_lv.setactivationskip(skip_if_is_base)
-
         self.hooks.emit("new-snapshot-added",
                         prev_lv.lvm_name,
                         new_lv.lvm_name)
@@ -226,7 +280,8 @@ class ImageLayers(object):
             LVM.VG.create(self.vg, pvs)
         LVM.VG(self._vg()).create_thinpool(self._thinpool(), poolsize)
 
-    def add_base(self, size, name, version=None, release=None, lvs=None):
+    def add_base(self, size, name=None, version=None, release=None,
+                 lvs=None):
         """Add a new base LV
         """
         assert size
@@ -237,8 +292,9 @@ class ImageLayers(object):
 
         log.info("New base will be: %s" % new_base_lv)
         pool = self._thinpool()
-        pool.create_thinvol(new_base_lv.nvr, size)
-        new_base_lv.lvm.addtag(self.lv_base_tag)
+        with new_base_lv.lvm.transaction() as tx:
+            tx.create_thinvol(pool, size)
+            tx.addtag(self.lv_base_tag)
 
         self.hooks.emit("new-base-added", new_base_lv.path)
 
@@ -259,6 +315,7 @@ class ImageLayers(object):
             for layer in base.layers:
                 self.remove_layer(layer.nvr)
 
+        self.mounts.unmount(base.lvm.path)
         base.lvm.activate(False)
         base.lvm.remove()
 
@@ -274,42 +331,169 @@ class ImageLayers(object):
         assert layer != self.current_layer()
 
         log.debug("Removing %s" % layer)
+        self.mounts.unmount(layer.lvm.path)
         layer.lvm.activate(False)
         layer.lvm.remove()
 
         self.hooks.emit("layer-removed", layer.lvm.lvm_name)
 
-    def add_base_from_image(self, imagefile, size, name,
+    def _previous_base(self, name):
+        """The latest base with the name, None if there is none
+        """
+        try:
+            name = name or self.naming.last_base().name
+            bases = [b for b in self.naming.bases() if b.name == name]
+        except (RuntimeError, IndexError):
+            return None
+        return bases[-1] if bases else None
+
+    def _add_delta_base_with_tree(self, previous, sourcetree, size,
+                                  name=None, version=None, release=None):
+        """Add a new base as a snapshot of the previous one
+
+        The snapshot is synced with the tree in place, so only the
+        changed files allocate new blocks in the pool. The base keeps
+        the size of the previous one, or is grown to size if that is
+        larger. Returns None if the tree does not fit, and nothing was
+        created.
+        """
+        new_base_lv = self.naming.suggest_next_base(name=name,
+                                                    version=version,
+                                                    release=release)
+        log.info("New base will be: %s (a snapshot of %s)" %
+                 (new_base_lv, previous))
+        with new_base_lv.lvm.transaction() as tx:
+            tx.create_snapshot(previous.lvm)
+            tx.addtag(self.lv_base_tag)
+            # The previous base is protected, the snapshot is written
+            # right away, and protected once it is populated
+            tx.permission("rw")
+            tx.setactivationskip(False)
+            tx.activate(True, True)
+
+        self.hooks.emit("new-base-added", new_base_lv.path)
+
+        try:
+            # The filesystem UUID of the previous base is inherited
+            self.run.tune2fs(["-U", "random", new_base_lv.path])
+
+            grow = LVM.size_in_bytes(size) > new_base_lv.lvm.size()
+            if grow:
+                log.info("Growing %s to %s" % (new_base_lv, size))
+                new_base_lv.lvm.extend(size)
+
+            log.info("Syncing tree into base")
+            with mounted(new_base_lv.path) as mount:
+                dst = mount.target + "/"
+                if grow and not self.dry:
+                    # ext4 is grown online, no fsck is needed
+                    with tracing.span("resize"):
+                        spawn(["resize2fs", new_base_lv.path],
+                              capture=False)
+                fits = self.dry or self._tree_fits(sourcetree, dst)
+                if fits:
+                    rsync = tree_sync("checksum")
+                    rsync.delete = True
+                    if not self.dry:
+                        with tracing.span("sync tree"):
+                            rsync.sync(sourcetree, dst)
+
+                    self.hooks.emit("new-base-with-tree-added", dst)
+                else:
+                    log.info("Tree does not fit into a snapshot of %s, "
+                             "creating a full base" % previous)
+
+            self.mounts.unmount(new_base_lv.path)
+        finally:
+            new_base_lv.protect()
+
+        if not fits:
+            new_base_lv.lvm.remove()
+            self.hooks.emit("base-removed", new_base_lv.lvm.lvm_name)
+            return None
+        return new_base_lv
+
+    def _tree_fits(self, sourcetree, dst, reserve=0.1):
+        st = os.statvfs(dst)
+        return size_of_fstree(sourcetree) < \
+            st.f_blocks * st.f_frsize * (1 - reserve)
+
+    def add_base_from_image(self, imagefile, size, name=None,
                             version=None, release=None, lvs=None):
-        raise NotImplementedError
-        new_base_lv = self.add_base(size, name, version, release, lvs)
+        """Add a new base and write an image to it
 
-        cmd = ["dd", "conv=sparse"]
-        kwargs = {}
+        Args:
+            imagefile: Path to a file or block device, or a stream
+                       (like stdin)
+        """
+        if not hasattr(imagefile, "read") and \
+                not os.path.exists(imagefile):
+            raise RuntimeError("Image does not exist: %s" % imagefile)
 
-        if type(imagefile) is io.IOBase:
-            log.debug("Reading base from stdin")
-            kwargs["stdin"] = imagefile
-        elif type(imagefile) in [str, bytes]:
-            log.debug("Reading base from file: %s" % imagefile)
-            cmd.append("if=%s" % imagefile)
-        else:
-            raise RuntimeError("Unknown infile: %s" % imagefile)
+        new_base_lv = self.add_base(size, name, version, release, lvs)
 
-        cmd.append("of=%s" % new_base_lv.path)
-        log.debug("Running: %s %s" % (cmd, kwargs))
-        if not self.dry:
-            subprocess.check_call(cmd, **kwargs)
+        with new_base_lv.unprotected():
+            log.info("Writing image to base")
+            if not self.dry:
+                with tracing.span("block copy"):
+                    write_sparse(imagefile, new_base_lv.path)
 
         return new_base_lv
 
-    def add_base_with_tree(self, sourcetree, size, name, version=None,
-                           release=None, lvs=None):
+    def add_base_with_fsimage(self, fsimage, size, name=None, version=None,
+                              release=None, lvs=None):
+        """Add a new base by writing an ext filesystem image to it
+
+        The image is copied block by block, blocks of zeros are not
+        written to keep them unallocated in the pool. The filesystem
+        is grown to the size of the base and gets a new UUID.
+        """
         new_base_lv = self.add_base(size, name, version, release, lvs)
 
+        with new_base_lv.unprotected():
+            log.info("Writing filesystem image to base")
+            if not self.dry:
+                with tracing.span("block copy"):
+                    written = write_sparse(fsimage, new_base_lv.path)
+                log.debug("Wrote %d bytes of %s" %
+                          (written, os.path.getsize(fsimage)))
+
+                # resize2fs wants a freshly checked filesystem
+                with tracing.span("resize"):
+                    try:
+                        spawn(["e2fsck", "-f", "-y", new_base_lv.path],
+                              capture=False)
+                    except subprocess.CalledProcessError as e:
+                        # 1 and 2 mean that errors were corrected
+                        if e.returncode >= 4:
+                            raise
+                    spawn(["resize2fs", new_base_lv.path], capture=False)
+                self.run.tune2fs(["-U", "random", new_base_lv.path])
+
+            with mounted(new_base_lv.path) as mount:
+                self.hooks.emit("new-base-with-tree-added",
+                                mount.target + "/")
+
+            # The base is write protected again, so drop it's mount
+            self.mounts.unmount(new_base_lv.path)
+
+        return new_base_lv
+
+    def add_base_with_tree(self, sourcetree, size, name=None, version=None,
+                           release=None, lvs=None):
         if not os.path.exists(sourcetree):
             raise RuntimeError("Sourcetree does not exist: %s" % sourcetree)
 
+        if self.config.base_mode == "delta":
+            previous = self._previous_base(name)
+            if previous:
+                new_base_lv = self._add_delta_base_with_tree(
+                    previous, sourcetree, size, name, version, release)
+                if new_base_lv:
+                    return new_base_lv
+
+        new_base_lv = self.add_base(size, name, version, release, lvs)
+
         with new_base_lv.unprotected():
             log.info("Creating new filesystem on base")
             mkfscmd = ["mkfs.ext4", "-c", "-E", "discard", new_base_lv.path]
@@ -317,19 +501,24 @@ class ImageLayers(object):
                 mkfscmd.append("-q")
             log.debug("Running: %s" % mkfscmd)
             if not self.dry:
-                pass
-                subprocess.check_call(mkfscmd)
+                with tracing.span("mkfs"):
+                    spawn(mkfscmd, capture=False)
 
             log.info("Writing tree to base")
             with mounted(new_base_lv.path) as mount:
                 dst = mount.target + "/"
-                rsync = Rsync()
+                # The filesystem is empty, there is nothing to compare
+                rsync = tree_sync("copy")
                 if not self.dry:
-                    rsync.sync(sourcetree, dst)
+                    with tracing.span("sync tree"):
+                        rsync.sync(sourcetree, dst)
                     log.debug("Trying to copy prev fstab")
 
                 self.hooks.emit("new-base-with-tree-added", dst)
 
+            # The base is write protected again, so drop it's mount
+            self.mounts.unmount(new_base_lv.path)
+
         return new_base_lv
 
     def free_space(self, units="m"):
@@ -356,7 +545,14 @@ class ImageLayers(object):
     def current_layer(self):
         path = "/"
         log.debug("Fetching image for '%s'" % path)
-        lv = self.run.findmnt(["--noheadings", "-o", "SOURCE", path])
+        try:
+            lv = LVM.LV.from_mountpoint(path)
+            log.debug("Found '%s' in the mount table" % lv)
+            return self.image_from_name(lv.lv_name)
+        except RuntimeError:
+            log.debug("Failed to resolve '%s' through sysfs" % path,
+                      exc_info=True)
+        lv = find_mount_source(path)
         log.debug("Found '%s'" % lv)
         try:
             return self.image_from_path(lv)
@@ -364,18 +560,31 @@ class ImageLayers(object):
             log.error("The root volume does not look like an image")
             raise
 
+    def origin_graph(self):
+        return LVM.inventory().origin_graph(self._vg())
+
+    def _images_from_names(self, names):
+        for name in names:
+            try:
+                yield self.image_from_name(name)
+            except RuntimeError:
+                log.debug("Not an image: %s" % name)
+
     def base_of_layer(self, layer):
-        base = None
-        args = ["--noheadings", "--options", "origin"]
-        get_origin = lambda l: LVM._lvs(args +
-                                        ["%s/%s" % (self._vg(), l)])
-
-        while base is None and layer is not None:
-            layer = get_origin(layer)
-            base_candidate = self.image_from_name(layer)
-            if base_candidate.is_base():
-                base = base_candidate
-
-        if not base:
-            raise RuntimeError("No base found for: %s" % layer)
-        return base
+        ancestry = self.origin_graph().ancestry(str(layer))
+        for candidate in self._images_from_names(ancestry):
+            if candidate.is_base():
+                return candidate
+        raise RuntimeError("No base found for: %s" % layer)
+
+    def ancestry_of(self, image):
+        """All images image was derived from, the closest first
+        """
+        ancestry = self.origin_graph().ancestry(str(image))
+        return list(self._images_from_names(ancestry))
+
+    def descendants_of(self, image):
+        """All images which were derived from image (e.g. a base)
+        """
+        descendants = self.origin_graph().descendants(str(image))
+        return sorted(self._images_from_names(descendants))
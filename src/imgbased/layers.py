@@ -30,13 +30,10 @@ from .utils import memoize
 
 
 class Image(object):
-    vg = None
+    # Thousands of these are kept in the naming tree, so keep them small
+    __slots__ = ("vg", "name", "version", "release", "layers")
 
     nvr_fmt = "%s-%s.%s"
-    name = None
-    version = None
-    release = None
-    layers = None
 
     @property
     def nvr(self):
@@ -57,7 +54,7 @@ class Image(object):
 
     def __init__(self, vg=None, name=None, version=None, release=None):
         self.vg = vg
-        self.name = name or self.name
+        self.name = name
         self.version = version
         self.release = release
         self.layers = []
@@ -111,15 +108,19 @@ class Image(object):
 
 
 class Base(Image):
+    __slots__ = ()
+
     def protect(self):
-        self.lvm.permission("r")
-        self.lvm.setactivationskip(True)
-        self.lvm.activate(False, True)
+        with self.lvm.transaction() as tx:
+            tx.permission("r")
+            tx.setactivationskip(True)
+            tx.activate(False, True)
 
     def unprotect(self):
-        self.lvm.permission("rw")
-        self.lvm.setactivationskip(False)
-        self.lvm.activate(True, True)
+        with self.lvm.transaction() as tx:
+            tx.permission("rw")
+            tx.setactivationskip(False)
+            tx.activate(True, True)
 
     def unprotected(self):
         this = self
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+import os
+import sys
+import json
+import logging
+
+
+log = logging.getLogger(__package__)
+
+
+class Ledger(object):
+    """A record of external commands, to see where the time goes
+
+    >>> ledger = Ledger()
+    >>> ledger.record(["rsync", "-a", "/a", "/b"], 12.5, 10.25, 0, 0,
+    ...               site="imgbased.imgbase:add_base_with_tree")
+    >>> ledger.record(["/usr/sbin/lvs", "-o", "lv_name"], 0.25, 0.125, 0,
+    ...               120, site="imgbased.lvm:scan")
+    >>> ledger.record(["lvs", "-o", "lv_name"], 0.25, None, 5, 0,
+    ...               site="imgbased.lvm:scan")
+    >>> [(row["key"], row["calls"], row["failed"], row["cpu"])
+    ...  for row in ledger.by("binary")]
+    [('rsync', 1, 0, 10.25), ('lvs', 2, 1, 0.125)]
+    >>> print(ledger.table())  # doctest: +NORMALIZE_WHITESPACE
+    By binary       calls  failed   wall (s)    cpu (s)   output (B)
+    rsync               1       0     12.500     10.250            0
+    lvs                 2       1      0.500      0.125          120
+    <BLANKLINE>
+    By call site    calls  failed   wall (s)    cpu (s)   output (B)
+    imgbased.imgbase:add_base_with_tree
+                        1       0     12.500     10.250            0
+    imgbased.lvm:scan
+                        2       1      0.500      0.125          120
+    """
+    entries = None
+
+    def __init__(self):
+        self.entries = []
+
+    def record(self, argv, wall, cpu, status, output_size, site=None):
+        """Add one command
+
+        cpu is the user and system time of the command, None if it is
+        not known (e.g. for commands run in an lvm shell).
+        """
+        argv = [str(a) for a in argv]
+        self.entries.append({"argv": argv,
+                             "binary": os.path.basename(argv[0]),
+                             "wall": wall,
+                             "cpu": cpu,
+                             "status": status,
+                             "output_size": output_size,
+                             "site": site or call_site()})
+
+    def by(self, key):
+        """Aggregate the entries by binary or site, most wall time first
+        """
+        rows = {}
+        for entry in self.entries:
+            row = rows.setdefault(entry[key], {"key": entry[key],
+                                               "calls": 0, "failed": 0,
+                                               "wall": 0.0, "cpu": 0.0,
+                                               "output_size": 0})
+            row["calls"] += 1
+            row["failed"] += 1 if entry["status"] else 0
+            row["wall"] += entry["wall"]
+            row["cpu"] += entry["cpu"] or 0.0
+            row["output_size"] += entry["output_size"]
+        return sorted(rows.values(), key=lambda r: (-r["wall"], r["key"]))
+
+    def table(self):
+        """A human readable summary by binary and by call site
+        """
+        lines = []
+        for title, key in [("By binary", "binary"),
+                           ("By call site", "site")]:
+            if lines:
+                lines.append("")
+            lines.append("%-14s %6s %7s %10s %10s %12s" %
+                         (title, "calls", "failed", "wall (s)", "cpu (s)",
+                          "output (B)"))
+            for row in self.by(key):
+                numbers = ("%6d %7d %10.3f %10.3f %12d" %
+                           (row["calls"], row["failed"], row["wall"],
+                            row["cpu"], row["output_size"]))
+                if len(row["key"]) > 14:
+                    lines += [row["key"], "%-14s %s" % ("", numbers)]
+                else:
+                    lines.append("%-14s %s" % (row["key"], numbers))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as dst:
+            json.dump({"commands": self.entries,
+                       "by_binary": self.by("binary"),
+                       "by_site": self.by("site")}, dst, indent=2)
+
+
+# Where commands are recorded, None if recording is disabled
+_ledger = None
+
+# Code which only passes commands on, see call_site
+_plumbing = set()
+_plumbing_modules = (__name__, __package__ + ".utils",
+                     __package__ + ".cassette")
+
+
+def enable():
+    """Start recording all external commands
+    """
+    global _ledger
+    _ledger = Ledger()
+    return _ledger
+
+
+def disable():
+    global _ledger
+    _ledger = None
+
+
+def current():
+    return _ledger
+
+
+def record(argv, wall, cpu, status, output_size):
+    """Record a command, if recording is enabled
+    """
+    if _ledger is not None:
+        _ledger.record(argv, wall, cpu, status, output_size)
+
+
+def plumbing(func):
+    """Mark a function which only passes commands on
+
+    Such functions are not reported as call site.
+    """
+    _plumbing.add(func.__code__)
+    return func
+
+
+def call_site():
+    """The module and function which issued the current command
+
+    Frames in ledger, utils, cassette and plumbing functions are
+    skipped.
+    """
+    frame = sys._getframe(1)
+    while frame:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        if code not in _plumbing and module not in _plumbing_modules:
+            return "%s:%s" % (module, code.co_name)
+        frame = frame.f_back
+    return "?"
+
+# vim: sw=4 et sts=4:
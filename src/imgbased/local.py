@@ -22,8 +22,10 @@
 #
 
 import os
+import json
 from six.moves import configparser
 from io import StringIO
+from . import cassette
 
 import logging
 
@@ -71,6 +73,26 @@ class Configuration():
     class CoreSection(Section):
         _type = "core"
         mode = None
+        # How LVM commands are run: fork or shell (see lvm.LvmShell)
+        lvm_backend = "fork"
+        # How read-only queries enumerate LVs: lvm (through the
+        # inventory) or readonly (lvs --readonly, without the VG lock)
+        readonly_enumeration = "lvm"
+        # Where LV and VG details are read from: lvm or metadata
+        # (the PV metadata is read directly, see lvmmeta)
+        inventory_source = "lvm"
+        # How trees are synced: rsync or native (see utils.TreeSync)
+        sync_engine = "rsync"
+        # How a base is imported from a liveimg: tree (file by file)
+        # or block (the filesystem image is written to the base)
+        base_import = "tree"
+        # How a base is created from a tree: full (a new filesystem)
+        # or delta (a snapshot of the previous base with the same
+        # name, synced in place, to share the unchanged blocks)
+        base_mode = "full"
+        # MiB of downloaded images which are kept for later use (see
+        # fetch.ImageCache), 0 disables the cache
+        image_cache_size = 0
 
     class PoolSection(Section):
         _type = "pool"
@@ -90,6 +112,38 @@ class Configuration():
     def _parser(self, only_user_file=False):
         p = configparser.ConfigParser()
 
+        if self.cfgstr:
+            log.debug("Using cfgstr")
+            # Used for doctests
+            try:
+                p.readfp(StringIO(self.cfgstr.decode("ascii")))
+            except:
+                p.readfp(StringIO(self.cfgstr))
+        else:
+            locs = [self.VENDOR_CFG_PREFIX]
+            if only_user_file:
+                locs = [self.USER_CFG_PREFIX]
+            else:
+                locs += [self.USER_CFG_PREFIX]
+
+            # The files are read through the cassette, so that the
+            # configuration of the host is replayed as well
+            files = cassette.taped("config", self._read_files, locs,
+                                   only_user_file)
+            for fn, contents in json.loads(files):
+                p.readfp(StringIO(contents), fn)
+
+        return p
+
+    def _read_files(self, locs, only_user_file):
+        """The names and contents of the config files, as JSON
+        """
+        files = []
+
+        def read(fn):
+            with open(fn) as src:
+                files.append((fn, src.read()))
+
         def read_loc(loc_prefix):
             cfgfile = loc_prefix + self.CFG_FILE
             cfgdir = loc_prefix + self.CFG_DIR
@@ -98,7 +152,7 @@ class Configuration():
             log.debug("Reading config dir: %s" % cfgdir)
 
             if os.path.exists(cfgfile):
-                p.read(cfgfile)
+                read(cfgfile)
                 log.debug("Read file")
 
             if not only_user_file:
@@ -108,29 +162,15 @@ class Configuration():
                         fullfn = cfgdir + "/" + fn
                         log.debug("Also reading: %s" % fullfn)
                         if os.path.isfile(fullfn):
-                            p.read(fullfn)
+                            read(fullfn)
                 else:
                     log.debug("No config dir found")
 
-        if self.cfgstr:
-            log.debug("Using cfgstr")
-            # Used for doctests
-            try:
-                p.readfp(StringIO(self.cfgstr.decode("ascii")))
-            except:
-                p.readfp(StringIO(self.cfgstr))
-        else:
-            locs = [self.VENDOR_CFG_PREFIX]
-            if only_user_file:
-                locs = [self.USER_CFG_PREFIX]
-            else:
-                locs += [self.USER_CFG_PREFIX]
+        for loc in locs:
+            log.debug("Passing prefix: %s" % loc)
+            read_loc(loc)
 
-            for loc in locs:
-                log.debug("Passing prefix: %s" % loc)
-                read_loc(loc)
-
-        return p
+        return json.dumps(files)
 
     def core(self):
         return self.section(Configuration.CoreSection)
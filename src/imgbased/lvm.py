@@ -20,22 +20,470 @@
 #
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
+import os
+import re
+import json
+import time
 import shlex
+import atexit
 import logging
-from .utils import ExternalBinary
+import functools
+import subprocess
+from . import ledger
+from .utils import ExternalBinary, MountInfo, File, release_mounts
 
 
 log = logging.getLogger(__package__)
 
 
+class LvmShell(object):
+    """Pipe LVM commands into one long-lived lvm shell
+
+    Forking lvs, lvcreate etc. for every command means rescanning all
+    devices and setting up locking each time. The shell keeps that
+    state between commands.
+    The exit status of a command is not visible in the shell, so it is
+    taken from the command log report of the following lastlog.
+    If the shell misbehaves, commands fall back to a fork per call.
+
+    >>> LvmShell._quote(["lvs", "--select", "lv_name = foo", "-o", "a,b"])
+    'lvs --select "lv_name = foo" -o a,b'
+
+    >>> report = '''{"log": [
+    ...   {"log_type": "status", "log_object_type": "cmd",
+    ...    "log_ret_code": "1"}]}'''
+    >>> LvmShell._succeeded(report)
+    True
+    >>> LvmShell._succeeded(report.replace('"1"', '"5"'))
+    False
+    """
+    prompt = b"lvm> "
+    log_config = ["--config", "log/report_command_log=1"]
+
+    proc = None
+    broken = False
+
+    @staticmethod
+    def _quote(args):
+        return " ".join('"%s"' % a if " " in a else a for a in args)
+
+    @staticmethod
+    def _succeeded(lastlog):
+        data = json.loads(lastlog)
+        rows = data.get("log", [])
+        for report in data.get("report", []):
+            rows += report.get("log", [])
+        status = [r for r in rows
+                  if r.get("log_type") == "status" and
+                  r.get("log_object_type") == "cmd"]
+        if not status:
+            raise RuntimeError("No command status in log: %s" % lastlog)
+        return status[-1]["log_ret_code"] == "1"
+
+    def _start(self):
+        log.debug("Starting lvm shell")
+        self.proc = subprocess.Popen(["lvm"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     close_fds=True)
+        atexit.register(self.close)
+        self._read_until_prompt()
+
+    def _read_until_prompt(self):
+        buf = bytes()
+        while not buf.endswith(self.prompt):
+            chunk = os.read(self.proc.stdout.fileno(), 65536)
+            if not chunk:
+                raise RuntimeError("The lvm shell exited unexpectedly")
+            buf += chunk
+        return buf[:-len(self.prompt)]
+
+    def _execute(self, args):
+        line = self._quote(args).encode()
+        self.proc.stdin.write(line + b"\n")
+        self.proc.stdin.flush()
+        stdout = self._read_until_prompt()
+        # The shell might echo the command line
+        if stdout.startswith(line):
+            stdout = stdout[len(line):]
+        return stdout.decode(errors="replace").strip()
+
+    @ledger.plumbing
+    def call(self, args):
+        if self.broken:
+            return ExternalBinary().call(args)
+
+        log.debug("Calling in lvm shell: %s" % args)
+        begin = time.time()
+        try:
+            if self.proc is None:
+                self._start()
+            stdout = self._execute(args + self.log_config)
+            lastlog = self._execute(["lastlog", "--reportformat", "json"] +
+                                    self.log_config)
+            succeeded = self._succeeded(lastlog)
+        except (OSError, IOError, RuntimeError, ValueError, KeyError):
+            log.warning("The lvm shell failed, falling back to forking")
+            log.debug("lvm shell failure", exc_info=True)
+            self.broken = True
+            self.close()
+            return ExternalBinary().call(args)
+
+        # The CPU time is not known, the shell process is shared
+        ledger.record(["lvm"] + args, time.time() - begin, None,
+                      0 if succeeded else 5, len(stdout))
+        if not succeeded:
+            raise subprocess.CalledProcessError(5, args, stdout)
+        log.debug("Returned: %s" % stdout[0:1024])
+        return stdout
+
+    def close(self):
+        if self.proc is None:
+            return
+        log.debug("Closing lvm shell")
+        try:
+            self.proc.stdin.write(b"exit\n")
+            self.proc.stdin.close()
+        except (OSError, IOError):
+            log.debug("lvm shell is already gone")
+        self.proc.wait()
+        self.proc = None
+
+
+def _invalidates_inventory(func):
+    """Wrap a mutating LVM command to drop the cached inventory afterwards
+    """
+    @ledger.plumbing
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            LVM.invalidate()
+    return staticmethod(wrapper)
+
+
 class LVM(object):
     _lvs = ExternalBinary().lvs
     _vgs = ExternalBinary().vgs
-    _lvcreate = ExternalBinary().lvcreate
-    _lvchange = ExternalBinary().lvchange
-    _lvremove = ExternalBinary().lvremove
-    _vgcreate = ExternalBinary().vgcreate
-    _vgchange = ExternalBinary().vgchange
+    _lvcreate = _invalidates_inventory(ExternalBinary().lvcreate)
+    _lvchange = _invalidates_inventory(ExternalBinary().lvchange)
+    _lvremove = _invalidates_inventory(ExternalBinary().lvremove)
+    _lvextend = _invalidates_inventory(ExternalBinary().lvextend)
+    _vgcreate = _invalidates_inventory(ExternalBinary().vgcreate)
+    _vgchange = _invalidates_inventory(ExternalBinary().vgchange)
+
+    _inventory = None
+
+    sysfs = "/sys"
+
+    backends = {"fork": lambda: None,
+                "shell": LvmShell}
+
+    # Where the inventory is taken from, see LVM.Inventory
+    inventory_source = "lvm"
+
+    @staticmethod
+    def use_backend(backend):
+        """Select how LVM commands are executed, see LVM.backends
+
+        Tests and benchmarks can also pass an executor, like an
+        lvmsim.LvmSimulator.
+        """
+        if hasattr(backend, "call"):
+            log.debug("Using LVM executor: %s" % backend)
+            ExternalBinary.lvm = backend
+        elif backend in LVM.backends:
+            log.debug("Using LVM backend: %s" % backend)
+            ExternalBinary.lvm = LVM.backends[backend]()
+        else:
+            raise RuntimeError("Unknown LVM backend: %s" % backend)
+        return ExternalBinary.lvm
+
+    @staticmethod
+    def split_dm_name(dm_name):
+        """Split a device-mapper name into VG, LV and layer
+
+        LVM doubles dashes in VG and LV names, a single dash separates
+        them (and an internal layer like tpool).
+
+        >>> LVM.split_dm_name("HostVG-Image--0.1")
+        ('HostVG', 'Image-0.1', None)
+        >>> LVM.split_dm_name("my--vg-pool00-tpool")
+        ('my-vg', 'pool00', 'tpool')
+        >>> LVM.split_dm_name("nodash")
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Not an LVM device-mapper name: nodash
+        """
+        parts = re.split(r"(?<!-)-(?!-)", dm_name)
+        if len(parts) < 2:
+            raise RuntimeError("Not an LVM device-mapper name: %s" % dm_name)
+        parts = [p.replace("--", "-") for p in parts]
+        vg_name, lv_name = parts[:2]
+        layer = "-".join(parts[2:]) or None
+        return (vg_name, lv_name, layer)
+
+    @staticmethod
+    def size_in_bytes(size):
+        """Convert a size like LVM takes it, the default unit is MiB
+
+        >>> LVM.size_in_bytes("10G"), LVM.size_in_bytes("4096B")
+        (10737418240, 4096)
+        >>> LVM.size_in_bytes(2)
+        2097152
+        """
+        size = str(size).strip().lower()
+        unit = "m"
+        if size[-1] in "bskmgtpe":
+            size, unit = size[:-1], size[-1]
+        exponent = {"b": 0, "k": 1, "m": 2, "g": 3, "t": 4, "p": 5, "e": 6}
+        if unit == "s":
+            return int(float(size) * 512)
+        return int(float(size) * 1024 ** exponent[unit])
+
+    @staticmethod
+    def readonly_lv_names():
+        """List the names of all LVs without taking the VG lock
+
+        This is a single lvs --readonly run. It scans every PV like the
+        inventory, but it neither waits for nor blocks concurrent LVM
+        commands, at the risk of seeing the metadata in the middle of a
+        change. Reading the active LVs from sysfs first would not save
+        the scan: bases carry the activation skip flag, so they are
+        usually inactive and only LVM knows about them.
+        """
+        names = LVM._lvs(["--readonly", "--noheadings", "-o", "lv_name"])
+        return sorted(n.strip() for n in names.splitlines() if n.strip())
+
+    @staticmethod
+    def use_inventory_source(name):
+        """Select where the inventory is taken from: lvm or metadata
+        """
+        if name not in ("lvm", "metadata"):
+            raise RuntimeError("Unknown inventory source: %s" % name)
+        LVM.inventory_source = name
+        LVM.invalidate()
+
+    @staticmethod
+    def inventory():
+        """Return the current inventory snapshot, scan if there is none
+        """
+        if LVM._inventory is None:
+            if LVM.inventory_source == "metadata":
+                LVM._inventory = LVM.Inventory.from_metadata()
+            else:
+                LVM._inventory = LVM.Inventory.scan()
+        return LVM._inventory
+
+    @staticmethod
+    def invalidate():
+        """Drop the inventory snapshot, the next access will rescan
+        """
+        LVM._inventory = None
+
+    class Inventory(object):
+        """A snapshot of all VGs and LVs, taken with one lvs and one vgs run
+        or read from the PV metadata (see LVM.inventory_source)
+
+        All read-only queries of VG, LV and Thinpool are served from this
+        snapshot, mutating calls invalidate it (see LVM.invalidate).
+
+        >>> lvs = '''{"report": [{"lv": [
+        ...   {"vg_name": "HostVG", "lv_name": "pool", "lv_tags": "",
+        ...    "lv_path": "", "lv_dm_path": "/dev/mapper/HostVG-pool",
+        ...    "origin": "", "pool_lv": "", "lv_skip_activation": "0",
+        ...    "lv_permissions": "writeable"},
+        ...   {"vg_name": "HostVG", "lv_name": "Image-0.0",
+        ...    "lv_tags": "imgbased:base,other",
+        ...    "lv_path": "/dev/HostVG/Image-0.0",
+        ...    "lv_dm_path": "/dev/mapper/HostVG-Image--0.0",
+        ...    "origin": "", "pool_lv": "pool", "lv_skip_activation": "1",
+        ...    "lv_permissions": "read-only"}
+        ... ]}]}'''
+        >>> vgs = '''{"report": [{"vg": [
+        ...   {"vg_name": "HostVG", "vg_tags": "imgbased:vg"}]}]}'''
+        >>> inv = LVM.Inventory.from_reports(lvs, vgs)
+
+        >>> inv.lv("HostVG/Image-0.0")["pool_lv"]
+        'pool'
+        >>> inv.lv_tags("HostVG/Image-0.0")
+        ['imgbased:base', 'other']
+        >>> inv.lv_tags("HostVG/pool")
+        []
+        >>> inv.lvs_with_tag("imgbased:base")
+        ['HostVG/Image-0.0']
+        >>> inv.vgs_with_tag("imgbased:vg")
+        ['HostVG']
+        >>> inv.lv_by_path("/dev/mapper/HostVG-Image--0.0")["lv_name"]
+        'Image-0.0'
+        >>> inv.lv_names()
+        ['Image-0.0', 'pool']
+        >>> inv.lv("HostVG/Missing")
+        Traceback (most recent call last):
+        ...
+        KeyError: 'HostVG/Missing'
+        """
+        lv_fields = ["vg_name", "lv_name", "lv_path", "lv_dm_path",
+                     "lv_tags", "origin", "pool_lv",
+                     "lv_skip_activation", "lv_permissions"]
+        vg_fields = ["vg_name", "vg_tags"]
+
+        _lv_rows = None
+        _vg_rows = None
+        _graphs = None
+
+        def __init__(self, lvs, vgs):
+            self._lv_rows = dict(("%s/%s" % (lv["vg_name"], lv["lv_name"]),
+                                  lv) for lv in lvs)
+            self._vg_rows = dict((vg["vg_name"], vg) for vg in vgs)
+            self._graphs = {}
+
+        @staticmethod
+        def _parse_report(data, kind):
+            """Return the rows of a JSON report of lvs or vgs
+
+            >>> LVM.Inventory._parse_report('{"report": [{"vg": []}]}', "vg")
+            []
+            """
+            rows = []
+            for report in json.loads(data).get("report", []):
+                rows += report.get(kind, [])
+            return rows
+
+        @staticmethod
+        def from_reports(lvs_data, vgs_data):
+            Inventory = LVM.Inventory
+            return Inventory(Inventory._parse_report(lvs_data, "lv"),
+                             Inventory._parse_report(vgs_data, "vg"))
+
+        @staticmethod
+        def scan():
+            log.debug("Taking LVM inventory snapshot")
+            Inventory = LVM.Inventory
+            common = ["--reportformat", "json", "--binary", "-o"]
+            lvs = LVM._lvs(common + [",".join(Inventory.lv_fields)])
+            vgs = LVM._vgs(common + [",".join(Inventory.vg_fields)])
+            return Inventory.from_reports(lvs, vgs)
+
+        @staticmethod
+        def from_metadata(paths=None):
+            """Take the snapshot from the on-disk metadata of the PVs
+
+            No LVM command is run and no LVM lock is taken, see lvmmeta.
+            """
+            from . import lvmmeta
+            return LVM.Inventory(*lvmmeta.scan(paths))
+
+        @staticmethod
+        def _split_tags(tags):
+            return [t for t in tags.split(",") if t]
+
+        def lv(self, lvm_name):
+            return self._lv_rows[lvm_name]
+
+        def lv_tags(self, lvm_name):
+            return self._split_tags(self.lv(lvm_name)["lv_tags"])
+
+        def lv_names(self):
+            return sorted(lv["lv_name"] for lv in self._lv_rows.values())
+
+        def lvs_with_tag(self, tag):
+            return sorted(n for n in self._lv_rows
+                          if tag in self.lv_tags(n))
+
+        def lv_by_path(self, path):
+            for lv in self._lv_rows.values():
+                if path in (lv["lv_path"], lv["lv_dm_path"]):
+                    return lv
+            raise KeyError(path)
+
+        def origin_graph(self, vg_name):
+            """The origin graph of all LVs in a VG, built once per snapshot
+            """
+            if vg_name not in self._graphs:
+                rows = [lv for lv in self._lv_rows.values()
+                        if lv["vg_name"] == vg_name]
+                self._graphs[vg_name] = LVM.OriginGraph(rows)
+            return self._graphs[vg_name]
+
+        def vg_tags(self, vg_name):
+            return self._split_tags(self._vg_rows[vg_name]["vg_tags"])
+
+        def vgs_with_tag(self, tag):
+            return sorted(n for n in self._vg_rows
+                          if tag in self.vg_tags(n))
+
+    class OriginGraph(object):
+        """The snapshot relations between the LVs of one VG
+
+        >>> rows = [{"lv_name": n, "origin": o, "pool_lv": "pool",
+        ...          "lv_tags": ""}
+        ...         for n, o in [("root", ""),
+        ...                      ("Image-0.0", "root"),
+        ...                      ("Image-0.1", "Image-0.0"),
+        ...                      ("Image-0.2", "Image-0.1"),
+        ...                      ("Image-1.0", ""),
+        ...                      ("Image-1.1", "Image-1.0")]]
+        >>> graph = LVM.OriginGraph(rows)
+
+        >>> graph.origin("Image-0.1")
+        'Image-0.0'
+        >>> graph.origin("root") is None
+        True
+        >>> graph.ancestry("Image-0.2")
+        ['Image-0.1', 'Image-0.0', 'root']
+        >>> graph.children("Image-0.0")
+        ['Image-0.1']
+        >>> graph.descendants("Image-0.0")
+        ['Image-0.1', 'Image-0.2']
+        >>> graph.descendants("Image-1.1")
+        []
+        >>> graph.pool("Image-1.1")
+        'pool'
+        """
+        _rows = None
+        _children = None
+
+        def __init__(self, rows):
+            self._rows = dict((lv["lv_name"], lv) for lv in rows)
+            self._children = {}
+            for name, lv in self._rows.items():
+                if lv["origin"]:
+                    self._children.setdefault(lv["origin"], []).append(name)
+
+        def origin(self, lv_name):
+            return self._rows[lv_name]["origin"] or None
+
+        def pool(self, lv_name):
+            return self._rows[lv_name]["pool_lv"] or None
+
+        def tags(self, lv_name):
+            return [t for t in self._rows[lv_name]["lv_tags"].split(",") if t]
+
+        def ancestry(self, lv_name):
+            """All origins of an LV, the direct origin first
+            """
+            chain = []
+            origin = self.origin(lv_name)
+            while origin and origin not in chain:
+                chain.append(origin)
+                origin = self.origin(origin) if origin in self._rows \
+                    else None
+            return chain
+
+        def children(self, lv_name):
+            return sorted(self._children.get(lv_name, []))
+
+        def descendants(self, lv_name):
+            """All LVs which were (transitively) snapshotted from an LV
+            """
+            found = []
+            todo = [lv_name]
+            while todo:
+                children = self._children.get(todo.pop(), [])
+                found += children
+                todo += children
+            return sorted(found)
 
     class VG(object):
         vg_name = None
@@ -48,9 +496,7 @@ class LVM(object):
 
         @staticmethod
         def find_by_tag(tag):
-            vgs = LVM._vgs(["--noheadings", "--select",
-                            "vg_tags = %s" % tag, "-o", "vg_name"])
-            return vgs.splitlines()
+            return LVM.inventory().vgs_with_tag(tag)
 
         @staticmethod
         def from_tag(tag):
@@ -74,8 +520,7 @@ class LVM(object):
             LVM._vgchange(["--addtag", tag, self.vg_name])
 
         def tags(self):
-            return LVM._vgs(["--noheadings", "-ovg_tags",
-                            self.vg_name]).split(",")
+            return LVM.inventory().vg_tags(self.vg_name)
 
     class LV(object):
         vg_name = None
@@ -89,7 +534,7 @@ class LVM(object):
 
         @property
         def path(self):
-            return LVM._lvs(["--noheadings", "-olv_path", self.lvm_name])
+            return LVM.inventory().lv(self.lvm_name)["lv_path"]
 
         def __init__(self, vg_name, lv_name):
             self.vg_name = vg_name
@@ -113,10 +558,8 @@ class LVM(object):
 
         @staticmethod
         def find_by_tag(tag):
-            lvs = LVM._vgs(["--noheadings", "@%s" % tag,
-                            "-o", "lv_full_name"])
-            return [LVM.LV.from_lvm_name(lv.strip())
-                    for lv in lvs.splitlines()]
+            return [LVM.LV.from_lvm_name(lvm_name)
+                    for lvm_name in LVM.inventory().lvs_with_tag(tag)]
 
         @staticmethod
         def from_tag(tag):
@@ -140,57 +583,111 @@ class LVM(object):
         def from_path(path):
             """Get an object for the path
             """
+            try:
+                lv = LVM.inventory().lv_by_path(path)
+                return LVM.LV(lv["vg_name"], lv["lv_name"])
+            except KeyError:
+                log.debug("Path %s not in inventory, asking LVM" % path)
             data = LVM._lvs(["--noheadings", "-ovg_name,lv_name", path])
             assert data, "Failed to find LV for path: %s" % path
             log.debug("Found LV for path %s: %s" % (path, data))
             return LVM.LV(*shlex.split(data))
 
+        @staticmethod
+        def from_devno(major, minor):
+            """Get an object for a block device number, using sysfs
+
+            This does not need LVM at all, but only works for active LVs.
+            """
+            dm_dir = "%s/dev/block/%d:%d/dm" % (LVM.sysfs, major, minor)
+            try:
+                dm_name = File(dm_dir + "/name").read().strip()
+                dm_uuid = File(dm_dir + "/uuid").read().strip()
+            except (IOError, OSError):
+                raise RuntimeError("No device-mapper device: %d:%d" %
+                                   (major, minor))
+            if not dm_uuid.startswith("LVM-"):
+                raise RuntimeError("Not an LVM device: %s" % dm_name)
+            vg_name, lv_name, layer = LVM.split_dm_name(dm_name)
+            if layer:
+                raise RuntimeError("Not a top-level LV: %s" % dm_name)
+            return LVM.LV(vg_name, lv_name)
+
+        @staticmethod
+        def from_mountpoint(path):
+            """Get an object for the LV mounted at path
+            """
+            entry = MountInfo().find(path)
+            if entry is None:
+                raise RuntimeError("Nothing is mounted at: %s" % path)
+            return LVM.LV.from_devno(*entry.devno)
+
         def create_snapshot(self, new_name):
             LVM._lvcreate(["--snapshot",
                            "--name", new_name,
                            self.lvm_name])
 
+        @property
+        def dev_path(self):
+            """The /dev path of the LV, without a lookup
+            """
+            return "/dev/%s" % self.lvm_name
+
         def remove(self, force=False):
             cmd = ["-f"] if force else []
             cmd.append(self.lvm_name)
+            release_mounts(self.dev_path)
             LVM._lvremove(cmd)
 
+        def size(self):
+            """The size of the LV in bytes
+            """
+            return int(float(LVM._lvs(["--noheadings", "--nosuffix",
+                                       "--units", "b", "-o", "lv_size",
+                                       self.lvm_name])))
+
+        def extend(self, size):
+            """Grow the LV to size (like 10G), the filesystem is kept
+            """
+            LVM._lvextend(["--size", str(size), self.lvm_name])
+
+        def transaction(self):
+            """Collect several changes and apply them in one LVM call
+            """
+            return LVM.Transaction(self)
+
         def activate(self, val, ignoreactivationskip=False):
-            assert val in [True, False]
-            val = "y" if val else "n"
-            cmd = ["--activate", val, self.lvm_name]
-            if ignoreactivationskip:
-                cmd.append("--ignoreactivationskip")
-            LVM._lvchange(cmd)
+            with self.transaction() as tx:
+                tx.activate(val, ignoreactivationskip)
 
         def setactivationskip(self, val):
-            assert val in [True, False]
-            val = "y" if val else "n"
-            LVM._lvchange(["--setactivationskip", val,
-                           self.lvm_name])
+            with self.transaction() as tx:
+                tx.setactivationskip(val)
 
         def permission(self, val):
-            assert val in ["r", "rw"]
-            LVM._lvchange(["--permission", val,
-                           self.lvm_name])
+            with self.transaction() as tx:
+                tx.permission(val)
 
         def thinpool(self):
-            pool_lv = LVM._lvs(["--noheadings", "-opool_lv",
-                               self.lvm_name])
+            pool_lv = LVM.inventory().lv(self.lvm_name)["pool_lv"]
             return LVM.LV(self.vg_name, pool_lv) if pool_lv else None
 
         def addtag(self, tag):
-            LVM._lvchange(["--addtag", tag, self.lvm_name])
+            with self.transaction() as tx:
+                tx.addtag(tag)
 
         def tags(self):
-            return LVM._lvs(["--noheadings", "-olv_tags",
-                            self.lvm_name]).split(",")
+            return LVM.inventory().lv_tags(self.lvm_name)
 
         def origin(self):
             lv_name = self.options(["origin"]).pop()
             return LVM.LV(self.vg_name, lv_name)
 
         def options(self, options):
+            inventory = LVM.inventory()
+            if set(options) <= set(inventory.lv_fields):
+                lv = inventory.lv(self.lvm_name)
+                return [lv[o] for o in options]
             sep = "$"
             cmd = ["--noheadings",
                    "--separator", sep,
@@ -207,4 +704,123 @@ class LVM(object):
                            self.lvm_name])
             return vol
 
+    class Transaction(object):
+        """Changes to an LV which are applied together
+
+        Every lvchange commits the metadata and waits for udev, so all
+        collected property changes are flushed with a single lvchange
+        or, if the LV is created in the same transaction, a single
+        lvcreate.
+
+        lvchange only handles an activation change together with other
+        changes through a deprecated compatibility path, so the
+        activation is changed by a second lvchange, after the
+        properties. lvcreate takes all of them at once.
+
+        >>> lv = LVM.LV("HostVG", "Image-0.0")
+        >>> tx = lv.transaction()
+        >>> tx.permission("r")
+        >>> tx.setactivationskip(True)
+        >>> tx.activate(False, True)
+        >>> tx.commands()
+        [['lvchange', '--permission', 'r', '--setactivationskip', 'y', \
+'HostVG/Image-0.0'], \
+['lvchange', '--activate', 'n', '--ignoreactivationskip', \
+'HostVG/Image-0.0']]
+
+        >>> tx = lv.transaction()
+        >>> tx.activate(True, True)
+        >>> tx.commands()
+        [['lvchange', '--activate', 'y', '--ignoreactivationskip', \
+'HostVG/Image-0.0']]
+
+        >>> new = LVM.LV("HostVG", "Image-0.1")
+        >>> tx = new.transaction()
+        >>> tx.create_snapshot(lv)
+        >>> tx.addtag("imgbased:layer")
+        >>> tx.setactivationskip(False)
+        >>> tx.activate(True, True)
+        >>> tx.commands()
+        [['lvcreate', '--snapshot', '--name', 'Image-0.1', \
+'--addtag', 'imgbased:layer', '--setactivationskip', 'n', \
+'--activate', 'y', '--ignoreactivationskip', 'HostVG/Image-0.0']]
+
+        >>> tx = new.transaction()
+        >>> tx.create_thinvol(LVM.Thinpool("HostVG", "pool"), "10G")
+        >>> tx.commands()
+        [['lvcreate', '--thin', '--virtualsize', '10G', \
+'--name', 'Image-0.1', 'HostVG/pool']]
+
+        >>> LVM.LV("HostVG", "Image-0.0").transaction().commands()
+        []
+        """
+        lv = None
+
+        _create = None
+        _options = None
+        _activation = None
+
+        def __init__(self, lv):
+            self.lv = lv
+            self.clear()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            if exc_type is None:
+                self.commit()
+
+        def clear(self):
+            self._create = None
+            self._options = []
+            self._activation = []
+
+        def create_snapshot(self, origin):
+            self._create = (["--snapshot", "--name", self.lv.lv_name],
+                            origin.lvm_name)
+
+        def create_thinvol(self, pool, volsize):
+            self._create = (["--thin", "--virtualsize", volsize,
+                             "--name", self.lv.lv_name],
+                            pool.lvm_name)
+
+        def activate(self, val, ignoreactivationskip=False):
+            assert val in [True, False]
+            self._activation = ["--activate", "y" if val else "n"]
+            if ignoreactivationskip:
+                self._activation.append("--ignoreactivationskip")
+
+        def setactivationskip(self, val):
+            assert val in [True, False]
+            self._options += ["--setactivationskip", "y" if val else "n"]
+
+        def permission(self, val):
+            assert val in ["r", "rw"]
+            self._options += ["--permission", val]
+
+        def addtag(self, tag):
+            self._options += ["--addtag", tag]
+
+        def commands(self):
+            if self._create:
+                args, target = self._create
+                return [["lvcreate"] + args + self._options +
+                        self._activation + [target]]
+            return [["lvchange"] + options + [self.lv.lvm_name]
+                    for options in (self._options, self._activation)
+                    if options]
+
+        def commit(self):
+            run = {"lvcreate": LVM._lvcreate,
+                   "lvchange": LVM._lvchange}
+            if not self._create and ("--permission" in self._options or
+                                     "n" in self._activation):
+                # Kept mounts would make LVM fail with EBUSY
+                release_mounts(self.lv.dev_path)
+            for cmd in self.commands():
+                log.debug("Committing changes of %s: %s" % (self.lv, cmd))
+                run[cmd[0]](cmd[1:])
+            self.clear()
+
 # vim: sw=4 et sts=4
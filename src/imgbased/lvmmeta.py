@@ -0,0 +1,494 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+"""Read the LVM2 metadata directly from the PVs
+
+This is a read-only way to learn about VGs and LVs, it neither forks
+LVM nor takes any LVM lock. The on-disk layout is:
+
+- A label in one of the first four sectors of a PV, pointing to
+- the PV header, which lists the data and metadata areas, where
+- each metadata area starts with a header, pointing to
+- the current metadata text in a circular buffer.
+
+The text is parsed into the rows known from LVM.Inventory.
+"""
+
+import re
+import glob
+import zlib
+import struct
+import logging
+
+from .utils import File
+
+
+log = logging.getLogger(__package__)
+
+
+SECTOR_SIZE = 512
+LABEL_SCAN_SECTORS = 4
+LABEL_ID = b"LABELONE"
+LABEL_TYPE = b"LVM2 001"
+MDA_HEADER_SIZE = 512
+MDA_MAGIC = b" LVM2 x[5A%r0N*>"
+RAW_LOCN_IGNORED = 0x1
+INITIAL_CRC = 0xf597a6cf
+
+
+def calc_crc(data, initial=INITIAL_CRC):
+    """The checksum LVM uses for labels, headers and metadata
+
+    It is CRC32, just without the inversions.
+
+    >>> hex(calc_crc(b""))
+    '0xf597a6cf'
+    >>> calc_crc(b"imgbased") == calc_crc(b"based", calc_crc(b"img"))
+    True
+    """
+    return zlib.crc32(data, initial ^ 0xffffffff) ^ 0xffffffff
+
+
+def _locations(data, offset, fmt):
+    """Read a list of zero terminated structs
+    """
+    size = struct.calcsize(fmt)
+    locations = []
+    while offset + size <= len(data):
+        locn = struct.unpack_from(fmt, data, offset)
+        offset += size
+        if not any(locn):
+            break
+        locations.append(locn)
+    return locations, offset
+
+
+class PhysicalVolume(object):
+    """The label and metadata areas of a PV
+
+    A PV can be any block device or a plain file (e.g. a loop image).
+    """
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return "<PV '%s' />" % self.path
+
+    def _read(self, offset, size):
+        with open(self.path, "rb") as src:
+            src.seek(offset)
+            return src.read(size)
+
+    def label(self):
+        """Return (pv_uuid, data areas, metadata areas) or None
+        """
+        data = self._read(0, SECTOR_SIZE * LABEL_SCAN_SECTORS)
+        for sector in range(LABEL_SCAN_SECTORS):
+            buf = data[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+            if len(buf) < SECTOR_SIZE or not buf.startswith(LABEL_ID):
+                continue
+            _, _, crc, offset, typ = struct.unpack_from("<8sQII8s", buf)
+            if typ != LABEL_TYPE:
+                continue
+            if crc != calc_crc(buf[20:]):
+                log.debug("Bad label checksum on %s" % self.path)
+                continue
+            pv_uuid = buf[offset:offset + 32].decode("ascii")
+            das, pos = _locations(buf, offset + 40, "<QQ")
+            mdas, _ = _locations(buf, pos, "<QQ")
+            return (pv_uuid, das, mdas)
+        return None
+
+    def metadata_texts(self):
+        """Yield the current metadata text of each metadata area
+        """
+        label = self.label()
+        if label is None:
+            return
+        for mda_offset, mda_size in label[2]:
+            text = self._metadata_text(mda_offset, mda_size)
+            if text is not None:
+                yield text
+
+    def _metadata_text(self, mda_offset, mda_size):
+        header = self._read(mda_offset, MDA_HEADER_SIZE)
+        if len(header) < MDA_HEADER_SIZE:
+            return None
+        crc, magic, _, start, size = struct.unpack_from("<I16sIQQ", header)
+        if magic != MDA_MAGIC:
+            log.debug("No metadata area on %s at %d" %
+                      (self.path, mda_offset))
+            return None
+        if crc != calc_crc(header[4:]):
+            raise RuntimeError("Bad metadata area header checksum on %s" %
+                               self.path)
+        rlocns, _ = _locations(header, 40, "<QQII")
+        if not rlocns:
+            return None
+        offset, length, text_crc, flags = rlocns[0]
+        if flags & RAW_LOCN_IGNORED:
+            return None
+        # The text is in a circular buffer after the header
+        first = min(length, size - offset)
+        text = self._read(start + offset, first)
+        if first < length:
+            text += self._read(start + MDA_HEADER_SIZE, length - first)
+        if text_crc != calc_crc(text):
+            raise RuntimeError("Bad metadata checksum on %s" % self.path)
+        return text.rstrip(b"\0").decode("utf-8")
+
+
+_token = re.compile(r"""
+    \s*(?:
+      \#[^\n]*                  # A comment
+     |("(?:[^"\\]|\\.)*")       # A string
+     |([\[\]{}=,])              # Punctuation
+     |([^\s\[\]{}=,"\#]+)       # A word or a number
+    )""", re.VERBOSE)
+
+
+def _tokens(text):
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _token.match(text, pos)
+        if not match or match.end() == pos:
+            raise RuntimeError("Invalid LVM metadata at: %r" %
+                               text[pos:pos + 20])
+        pos = match.end()
+        string, punct, word = match.groups()
+        if string is not None:
+            yield ("value", re.sub(r"\\(.)", r"\1", string[1:-1]))
+        elif punct is not None:
+            yield (punct, punct)
+        elif word is not None:
+            yield ("word", word)
+
+
+def _number(word):
+    try:
+        return int(word)
+    except ValueError:
+        return float(word)
+
+
+def parse_metadata(text):
+    """Parse LVM2 text metadata into nested dicts
+
+    >>> md = parse_metadata('''
+    ... vg0 {  # A comment
+    ... seqno = 3
+    ... tags = ["a", "b\\\\"c"]
+    ... logical_volumes {
+    ... lv0 {
+    ... status = ["READ",
+    ...   "VISIBLE"]
+    ... }
+    ... }
+    ... }
+    ... contents = "Text Format Volume Group"
+    ... ''')
+    >>> md["vg0"]["seqno"]
+    3
+    >>> md["vg0"]["tags"]
+    ['a', 'b"c']
+    >>> md["vg0"]["logical_volumes"]["lv0"]["status"]
+    ['READ', 'VISIBLE']
+    >>> md["contents"]
+    'Text Format Volume Group'
+    """
+    tokens = list(_tokens(text))
+    root = {}
+    stack = [root]
+    pos = 0
+
+    def value(kind, tok):
+        if kind == "value":
+            return tok
+        if kind == "word":
+            return _number(tok)
+        raise RuntimeError("Unexpected token in LVM metadata: %s" % tok)
+
+    while pos < len(tokens):
+        kind, tok = tokens[pos]
+        if kind == "}":
+            stack.pop()
+            if not stack:
+                raise RuntimeError("Unbalanced braces in LVM metadata")
+            pos += 1
+        elif kind == "word" and tokens[pos + 1][0] == "{":
+            stack[-1][tok] = section = {}
+            stack.append(section)
+            pos += 2
+        elif kind == "word" and tokens[pos + 1][0] == "=":
+            pos += 2
+            if tokens[pos][0] == "[":
+                items = []
+                pos += 1
+                while tokens[pos][0] != "]":
+                    if tokens[pos][0] != ",":
+                        items.append(value(*tokens[pos]))
+                    pos += 1
+                stack[-1][tok] = items
+            else:
+                stack[-1][tok] = value(*tokens[pos])
+            pos += 1
+        else:
+            raise RuntimeError("Unexpected token in LVM metadata: %s" % tok)
+    return root
+
+
+def _dm_name(*names):
+    return "-".join(n.replace("-", "--") for n in names)
+
+
+def inventory_rows(metadata):
+    """Turn parsed metadata into the lv and vg rows of LVM.Inventory
+
+    Hidden LVs (like the thin pool data and metadata) are left out,
+    like lvs does it.
+
+    >>> md = parse_metadata(_testdata)
+    >>> lvs, vgs = inventory_rows(md)
+    >>> vgs
+    [{'vg_name': 'HostVG', 'vg_tags': 'imgbased:vg'}]
+    >>> [lv["lv_name"] for lv in lvs]
+    ['Image-0.0', 'Image-0.1', 'pool']
+    >>> lv = lvs[1]
+    >>> lv["lv_dm_path"], lv["origin"], lv["pool_lv"], lv["lv_tags"]
+    ('/dev/mapper/HostVG-Image--0.1', 'Image-0.0', 'pool', 'imgbased:layer')
+    >>> lvs[0]["lv_skip_activation"], lvs[0]["lv_permissions"]
+    ('1', 'read-only')
+    """
+    lv_rows = []
+    vg_rows = []
+    for vg_name, vg in sorted(metadata.items()):
+        if not isinstance(vg, dict) or "logical_volumes" not in vg:
+            continue
+        vg_rows.append({"vg_name": vg_name,
+                        "vg_tags": ",".join(vg.get("tags", []))})
+        for lv_name, lv in sorted(vg["logical_volumes"].items()):
+            status = lv.get("status", [])
+            flags = status + lv.get("flags", [])
+            if "VISIBLE" not in status:
+                continue
+            segment = lv.get("segment1", {})
+            lv_rows.append({
+                "vg_name": vg_name,
+                "lv_name": lv_name,
+                "lv_path": "/dev/%s/%s" % (vg_name, lv_name),
+                "lv_dm_path": "/dev/mapper/%s" % _dm_name(vg_name, lv_name),
+                "lv_tags": ",".join(lv.get("tags", [])),
+                "origin": segment.get("origin", ""),
+                "pool_lv": segment.get("thin_pool", ""),
+                "lv_skip_activation": "1" if "ACTIVATION_SKIP" in flags
+                                      else "0",
+                "lv_permissions": "writeable" if "WRITE" in status
+                                  else "read-only"})
+    return lv_rows, vg_rows
+
+
+def devices():
+    """All block devices which could be PVs
+
+    LVs themselves are skipped.
+    """
+    paths = []
+    for line in File("/proc/partitions").read().splitlines()[2:]:
+        name = line.split()[-1]
+        uuid = "/sys/class/block/%s/dm/uuid" % name
+        if glob.glob(uuid) and File(uuid).read().startswith("LVM-"):
+            continue
+        paths.append("/dev/%s" % name)
+    return paths
+
+
+def scan(paths=None, retries=3):
+    """Read the metadata from all PVs, return the inventory rows
+
+    A VG can span several PVs, then the metadata with the highest
+    seqno wins. As no lock is taken, a checksum mismatch can be the
+    result of a concurrent update, in this case the PV is reread.
+    """
+    log.debug("Reading LVM metadata from the PVs")
+    vgs = {}
+    for path in paths or devices():
+        pv = PhysicalVolume(path)
+        for attempt in range(retries):
+            try:
+                texts = list(pv.metadata_texts())
+                break
+            except (IOError, OSError):
+                log.debug("Can not read %s" % path, exc_info=True)
+                texts = []
+                break
+            except RuntimeError:
+                if attempt == retries - 1:
+                    raise
+                log.debug("Rereading %s" % path, exc_info=True)
+        for text in texts:
+            for name, vg in parse_metadata(text).items():
+                if not isinstance(vg, dict) or "seqno" not in vg:
+                    continue
+                known = vgs.get(vg.get("id", name))
+                if known is None or known[1]["seqno"] < vg["seqno"]:
+                    vgs[vg.get("id", name)] = (name, vg)
+    return inventory_rows(dict(vgs.values()))
+
+
+def _write_pv(path, text, mda_size=4096, text_offset=MDA_HEADER_SIZE):
+    """Write a minimal PV image with text as metadata, for testing
+
+    The metadata area starts at 4096, the text is placed at text_offset
+    in its circular buffer.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as tmp:
+    ...     _write_pv(tmp.name, _testdata, mda_size=2048, text_offset=1536)
+    ...     lvs, vgs = scan([tmp.name])
+    >>> [lv["lv_name"] for lv in lvs]
+    ['Image-0.0', 'Image-0.1', 'pool']
+    >>> with tempfile.NamedTemporaryFile() as tmp:
+    ...     scan([tmp.name])
+    ([], [])
+    """
+    mda_start = 4096
+    data = text.encode("utf-8") + b"\0"
+    assert len(data) < mda_size - MDA_HEADER_SIZE
+    buf = bytearray(mda_start + mda_size)
+
+    pv = struct.pack("<32sQ", b"x" * 32, len(buf))
+    pv += struct.pack("<QQQQ", len(buf), 0, 0, 0)
+    pv += struct.pack("<QQQQ", mda_start, mda_size, 0, 0)
+    label = struct.pack("<8sQII8s", LABEL_ID, 1, 0, 32, LABEL_TYPE) + pv
+    label += b"\0" * (SECTOR_SIZE - len(label))
+    crc = struct.pack("<I", calc_crc(label[20:]))
+    buf[SECTOR_SIZE:2 * SECTOR_SIZE] = label[:16] + crc + label[20:]
+
+    # Wrap around the end of the area, like LVM does
+    for idx, byte in enumerate(bytearray(data)):
+        pos = text_offset + idx
+        if pos >= mda_size:
+            pos -= mda_size - MDA_HEADER_SIZE
+        buf[mda_start + pos] = byte
+    header = struct.pack("<16sIQQ", MDA_MAGIC, 1, mda_start, mda_size)
+    header += struct.pack("<QQII", text_offset, len(data), calc_crc(data), 0)
+    header += b"\0" * (MDA_HEADER_SIZE - 4 - len(header))
+    buf[mda_start:mda_start + MDA_HEADER_SIZE] = \
+        struct.pack("<I", calc_crc(header)) + header
+
+    with open(path, "wb") as dst:
+        dst.write(bytes(buf))
+
+
+_testdata = """
+HostVG {
+id = "mIFc3O-gcyE-MmEm-B8T2-8SFy-VAK0-13C7tN"
+seqno = 12
+format = "lvm2"
+status = ["RESIZEABLE", "READ", "WRITE"]
+flags = []
+tags = ["imgbased:vg"]
+extent_size = 8192
+
+physical_volumes {
+pv0 {
+id = "jPTQOH-b7ZB-uk8g-6lWv-jOvw-sXz4-lQ3ZGM"
+device = "/dev/vda2"
+status = ["ALLOCATABLE"]
+pe_start = 2048
+pe_count = 2559
+}
+}
+
+logical_volumes {
+
+pool {
+id = "f0SCSc-hMUh-IsHh-1T7I-6yG3-1XZB-A1c0UN"
+status = ["READ", "WRITE", "VISIBLE"]
+flags = []
+tags = ["imgbased:pool"]
+segment_count = 1
+
+segment1 {
+start_extent = 0
+extent_count = 2000
+type = "thin-pool"
+metadata = "pool_tmeta"
+pool = "pool_tdata"
+transaction_id = 4
+chunk_size = 128
+}
+}
+
+Image-0.0 {
+id = "4TA3K2-OJ2B-0c02-Zm9q-1m2V-j2d2-fzPKhh"
+status = ["READ", "VISIBLE"]
+flags = ["ACTIVATION_SKIP"]
+tags = ["imgbased:base"]
+segment_count = 1
+
+segment1 {
+start_extent = 0
+extent_count = 1000
+type = "thin"
+thin_pool = "pool"
+transaction_id = 1
+device_id = 1
+}
+}
+
+Image-0.1 {
+id = "Q2m4Cr-s5ek-3SoM-p8Yj-4B5U-6V1d-0UjvYh"
+status = ["READ", "WRITE", "VISIBLE"]
+flags = []
+tags = ["imgbased:layer"]
+segment_count = 1
+
+segment1 {
+start_extent = 0
+extent_count = 1000
+type = "thin"
+thin_pool = "pool"
+transaction_id = 2
+device_id = 2
+origin = "Image-0.0"
+}
+}
+
+pool_tmeta {
+id = "b2cEvl-3dP1-bIvG-1Ayv-3nVn-1hcn-Bd1Vth"
+status = ["READ", "WRITE"]
+flags = []
+segment_count = 1
+}
+}
+}
+# Generated by LVM2
+contents = "Text Format Volume Group"
+version = 1
+"""
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,488 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+import json
+import time
+import logging
+import subprocess
+
+
+log = logging.getLogger(__package__)
+
+
+class LvmSimulator(object):
+    """An in-process stand-in for the LVM commands imgbased uses
+
+    It keeps VGs, thin pools, thin LVs and snapshots with their tags,
+    activation and permissions in memory. It is an LVM executor like
+    LvmShell (see ExternalBinary.lvm), and every command is recorded,
+    so benchmarks and tests can count LVM round trips.
+
+    Each command sleeps as long as it roughly takes on a real host,
+    scaled by latency_scale (0 to not sleep at all).
+
+    >>> sim = LvmSimulator(latency_scale=0)
+    >>> sim.call(["vgcreate", "HostVG", "/dev/sim0"])
+    ''
+    >>> sim.call(["vgchange", "--addtag", "imgbased:vg", "HostVG"])
+    ''
+    >>> sim.call(["lvcreate", "--thin", "--size", "10G", "HostVG/pool"])
+    ''
+    >>> sim.call(["lvcreate", "--thin", "--virtualsize", "5G",
+    ...           "--name", "Image-0.0", "--addtag", "imgbased:base",
+    ...           "HostVG/pool"])
+    ''
+    >>> sim.call(["lvcreate", "--snapshot", "--name", "Image-0.1",
+    ...           "HostVG/Image-0.0"])
+    ''
+    >>> report = sim.call(["lvs", "--noheadings", "-o",
+    ...                    "lv_name,origin,pool_lv,lv_skip_activation",
+    ...                    "--binary", "HostVG"])
+    >>> for line in report.splitlines():
+    ...     print(line.strip())
+    Image-0.0           pool 0
+    Image-0.1 Image-0.0 pool 1
+    pool                     0
+
+    >>> sim.call(["lvchange", "--permission", "r", "--activate", "n",
+    ...           "@imgbased:base"])
+    ''
+    >>> sim.call(["lvs", "-o", "lv_name,lv_permissions,lv_active",
+    ...           "--noheadings", "--separator", ",", "HostVG/Image-0.0"])
+    'Image-0.0,read-only,'
+
+    >>> sim.call(["lvs", "--noheadings", "-o", "lv_name", "-S",
+    ...           "lv_skip_activation=1 || lv_active_locally=0"])
+    'Image-0.0\\n  Image-0.1'
+
+    >>> json.loads(sim.call(["vgs", "--reportformat", "json", "-o",
+    ...                      "vg_name,vg_tags"]))["report"][0]["vg"]
+    [{'vg_name': 'HostVG', 'vg_tags': 'imgbased:vg'}]
+
+    >>> sim.call(["lvchange", "-ay", "-K", "HostVG/Image-0.1"])
+    ''
+    >>> sim.call(["lvremove", "HostVG/Image-0.1"])
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Logical volume Image-0.1 is active
+    >>> sim.call(["lvremove", "-f", "HostVG/Image-0.1"])
+    ''
+    >>> sim.counts()["lvcreate"], len(sim.calls)
+    (3, 13)
+    """
+    # Roughly what the commands take on a host with a handful of PVs,
+    # metadata updates include the commit and waiting for udev
+    latencies = {"lvs": 0.03,
+                 "vgs": 0.03,
+                 "lvcreate": 0.3,
+                 "lvchange": 0.15,
+                 "lvremove": 0.2,
+                 "vgcreate": 0.3,
+                 "vgchange": 0.1}
+    latency_scale = 1.0
+
+    # Commands are executed even in dry mode, nothing real is touched
+    in_process = True
+
+    vgs = None
+    calls = None
+
+    lv_fields = ["vg_name", "lv_name", "lv_path", "lv_dm_path", "lv_tags",
+                 "origin", "pool_lv", "lv_skip_activation",
+                 "lv_permissions", "lv_active", "lv_active_locally",
+                 "lv_attr", "lv_size", "data_percent", "metadata_percent"]
+    vg_fields = ["vg_name", "vg_tags", "vg_size", "lv_count"]
+
+    lvs_default = ["lv_name", "vg_name", "lv_attr", "lv_size", "pool_lv",
+                   "origin", "data_percent"]
+    vgs_default = ["vg_name", "lv_count", "vg_size"]
+
+    _units = {"b": 1, "s": 512, "k": 1024, "m": 1024 ** 2,
+              "g": 1024 ** 3, "t": 1024 ** 4}
+
+    def __init__(self, latency_scale=None):
+        if latency_scale is not None:
+            self.latency_scale = latency_scale
+        self.vgs = {}
+        self.calls = []
+
+    def __repr__(self):
+        return "<LvmSimulator %s />" % sorted(self.vgs)
+
+    def counts(self):
+        """The number of calls per LVM command
+        """
+        counts = {}
+        for args in self.calls:
+            counts[args[0]] = counts.get(args[0], 0) + 1
+        return counts
+
+    def reset(self):
+        """Forget about the recorded calls
+        """
+        self.calls = []
+
+    def call(self, args):
+        log.debug("Simulating: %s" % args)
+        self.calls.append(list(args))
+        time.sleep(self.latencies.get(args[0], 0) * self.latency_scale)
+        func = getattr(self, "_" + args[0], None)
+        if func is None:
+            self._fail(args, "Unknown command")
+        opts, targets = self._parse(args)
+        return func(args, opts, targets)
+
+    def _fail(self, args, msg):
+        log.debug("Simulated failure of %s: %s" % (args, msg))
+        raise subprocess.CalledProcessError(5, ["lvm"] + list(args),
+                                            msg.encode())
+
+    # Options with an argument, short ones are mapped to the long ones
+    _with_arg = {"-o": "--options", "-S": "--select", "-n": "--name",
+                 "-L": "--size", "-V": "--virtualsize",
+                 "-a": "--activate", "-k": "--setactivationskip",
+                 "-p": "--permission", "--options": None, "--select": None,
+                 "--name": None, "--size": None, "--virtualsize": None,
+                 "--activate": None, "--setactivationskip": None,
+                 "--permission": None, "--addtag": None, "--deltag": None,
+                 "--separator": None, "--units": None,
+                 "--reportformat": None, "--config": None}
+    _flags = {"-s": "--snapshot", "-T": "--thin", "-K":
+              "--ignoreactivationskip", "-f": "--force", "-y": "--yes"}
+
+    def _parse(self, args):
+        opts = {}
+        targets = []
+        args = list(args[1:])
+        while args:
+            arg = args.pop(0)
+            if arg[:2] in self._with_arg and len(arg) > 2 \
+                    and not arg.startswith("--"):
+                # Like -ay or -olv_name
+                arg, value = arg[:2], arg[2:]
+                args.insert(0, value)
+            if arg in self._with_arg:
+                name = self._with_arg[arg] or arg
+                if not args:
+                    self._fail([arg], "Option needs an argument")
+                opts.setdefault(name, []).append(args.pop(0))
+            elif arg.startswith("-"):
+                opts[self._flags.get(arg, arg)] = True
+            else:
+                targets.append(arg)
+        return opts, targets
+
+    def _size(self, value, default="m"):
+        """Size in bytes
+
+        >>> LvmSimulator()._size("10G"), LvmSimulator()._size("2")
+        (10737418240, 2097152)
+        """
+        value = str(value).lower()
+        unit = default
+        if value[-1] in self._units:
+            value, unit = value[:-1], value[-1]
+        return int(float(value) * self._units[unit])
+
+    @staticmethod
+    def _yes(value):
+        return value.lower() in ("y", "yes", "1")
+
+    def _vg(self, args, name):
+        if name not in self.vgs:
+            self._fail(args, "Volume group \"%s\" not found" % name)
+        return self.vgs[name]
+
+    def _lv(self, args, lvm_name):
+        vg_name, _, lv_name = lvm_name.partition("/")
+        lvs = self._vg(args, vg_name)["lvs"]
+        if lv_name not in lvs:
+            self._fail(args, "Failed to find logical volume \"%s\"" %
+                       lvm_name)
+        return lvs[lv_name]
+
+    def _select_lvs(self, args, targets):
+        """All LVs matching the targets: VG, VG/LV, path or @tag
+        """
+        everything = [lv for vg in sorted(self.vgs)
+                      for _, lv in sorted(self.vgs[vg]["lvs"].items())]
+        if not targets:
+            return everything
+        found = []
+        for target in targets:
+            if target.startswith("@"):
+                found += [lv for lv in everything
+                          if target[1:] in lv["tags"]]
+            elif target.startswith("/dev/"):
+                matches = [lv for lv in everything
+                           if target in (self._path(lv),
+                                         self._dm_path(lv))]
+                if not matches:
+                    self._fail(args, "Failed to find device \"%s\"" %
+                               target)
+                found += matches
+            elif "/" in target:
+                found.append(self._lv(args, target))
+            else:
+                vg = self._vg(args, target)
+                found += [lv for _, lv in sorted(vg["lvs"].items())]
+        return found
+
+    @staticmethod
+    def _path(lv):
+        return "/dev/%s/%s" % (lv["vg_name"], lv["lv_name"])
+
+    @staticmethod
+    def _dm_path(lv):
+        names = (lv["vg_name"], lv["lv_name"])
+        return "/dev/mapper/%s" % "-".join(n.replace("-", "--")
+                                           for n in names)
+
+    def _lv_field(self, lv, field, opts):
+        binary = "--binary" in opts
+        if field in ("vg_name", "lv_name", "origin", "pool_lv"):
+            return lv[field] or ""
+        if field == "lv_path":
+            return self._path(lv)
+        if field == "lv_dm_path":
+            return self._dm_path(lv)
+        if field == "lv_tags":
+            return ",".join(sorted(lv["tags"]))
+        if field == "lv_skip_activation":
+            if binary:
+                return "1" if lv["skip"] else "0"
+            return "skip activation" if lv["skip"] else ""
+        if field == "lv_permissions":
+            return "writeable" if lv["writeable"] else "read-only"
+        if field in ("lv_active", "lv_active_locally"):
+            if binary:
+                return "1" if lv["active"] else "0"
+            return ("active" if field == "lv_active" else
+                    "active locally") if lv["active"] else ""
+        if field == "lv_attr":
+            return "%s%si-%s-tz-%s" % ("t" if lv["thin_pool"] else "V",
+                                       "w" if lv["writeable"] else "r",
+                                       "a" if lv["active"] else "-",
+                                       "k" if lv["skip"] else "-")
+        if field == "lv_size":
+            return self._format_size(lv["size"], opts)
+        if field in ("data_percent", "metadata_percent"):
+            return "0.00"
+        self._fail([field], "Unrecognised field: %s" % field)
+
+    def _vg_field(self, vg, field, opts):
+        if field == "vg_name":
+            return vg["vg_name"]
+        if field == "vg_tags":
+            return ",".join(sorted(vg["tags"]))
+        if field == "vg_size":
+            return self._format_size(vg["size"], opts)
+        if field == "lv_count":
+            return str(len(vg["lvs"]))
+        self._fail([field], "Unrecognised field: %s" % field)
+
+    def _format_size(self, size, opts):
+        unit = opts.get("--units", ["g"])[-1]
+        value = "%.2f" % (float(size) / self._units[unit.lower()])
+        if "--nosuffix" in opts:
+            return value
+        return value + unit
+
+    def _matches(self, lv, selection, opts):
+        """Only or-ed field comparisons, like a=1 || b!=2, are known
+        """
+        for term in selection.split("||"):
+            field, op, value = term.partition("!=")
+            if not op:
+                field, op, value = term.partition("=")
+            have = self._lv_field(lv, field.strip(), {"--binary": True})
+            if (have == value.strip()) == (op == "="):
+                return True
+        return False
+
+    def _report(self, kind, rows, fields, opts, func):
+        if opts.get("--reportformat", [""])[-1] == "json":
+            report = [dict((f, func(row, f, opts)) for f in fields)
+                      for row in rows]
+            return json.dumps({"report": [{kind: report}]}, indent=2)
+        sep = opts.get("--separator", [None])[-1]
+        lines = [[func(row, f, opts) for f in fields] for row in rows]
+        if "--noheadings" not in opts:
+            lines.insert(0, [f.upper() for f in fields])
+        if sep is not None:
+            text = [sep.join(line) for line in lines]
+        else:
+            widths = [max(len(line[idx]) for line in lines)
+                      for idx in range(len(fields))]
+            text = [" ".join(v.ljust(w) for v, w in zip(line, widths))
+                    for line in lines]
+        return "\n".join("  " + line.rstrip() for line in text).strip()
+
+    def _fields(self, opts, default):
+        fields = []
+        for value in opts.get("--options", [",".join(default)]):
+            fields += [f.strip() for f in value.split(",") if f.strip()]
+        return fields
+
+    def _lvs(self, args, opts, targets):
+        rows = self._select_lvs(args, targets)
+        for selection in opts.get("--select", []):
+            rows = [lv for lv in rows if self._matches(lv, selection, opts)]
+        fields = self._fields(opts, self.lvs_default)
+        return self._report("lv", rows, fields, opts, self._lv_field)
+
+    def _vgs(self, args, opts, targets):
+        rows = []
+        for target in targets or sorted(self.vgs):
+            if target.startswith("@"):
+                rows += [self.vgs[n] for n in sorted(self.vgs)
+                         if target[1:] in self.vgs[n]["tags"]]
+            else:
+                rows.append(self._vg(args, target))
+        fields = self._fields(opts, self.vgs_default)
+        return self._report("vg", rows, fields, opts, self._vg_field)
+
+    def _vgcreate(self, args, opts, targets):
+        if len(targets) < 2:
+            self._fail(args, "Please enter a volume group name and PVs")
+        name = targets[0]
+        if name in self.vgs:
+            self._fail(args, "A volume group called %s already exists" %
+                       name)
+        self.vgs[name] = {"vg_name": name, "tags": set(), "lvs": {},
+                          "pvs": targets[1:], "size": 0}
+        self._change_tags(self.vgs[name], opts)
+        return ""
+
+    def _vgchange(self, args, opts, targets):
+        for target in targets:
+            vg = self._vg(args, target)
+            self._change_tags(vg, opts)
+            if "--activate" in opts:
+                for lv in vg["lvs"].values():
+                    self._activate(lv, opts)
+        return ""
+
+    def _change_tags(self, obj, opts):
+        obj["tags"].update(opts.get("--addtag", []))
+        obj["tags"].difference_update(opts.get("--deltag", []))
+
+    def _activate(self, lv, opts):
+        value = opts["--activate"][-1]
+        if not self._yes(value[-1]):
+            lv["active"] = False
+        elif not lv["skip"] or "--ignoreactivationskip" in opts:
+            lv["active"] = True
+
+    def _change(self, lv, opts):
+        self._change_tags(lv, opts)
+        if "--setactivationskip" in opts:
+            lv["skip"] = self._yes(opts["--setactivationskip"][-1])
+        if "--permission" in opts:
+            lv["writeable"] = opts["--permission"][-1] == "rw"
+        if "--activate" in opts:
+            self._activate(lv, opts)
+
+    def _lvcreate(self, args, opts, targets):
+        if len(targets) != 1:
+            self._fail(args, "Please specify a single origin or pool")
+        target = targets[0]
+        name = opts.get("--name", [None])[-1]
+        if "--snapshot" in opts:
+            origin = self._lv(args, target)
+            if not origin["pool_lv"]:
+                self._fail(args, "Only thin snapshots are simulated")
+            lv = self._new_lv(args, origin["vg_name"], name,
+                              size=origin["size"], pool_lv=origin["pool_lv"],
+                              origin=origin["lv_name"],
+                              writeable=origin["writeable"])
+            # Thin snapshots skip activation by default
+            lv["skip"] = True
+        elif "--thin" in opts and "--virtualsize" in opts:
+            pool = self._lv(args, target)
+            if not pool["thin_pool"]:
+                self._fail(args, "%s is not a thin pool" % target)
+            size = self._size(opts["--virtualsize"][-1])
+            lv = self._new_lv(args, pool["vg_name"], name, size=size,
+                              pool_lv=pool["lv_name"])
+        elif "--thin" in opts and "--size" in opts:
+            vg_name, _, pool_name = target.partition("/")
+            size = self._size(opts["--size"][-1])
+            lv = self._new_lv(args, vg_name, name or pool_name, size=size,
+                              thin_pool=True)
+        else:
+            self._fail(args, "Only thin pools and volumes are simulated")
+        self._change(lv, dict(opts, **{"--activate": opts.get(
+            "--activate", ["y"])}))
+        return ""
+
+    def _new_lv(self, args, vg_name, lv_name, size, pool_lv="",
+                origin="", thin_pool=False, writeable=True):
+        vg = self._vg(args, vg_name)
+        if not lv_name:
+            lv_name = "lvol%d" % len(vg["lvs"])
+        if lv_name in vg["lvs"]:
+            self._fail(args, "Logical Volume \"%s\" already exists" %
+                       lv_name)
+        vg["lvs"][lv_name] = lv = {
+            "vg_name": vg_name, "lv_name": lv_name, "size": size,
+            "pool_lv": pool_lv, "origin": origin, "thin_pool": thin_pool,
+            "tags": set(), "skip": False, "active": False,
+            "writeable": writeable}
+        return lv
+
+    def _lvchange(self, args, opts, targets):
+        if not targets:
+            self._fail(args, "No logical volume specified")
+        for lv in self._select_lvs(args, targets):
+            self._change(lv, opts)
+        return ""
+
+    def _lvextend(self, args, opts, targets):
+        if len(targets) != 1 or "--size" not in opts:
+            self._fail(args, "Please specify a size and a single LV")
+        lv = self._lv(args, targets[0])
+        size = self._size(opts["--size"][-1])
+        if size <= lv["size"]:
+            self._fail(args, "New size is not larger than the old one")
+        lv["size"] = size
+        return ""
+
+    def _lvremove(self, args, opts, targets):
+        forced = "--force" in opts or "--yes" in opts
+        for lv in self._select_lvs(args, targets):
+            vg = self.vgs[lv["vg_name"]]
+            if lv["active"] and not forced:
+                self._fail(args, "Logical volume %s is active" %
+                           lv["lv_name"])
+            users = [n for n, o in vg["lvs"].items()
+                     if o["pool_lv"] == lv["lv_name"]]
+            if users and not forced:
+                self._fail(args, "Thin pool %s is in use" % lv["lv_name"])
+            for name in users:
+                del vg["lvs"][name]
+            del vg["lvs"][lv["lv_name"]]
+        return ""
+
+# vim: sw=4 et sts=4:
@@ -21,7 +21,9 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 
+import bisect
 import logging
+import operator
 import re
 from .utils import format_to_pattern
 from .layers import Base, Image
@@ -29,61 +31,144 @@ from .layers import Base, Image
 log = logging.getLogger(__package__)
 
 
-class NamingScheme():
+class TreeIndex(object):
+    """Lookup structures for a tree of bases and their layers
+
+    It is built once per tree, so that queries don't need to rebuild
+    and resort the tree.
+
+    >>> b0 = Base(None, "Image", 0, 0)
+    >>> b1 = Base(None, "Image", 1, 0)
+    >>> b1.layers = [Image(None, "Image", 1, 1), Image(None, "Image", 1, 2)]
+    >>> idx = TreeIndex([b0, b1])
+    >>> idx.by_nvr["Image-1.2"]
+    <Image Image-1.2 />
+    >>> idx.layers_by_base["Image-1.0"]
+    [<Image Image-1.1 />, <Image Image-1.2 />]
+    >>> idx.layer_before(Image(None, "Image", 1, 2))
+    <Image Image-1.1 />
+    """
+    tree = None
+    bases = None
+    layers = None
+    by_nvr = None
+    layers_by_base = None
+
+    _layer_keys = None
+
+    def __init__(self, tree):
+        # Sorting by key is the same order as the Image comparison,
+        # but needs far less calls
+        by_vr = operator.attrgetter("version_release")
+        self.tree = tree
+        self.bases = sorted(tree, key=by_vr)
+        self.layers = sorted((layer for base in tree
+                              for layer in base.layers), key=by_vr)
+        self._layer_keys = [layer.version_release for layer in self.layers]
+        self.by_nvr = {}
+        self.layers_by_base = {}
+        for base in tree:
+            self.by_nvr[base.nvr] = base
+            # The layers of a base are already ordered by release
+            self.layers_by_base[base.nvr] = list(base.layers)
+            for layer in base.layers:
+                self.by_nvr[layer.nvr] = layer
+
+    def images(self):
+        return sorted(self.bases + self.layers,
+                      key=operator.attrgetter("version_release"))
+
+    def layer_before(self, other_layer):
+        idx = bisect.bisect_left(self._layer_keys,
+                                 other_layer.version_release)
+        while idx < len(self.layers) and \
+                self.layers[idx] != other_layer and \
+                self._layer_keys[idx] == other_layer.version_release:
+            idx += 1
+        assert idx < len(self.layers) and self.layers[idx] == other_layer
+        return self.layers[idx - 1]
+
+
+class NamingScheme(object):
+    """A naming scheme maps LV names to a tree of bases and layers
+
+    The tree is cached until names is reassigned or invalidate() is
+    called, e.g. when LVs got added or removed.
+    """
     vg = None
-    names = None
+
+    _names = None
+    _index = None
 
     def __init__(self, names=None):
         self.names = names or []
 
+    @property
+    def names(self):
+        return self._names
+
+    @names.setter
+    def names(self, names):
+        self._names = names
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the cached tree, it will be rebuilt on the next query
+        """
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            self._index = TreeIndex(self._build_tree())
+        return self._index
+
     def image_from_name(self, name):
         raise NotImplementedError
 
-    def tree(self):
+    def _build_tree(self, lvs=None):
+        raise NotImplementedError
+
+    def tree(self, lvs=None):
         """Returns an ordered list of bases and children
         """
-        raise NotImplementedError
+        if lvs is not None:
+            return self._build_tree(lvs)
+        return list(self.index().tree)
 
     def images(self):
-        images = []
-        for base in self.bases():
-            images.append(base)
-            images.extend(base.layers)
-        return sorted(images)
+        return self.index().images()
 
     def bases(self):
-        bases = sorted(self.tree())
+        bases = list(self.index().bases)
         assert all(type(b) is Base for b in bases)
         return bases
 
     def layers(self, for_base=None):
-        layers = []
-        for b in self.tree():
-            if for_base is None or (for_base and b == for_base):
-                layers.extend(b.layers)
-        return sorted(layers)
+        index = self.index()
+        if for_base is None:
+            return list(index.layers)
+        if type(for_base) is not Base:
+            return []
+        return list(index.layers_by_base.get(for_base.nvr, []))
 
     def last_base(self):
-        return self.bases().pop()
+        return self.index().bases[-1]
 
     def last_layer(self):
-        return self.layers().pop()
+        return self.index().layers[-1]
 
     def layer_before(self, other_layer):
-        layers = self.layers()
-        assert other_layer in layers
-        oidx = layers.index(other_layer)
-        return layers[oidx-1]
+        return self.index().layer_before(other_layer)
 
     def suggest_next_base(self, name=None, version=None, release=None):
         """Dertermine the name for the next base LV name (based on the scheme)
         """
         log.debug("Finding next base")
         try:
-            base = self.last_base()
-            base.version = version or int(base.version) + 1
-            base.release = release or 0
-            base.layers = []
+            last_base = self.last_base()
+            base = Base(self.vg, last_base.name,
+                        version or int(last_base.version) + 1,
+                        release or 0)
         except RuntimeError:
             log.debug("No previous base found, creating an initial one")
             base = Base(self.vg, name, version or 0, release or 0)
@@ -108,7 +193,7 @@ class NamingScheme():
             # has no layers, only images form tree() have layers.
             if prev.layers:
                 log.debug("... with layers")
-                last_layer = sorted(prev.layers).pop()
+                last_layer = max(prev.layers)
                 suggestion.release = int(last_layer.release) + 1
             else:
                 log.debug("... without layers")
@@ -119,21 +204,37 @@ class NamingScheme():
 
         return suggestion
 
-    def layout(self, lvs=None):
-        """List all bases and layers for humans
+    def layout_lines(self, lvs=None):
+        """Yield the lines of the layout, one by one
+
+        The tree is retrieved right away, so a missing layout is
+        reported on the call, not on the first iteration.
+
+        >>> naming = NvrLikeNaming(["Image-0.0", "Image-0.1"])
+        >>> lines = naming.layout_lines()
+        >>> next(lines)
+        'Image-0.0'
+        >>> list(lines)
+        [' └╼ Image-0.1']
         """
-        idx = []
         try:
             tree = self.tree(lvs)
         except RuntimeError:
             raise RuntimeError("No valid layout found. Initialize if needed.")
 
-        for base in tree:
-            idx.append("%s" % base)
-            for layer in base.layers:
-                c = u"└" if layer is base.layers[-1] else u"├"
-                idx.append(u" %s╼ %s" % (c, layer))
-        return u"\n".join(idx)
+        def lines():
+            for base in tree:
+                yield u"%s" % base
+                last = len(base.layers) - 1
+                for num, layer in enumerate(base.layers):
+                    c = u"└" if num == last else u"├"
+                    yield u" %s╼ %s" % (c, layer)
+        return lines()
+
+    def layout(self, lvs=None):
+        """List all bases and layers for humans
+        """
+        return u"\n".join(self.layout_lines(lvs))
 
 
 class NvrLikeNaming(NamingScheme):
@@ -212,7 +313,15 @@ class NvrLikeNaming(NamingScheme):
 
     nvr_fmt = "%s-%d.%d"
 
-    def tree(self, lvs=None):
+    _nvr_pattern = None
+
+    @property
+    def nvr_pattern(self):
+        if self._nvr_pattern is None:
+            self._nvr_pattern = re.compile(format_to_pattern(self.nvr_fmt))
+        return self._nvr_pattern
+
+    def _build_tree(self, lvs=None):
         """Returns a list of bases and children
         >>> layers = NvrLikeNaming()
         >>> layers.tree()
@@ -230,36 +339,25 @@ class NvrLikeNaming(NamingScheme):
             lvs = self.names()
         else:
             lvs = lvs or self.names
-        laypat = format_to_pattern(self.nvr_fmt)
         sorted_lvs = []
 
-        if lvs is None:
-            lvs = self.lvs()
-
         for lv in lvs:
-            if not re.match(laypat, lv):
+            match = self.nvr_pattern.match(lv)
+            if not match:
                 continue
-            name, version, release = re.search(laypat, lv).groups()
-            baseidx, layidx = map(int, [version, release])
-            sorted_lvs.append((name, baseidx, layidx))
+            name, version, release = match.groups()
+            sorted_lvs.append((name, int(version), int(release)))
 
-        sorted_lvs = sorted(sorted_lvs)
+        sorted_lvs.sort()
 
-        log.debug(str(lvs))
+        log.debug("Building tree from %d LVs" % len(sorted_lvs))
         lst = []
-        imgs = []
         for v in sorted_lvs:
             if v[2] == 0:
-                img = Base(self.vg, *v)
-            else:
-                img = Image(self.vg, *v)
-            imgs.append(img)
-        for img in imgs:
-            if img.release == 0:
-                lst.append(img)
+                lst.append(Base(self.vg, *v))
             else:
                 parent = lst[-1]
-                parent.layers.append(img)
+                parent.layers.append(Image(self.vg, *v))
 
         if len(lst) == 0:
             raise RuntimeError("No bases found: %s" % lvs)
@@ -274,9 +372,8 @@ class NvrLikeNaming(NamingScheme):
         >>> naming.image_from_name("Image-24.0")
         <Base Image-24.0 />
         """
-        laypat = format_to_pattern(self.nvr_fmt)
-        log.debug("Prasing %s from %s" % (laypat, name))
-        match = re.search(laypat, name)
+        log.debug("Prasing %s from %s" % (self.nvr_pattern.pattern, name))
+        match = self.nvr_pattern.search(name)
         if not match:
             raise RuntimeError("Failed to parse image name: %s" % name)
         name, version, release = match.groups()
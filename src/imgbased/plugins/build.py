@@ -1,6 +1,6 @@
 
 import logging
-from ..utils import Rsync
+from ..utils import tree_sync
 
 
 log = logging.getLogger(__package__)
@@ -32,7 +32,7 @@ def postprocess(app):
     log.info("Launching image post-processing")
 
     log.info("Copying /etc to /usr/etc")
-    rsync = Rsync()
+    rsync = tree_sync()
     rsync.sync("/etc", "/usr/etc")
 
 # vim: sw=4 et sts=4
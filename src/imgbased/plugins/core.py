@@ -21,7 +21,6 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 import sys
-import argparse
 import logging
 
 
@@ -48,9 +47,9 @@ def add_argparse(app, parser, subparsers):
                              help="Add a base layer from an fs tree")
     base_parser.add_argument("--add-with-image",
                              metavar="PATH_TO_IMAGE",
-                             help="Add a base layer from an fs image",
-                             nargs="?", type=argparse.FileType('r'),
-                             default=None)
+                             help="Add a base layer from an fs image "
+                             "(read from stdin if no path is given)",
+                             nargs="?", const="-", default=None)
 
     base_parser.add_argument("--remove",
                              metavar="BASE",
@@ -62,6 +61,8 @@ def add_argparse(app, parser, subparsers):
                              help="Get the most recently added base")
     base_parser.add_argument("--of-layer", metavar="LAYER",
                              help="Get the base of layer LAYER")
+    base_parser.add_argument("--descendants-of", metavar="BASE",
+                             help="Get all images derived from BASE")
 
     subparsers.add_parser("check",
                           help="Perform some runtime checks")
@@ -77,7 +78,10 @@ def check_argparse(app, args):
         elif args.add_with_image:
             if not args.size:
                 raise RuntimeError("--size is required")
-            app.imgbase.add_base_from_image(args.add_with_image or sys.stdin)
+            image = args.add_with_image
+            if image == "-":
+                image = getattr(sys.stdin, "buffer", sys.stdin)
+            app.imgbase.add_base_from_image(image, args.size)
         elif args.add_with_tree:
             if not args.size:
                 raise RuntimeError("--size")
@@ -89,6 +93,9 @@ def check_argparse(app, args):
             print(app.imgbase.latest_base())
         elif args.of_layer:
             print(str(app.imgbase.base_of_layer(args.of_layer)))
+        elif args.descendants_of:
+            for image in app.imgbase.descendants_of(args.descendants_of):
+                print(image)
     elif args.command == "check":
         run_check(app)
 
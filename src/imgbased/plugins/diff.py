@@ -1,10 +1,9 @@
 
-import difflib
 import os
 import sys
 import logging
 
-from ..utils import mounted, ExternalBinary
+from ..utils import mounted, StreamingExternalBinary, spawn
 
 
 log = logging.getLogger(__package__)
@@ -64,8 +63,10 @@ def diff(imgbase, left, right, mode="tree"):
     imgl = imgbase.image_from_name(left)
     imgr = imgbase.image_from_name(right)
 
-    with mounted(imgl.path, target="/mnt/%s" % left) as mountl, \
-            mounted(imgr.path, target="/mnt/%s" % right) as mountr:
+    with mounted(imgl.path, target="/mnt/%s" % left,
+                 readonly=True) as mountl, \
+            mounted(imgr.path, target="/mnt/%s" % right,
+                    readonly=True) as mountr:
         return path_diff(mountl.target, mountr.target, mode,
                          left, right)
 
@@ -79,17 +80,77 @@ def path_diff(left, right, mode, left_alias=None, right_alias=None):
             raise RuntimeError("Path does not exist: %r" % p)
 
     if mode == "tree":
-        l = ExternalBinary().find(["-ls"], cwd=left).splitlines(True)
-        r = ExternalBinary().find(["-ls"], cwd=right).splitlines(True)
-        udiff = difflib.unified_diff(r, l, fromfile=left_alias,
-                                     tofile=right_alias, n=0)
-        lines = (l for l in udiff if not l.startswith("@"))
+        lines = listing_diff(_listing(right), _listing(left),
+                             left_alias, right_alias)
         sys.stdout.writelines(lines)
     elif mode == "content":
-        import subprocess
-        subprocess.call(["diff", "-urN",
-                         left, right])
+        spawn(["diff", "-urN", left, right], capture=False, check=False)
     else:
         raise RuntimeError("Unknown diff mode: %s" % mode)
 
+
+def _listing(path):
+    """The lines of a tree, sorted by name
+
+    Each line is the name, a tab and the details find -ls shows. The
+    name comes first, because the position of the name in find -ls
+    depends on the file type (device nodes have a major and minor
+    number instead of a size).
+    The sorting is done by sort, which spills to disk if needed.
+    """
+    env = dict(os.environ, LC_ALL="C")
+    return StreamingExternalBinary().call(
+        ["find", ".", "-printf", "%p\t%i %k %M %n %u %g %s %t %l\n"],
+        ["sort", "-t", "\t", "-k", "1,1"],
+        cwd=path, env=env)
+
+
+def _name(line):
+    """
+    >>> _name("./dev/null\\t12 0 crw-rw-rw- 1 root root 0 Jan 1 ")
+    './dev/null'
+    """
+    return line.split("\t", 1)[0]
+
+
+def listing_diff(old, new, fromfile, tofile):
+    """Compare two listings which are sorted by name, like diff -U0
+
+    Only one line of each listing is kept in memory at a time.
+
+    >>> old = ["./a\\t1", "./b\\t1", "./c\\t1"]
+    >>> new = ["./a\\t1", "./b\\t2", "./d\\t1"]
+    >>> print("".join(listing_diff(old, new, "left", "right")))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    --- left
+    +++ right
+    -./b 1
+    +./b 2
+    -./c 1
+    +./d 1
+    <BLANKLINE>
+    >>> list(listing_diff(old, old, "left", "right"))
+    []
+    """
+    header = ["--- %s\n" % fromfile, "+++ %s\n" % tofile]
+    old, new = iter(old), iter(new)
+    o, n = next(old, None), next(new, None)
+    while o is not None or n is not None:
+        if o is not None and n is not None and _name(o) == _name(n):
+            if o != n:
+                for line in header + ["-%s\n" % o, "+%s\n" % n]:
+                    yield line
+                header = []
+            o, n = next(old, None), next(new, None)
+        elif n is None or (o is not None and _name(o) < _name(n)):
+            for line in header + ["-%s\n" % o]:
+                yield line
+            header = []
+            o = next(old, None)
+        else:
+            for line in header + ["+%s\n" % n]:
+                yield line
+            header = []
+            n = next(new, None)
+
 # vim: sw=4 et sts=4
@@ -40,6 +40,9 @@ def add_argparse(app, parser, subparsers):
                               help="Get the latest layer")
     layer_parser.add_argument("--current", action="store_true",
                               help="Get the current layer used to boot this")
+    layer_parser.add_argument("--ancestry-of", metavar="LAYER",
+                              help="Get all images LAYER was derived from, "
+                              "the closest first")
     layer_parser.add_argument("IMAGE", nargs="?",
                               help="Optional to be used with --add")
 
@@ -64,7 +67,11 @@ def check_argparse(app, args):
                 app.imgbase.add_layer_on_latest()
         elif args.current:
             print(app.imgbase.current_layer())
+        elif args.ancestry_of:
+            for image in app.imgbase.ancestry_of(args.ancestry_of):
+                print(image)
         elif args.latest:
+            app.imgbase.prefer_readonly()
             print(app.imgbase.latest_layer())
 
 # vim: sw=4 et sts=4
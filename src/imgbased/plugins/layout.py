@@ -75,10 +75,14 @@ def check_argparse(app, args):
         elif args.free_space:
             print(app.imgbase.free_space(args.units))
         elif args.bases:
+            app.imgbase.prefer_readonly()
             print("\n".join(str(b) for b in app.imgbase.naming.bases()))
         elif args.layers:
+            app.imgbase.prefer_readonly()
             print("\n".join(str(l) for l in app.imgbase.naming.layers()))
         else:
-            print(app.imgbase.layout())
+            app.imgbase.prefer_readonly()
+            for line in app.imgbase.layout_lines():
+                print(line)
 
 # vim: sw=4 et sts=4
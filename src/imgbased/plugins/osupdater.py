@@ -26,9 +26,10 @@ import glob
 import os
 import shutil
 from .. import bootloader
+from .. import tracing
 from ..lvm import LVM
 from ..utils import mounted, ShellVarFile, RpmPackageDb, copy_files, Fstab,\
-    File, SystemRelease, Rsync, kernel_versions_in_path, findmnt, \
+    File, SystemRelease, tree_sync, kernel_versions_in_path, findmnt, \
     nspawn, IDMap
 
 
@@ -81,12 +82,14 @@ def on_new_layer(imgbase, previous_lv_lvm_name, new_lv_lvm_name):
     previous_layer = imgbase.naming.layer_before(new_layer)
 
     try:
-        migrate_etc(imgbase, new_layer, previous_layer)
+        with tracing.span("migrate_etc"):
+            migrate_etc(imgbase, new_layer, previous_layer)
     except:
         log.error("Failed to migrate etc", exc_info=True)
 
     try:
-        adjust_mounts_and_boot(imgbase, new_layer, previous_layer)
+        with tracing.span("adjust_mounts_and_boot"):
+            adjust_mounts_and_boot(imgbase, new_layer, previous_layer)
     except:
         # FIXME Handle and rollback
         raise
@@ -94,7 +97,7 @@ def on_new_layer(imgbase, previous_lv_lvm_name, new_lv_lvm_name):
 
 def migrate_etc(imgbase, new_layer, previous_layer):
     with mounted(new_layer.lvm.path) as new_fs,\
-            mounted(previous_layer.lvm.path) as old_fs:
+            mounted(previous_layer.lvm.path, readonly=True) as old_fs:
         old_etc = old_fs.path("/etc")
         new_etc = new_fs.path("/etc")
 
@@ -121,7 +124,8 @@ def migrate_etc(imgbase, new_layer, previous_layer):
                 log.info("UID/GID drift was detected")
                 log.debug("Drifted uids: %s gids: %s" %
                           idmaps.get_drift())
-                changes = idmaps.fix_drift(new_fs)
+                with tracing.span("IDMap.fix_drift"):
+                    changes = idmaps.fix_drift(new_fs)
                 if changes:
                     log.info("UID/GID adjustments were applied")
                     log.debug("Changed files: %s" % list(changes))
@@ -131,10 +135,11 @@ def migrate_etc(imgbase, new_layer, previous_layer):
                 log.debug("No drift detected")
 
             log.info("Migrating /etc")
-            rsync = Rsync()
+            rsync = tree_sync()
             # Don't copy release files to have up to date release infos
             rsync.exclude = ["etc/fedora-release*", "/etc/redhat-release*"]
-            rsync.sync(old_etc + "/", new_etc)
+            with tracing.span("sync /etc"):
+                rsync.sync(old_etc + "/", new_etc)
         else:
             log.info("Just copying important files")
             copy_files(new_etc,
@@ -144,8 +149,9 @@ def migrate_etc(imgbase, new_layer, previous_layer):
                         old_etc + "/group"])
 
         log.info("Migrating /root")
-        rsync = Rsync()
-        rsync.sync(old_fs.path("/root/"), new_fs.path("/root"))
+        rsync = tree_sync()
+        with tracing.span("sync /root"):
+            rsync.sync(old_fs.path("/root/"), new_fs.path("/root"))
 
 
 def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
@@ -161,7 +167,7 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
     new_lvm_name = new_lv.lvm_name
 
     oldrootsource = None
-    with mounted(previous_layer.lvm.path) as oldrootmnt:
+    with mounted(previous_layer.lvm.path, readonly=True) as oldrootmnt:
         oldfstab = Fstab("%s/etc/fstab" % oldrootmnt.target)
         if not oldfstab.exists():
             log.warn("No old fstab found, skipping os-upgrade")
@@ -180,6 +186,7 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
                 old_grub.get("GRUB_CMDLINE_LINUX", "")
             log.debug("Old def grub: %s" % old_grub_append)
 
+    @tracing.traced()
     def update_fstab(newroot):
         newfstab = Fstab("%s/etc/fstab" % newroot)
 
@@ -193,6 +200,7 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
         rootentry.source = new_lv.path
         newfstab.update(rootentry)
 
+    @tracing.traced()
     def update_grub_default(newroot):
         defgrub = ShellVarFile("%s/etc/default/grub" % newroot)
 
@@ -217,6 +225,7 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
             defgrub.set("GRUB_CMDLINE_LINUX",
                         oldcmd.replace('"', "") + " rd.lvm.lv=" + new_lvm_name)
 
+    @tracing.traced()
     def copy_kernel(newroot):
         if not File("%s/boot" % newroot).exists():
             log.info("New root does not contain a kernel, skipping.")
@@ -235,14 +244,12 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
             pkgs = RpmPackageDb()
             pkgs.root = newroot
 
-            pkgfiles = pkgs.get_files("kernel")
-            if not pkgfiles:
-                log.info("No kernel found on %s" % new_layer)
-                return
-
             kfiles = ["%s/%s" % (newroot, f)
-                      for f in pkgfiles
+                      for f in pkgs.get_files("kernel")
                       if f.startswith("/boot/")]
+            if not kfiles:
+                log.info("No kernel found on %s" % new_layer)
+                return
             log.debug("Found kernel files: %s" % kfiles)
 
             os.mkdir(bootdir)
@@ -266,8 +273,10 @@ def adjust_mounts_and_boot(imgbase, new_layer, previous_layer):
         log.debug("Found kvers: %s" % kvers)
         log.debug("Using kver: %s" % kver)
         initrd = "/boot/initramfs-%s.img" % kver
-        chroot_b("dracut", "-f", initrd, "--kver", kver)
+        with tracing.span("dracut"):
+            chroot_b("dracut", "-f", initrd, "--kver", kver)
 
+    @tracing.traced()
     def add_bootentry(newroot):
         if not File("%s/boot" % newroot).exists():
             log.info("New root does not contain a /boot, skipping.")
@@ -51,8 +51,8 @@ def diff(imgbase, left, right, mode="default"):
     imgl = imgbase.image_from_name(left)
     imgr = imgbase.image_from_name(right)
 
-    with mounted(imgl.path) as mountl, \
-            mounted(imgr.path) as mountr:
+    with mounted(imgl.path, readonly=True) as mountl, \
+            mounted(imgr.path, readonly=True) as mountr:
         if mode == "default":
             pkgdb = RpmPackageDb()
             pkgdb.root = mountl.target
@@ -1,18 +1,21 @@
 
-from ..utils import sorted_versions, request_url, mounted, \
-    size_of_fstree
+from ..utils import sorted_versions, mounted, \
+    size_of_fstree, ext_fs_usage
 from ..local import Configuration
+from .. import tracing
+from .. import fetch
 from six.moves import configparser
 from io import StringIO
 import argparse
 import sys
 import re
 import os
+import time
 import hashlib
-import tempfile
-import subprocess
+import shutil
 import glob
 import logging
+import contextlib
 try:
     from urllib.request import unquote
 except ImportError:
@@ -39,6 +42,9 @@ def add_argparse(app, parser, subparsers):
     su_add = su.add_parser("add", help="Add a remote")
     su_add.add_argument("NAME", type=str)
     su_add.add_argument("URL", type=str)
+    su_add.add_argument("--segments", type=int,
+                        help="Download images with this many concurrent " +
+                             "connections")
 
     su_remove = su.add_parser("remove", help="Remove a remote")
     su_remove.add_argument("NAME", type=str)
@@ -64,6 +70,15 @@ def add_argparse(app, parser, subparsers):
                                 " the remote image we get.",
                            action="store_true")
 
+    su_cache = su.add_parser("cache", help="Manage the cache of images")
+    su_cache.add_argument("--list", help="List the cached images (default)",
+                          action="store_true")
+    su_cache.add_argument("--prune", help="Remove the least recently " +
+                          "used images, down to the configured size",
+                          action="store_true")
+    su_cache.add_argument("--size", type=int,
+                          help="Prune down to this many MiB instead")
+
     su_images = su.add_parser("versions",
                               help="List availabel versions of a stream")
     su_images.add_argument("NAME", type=str)
@@ -150,7 +165,7 @@ def check_argparse_update(app, args, remotecfg):
 def check_argparse_remote(app, args, remotecfg):
     remotes = remotecfg.remotes()
     if args.subcmd == "add":
-        remotecfg.add(args.NAME, args.URL)
+        remotecfg.add(args.NAME, args.URL, args.segments)
 
     elif args.subcmd == "remove":
         remotecfg.remove(args.NAME)
@@ -190,6 +205,23 @@ def check_argparse_remote(app, args, remotecfg):
         for name, url in sorted(remotes.items()):
             print("%s: %s" % (name, url))
 
+    elif args.subcmd == "cache":
+        cache = fetch.image_cache()
+        if cache is None:
+            raise RuntimeError("The image cache is disabled")
+        if args.prune:
+            maxsize = None if args.size is None else args.size << 20
+            for entry in cache.prune(maxsize):
+                print("Removed %s" % (entry["url"] or entry["key"]))
+        else:
+            for entry in cache.entries():
+                print("%s %8d MiB %s%s" %
+                      (time.strftime("%Y-%m-%d %H:%M",
+                                     time.localtime(entry["last_used"])),
+                       entry["size"] >> 20,
+                       entry["url"] or entry["key"],
+                       "" if entry["complete"] else " (partial)"))
+
 
 class RemotesConfiguration():
     """Datastructure to access localy configured remotes
@@ -210,8 +242,7 @@ class RemotesConfiguration():
     >>> rs.localcfg.cfgstr = example
 
     >>> rs.remotes()
-    {'jenkins': <Remote name=jenkins url=http://jenkins.ovirt.org/ \
-mode=None />}
+    {'jenkins': <Remote name=jenkins url=http://jenkins.ovirt.org/ />}
     """
 
     localcfg = None
@@ -221,6 +252,8 @@ mode=None />}
         _type = "remote"
         name = None
         url = None
+        # Concurrent Range requests to download images with
+        segments = 1
 
     def __init__(self):
         RS = RemotesConfiguration.RemoteSection
@@ -239,8 +272,7 @@ mode=None />}
         >>> rs.localcfg.cfgstr = example
 
         >>> rs.remotes()
-        {'jenkins': <Remote name=jenkins url=http://jenkins.ovirt.org/ \
-mode=None />}
+        {'jenkins': <Remote name=jenkins url=http://jenkins.ovirt.org/ />}
 
         >>> rs = RemotesConfiguration()
         >>> rs.localcfg.cfgstr = u""
@@ -249,14 +281,18 @@ mode=None />}
 
         >>> rs.localcfg.cfgstr = u"[remote thing]\\nurl = bar"
         >>> rs.remotes()
-        {'thing': <Remote name=thing url=bar mode=None />}
+        {'thing': <Remote name=thing url=bar />}
 
         >>> rs.localcfg.cfgstr = u"[remote a thing]\\nurl = bar"
         >>> rs.remotes()
-        {'a thing': <Remote name=a thing url=bar mode=None />}
+        {'a thing': <Remote name=a thing url=bar />}
 
         >>> rs.remote("a thing")
         <RemoteSection (remote) [('name', 'a thing'), ('url', 'bar')] />
+
+        >>> rs.localcfg.cfgstr = u"[remote fast]\\nurl = bar\\nsegments = 4"
+        >>> rs.remotes()["fast"].segments
+        4
         """
         RS = RemotesConfiguration.RemoteSection
         remotes = {}
@@ -264,6 +300,7 @@ mode=None />}
             r = Remote()
             r.name = section.name
             r.url = section.url
+            r.segments = int(section.segments)
             remotes[r.name] = r
         return remotes
 
@@ -282,10 +319,12 @@ mode=None />}
             self.localcfg.save(s)
         return s.pull.split(":", 1)
 
-    def add(self, name, url):
+    def add(self, name, url, segments=None):
         s = self.RemoteSection()
         s.name = name
         s.url = url
+        if segments:
+            s.segments = segments
         self.localcfg.save(s)
 
     def remove(self, name):
@@ -300,6 +339,7 @@ class Remote(object):
     """
     name = None
     url = None
+    segments = 1
 
     _discoverer = None
 
@@ -309,7 +349,7 @@ class Remote(object):
 
     @property
     def config(self):
-        cfg = request_url(self._remote_configfile)
+        cfg = fetch.get(self._remote_configfile)
         log.debug("Got remote config: %s", cfg)
         p = configparser.ConfigParser()
         p.readfp(StringIO(cfg))
@@ -327,14 +367,17 @@ class Remote(object):
         self.name = name
         self.url = url
 
+    def catalog(self):
+        return self._discoverer.catalog()
+
     def list_images(self):
-        return self._discoverer.list_images()
+        return self.catalog().images
 
     def list_streams(self):
         """List all streams in this remote
 
-        >>> def fake_images():
-        ...     images = {}
+        >>> def fake_catalog():
+        ...     images = []
         ...     for t in [("org.example.Client", "1"),
         ...               ("org.example.Client", "2"),
         ...               ("org.example.Server", "1"),
@@ -344,41 +387,42 @@ class Remote(object):
         ...               ("org.example.Server", "2-0")]:
         ...         i = RemoteImage(None)
         ...         i.vendorid, i.version = t
-        ...         images[str(t)] = i
-        ...     return images
+        ...         images.append(i)
+        ...     return ImageCatalog(images)
 
         >>> r = Remote('foo', 'http://www.foo.com')
-        >>> r.list_images = fake_images
+        >>> r.catalog = fake_catalog
 
         >>> r.list_streams()
         ['org.example.Client', 'org.example.Server']
 
         >>> r.list_versions("org.example.Server")
         ['1', '1-1', '1-2', '1-12', '2-0']
+
+        >>> r.latest_version("org.example.Client")
+        '2'
+
+        >>> r.get_image("org.example.Server", "1-2")
+        <Image vendorid=org.example.Server version=1-2 path=None />
         """
-        return sorted(set(i.stream() for i in self.list_images().values()))
+        return self.catalog().streams()
 
     def list_versions(self, stream):
         """Get all versions of a stream in this remote
         """
-        versions = (i.version for i in self.list_images().values()
-                    if i.stream() == stream)
-        return sorted_versions(versions, "-")
+        return list(self.catalog().versions(stream))
 
     def latest_version(self, stream):
-        assert stream in self.list_streams()
-        versions = self.list_versions(stream)
-        log.debug("All versions: %s" % versions)
-        return versions[-1]
+        catalog = self.catalog()
+        assert stream in catalog, "Unknown stream: %s" % stream
+        return catalog.latest(stream)
 
     def get_image(self, stream, version):
-        assert stream in self.list_streams()
-        return [i for i in self.list_images().values()
-                if i.version == version].pop()
+        return self.catalog().get(stream, version)
 
     def __repr__(self):
-        return "<Remote name=%s url=%s mode=%s />" % \
-            (self.name, self.url, self.mode)
+        # Not the mode, it needs to fetch the config
+        return "<Remote name=%s url=%s />" % (self.name, self.url)
 
 
 class RemoteImage():
@@ -393,6 +437,7 @@ class RemoteImage():
     version = None
     path = None
     suffix = None
+    sha256 = None
 
     @property
     def mode(self):
@@ -457,6 +502,11 @@ class RemoteImage():
 
         dstpath: device or filename
 
+        An interrupted download is resumed, and the image is verified
+        if the index has a checksum for it. The segments of the remote
+        are downloaded concurrently. If the image cache is enabled, the
+        image is copied from there.
+
         >>> src = "/tmp/src"
         >>> dst = "/tmp/dst"
 
@@ -473,12 +523,60 @@ class RemoteImage():
         >>> with open(dst) as f:
         ...     f.read()
         'Hey!'
+
+        >>> img.sha256 = hashlib.sha256(b"Ho!").hexdigest()
+        >>> img.download(dst)
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Checksum mismatch for file:///tmp/src: Expected \
+1dc4de34e12a23f288aa8630d90e58bd9608af5f646616b710b19b757ec1d52b, got \
+b57c370a0fcc704562e14bc1765dfc6e573fde46ebfda7c229e9f429b5f5697a
         """
+        cache = self._cache()
+        if cache is None:
+            self._download(dstpath)
+        else:
+            with cache.get(self.url(), self.sha256,
+                           self._segments()) as path:
+                shutil.copyfile(path, dstpath)
+
+    @contextlib.contextmanager
+    def fetched(self):
+        """Yields the path to a local copy of the image
+
+        The image cache is used if it is enabled, otherwise the image
+        is downloaded to fetch.downloaddir (where an interrupted
+        download can be resumed) and removed afterwards.
+        """
+        cache = self._cache()
+        if cache is None:
+            if not os.path.isdir(fetch.downloaddir):
+                os.makedirs(fetch.downloaddir)
+            dst = os.path.join(fetch.downloaddir,
+                               os.path.basename(unquote(self.path)))
+            self._download(dst)
+            try:
+                yield dst
+            finally:
+                os.unlink(dst)
+        else:
+            with cache.get(self.url(), self.sha256,
+                           self._segments()) as path:
+                yield path
+
+    def _cache(self):
+        # Local files are not worth caching
+        if self.url().startswith("file://"):
+            return None
+        return fetch.image_cache()
+
+    def _segments(self):
+        return self.remote.segments if self.remote else 1
+
+    def _download(self, dstpath):
         url = self.url()
         log.info("Fetching image from url '%s'" % url)
-        subprocess.check_call(["curl", "--location",
-                               "--fail", "--output",
-                               dstpath, url])
+        fetch.download(url, dstpath, self.sha256, segments=self._segments())
 
 
 class ImageDiscoverer():
@@ -517,6 +615,118 @@ path=rootfs:<vendor>:<arch>:<version>.<suffix.es> />
         raise NotImplemented()
 
 
+class ImageCatalog(object):
+    """The images of a remote, indexed by stream and version
+
+    The versions of a stream are sorted once, when they are first
+    needed, and not for every lookup.
+
+    >>> def image(vendorid, version):
+    ...     img = RemoteImage(None)
+    ...     img.vendorid, img.version = vendorid, version
+    ...     img.path = "%s-%s" % (vendorid, version)
+    ...     return img
+
+    >>> catalog = ImageCatalog([image("org.example.Host", "1-12"),
+    ...                         image("org.example.Host", "1-2"),
+    ...                         image("org.example.Node", "2"),
+    ...                         image("org.example.Host", "1")])
+    >>> len(catalog)
+    4
+    >>> catalog.streams()
+    ['org.example.Host', 'org.example.Node']
+    >>> catalog.versions("org.example.Host")
+    ['1', '1-2', '1-12']
+    >>> catalog.latest("org.example.Host")
+    '1-12'
+    >>> catalog.get("org.example.Node", "2")
+    <Image vendorid=org.example.Node version=2 path=org.example.Node-2 />
+
+    The version alone is not enough, the stream is respected:
+
+    >>> catalog.get("org.example.Node", "1")
+    Traceback (most recent call last):
+    ...
+    KeyError: ('org.example.Node', '1')
+
+    >>> catalog.add(image("org.example.Node", "10"))
+    >>> catalog.latest("org.example.Node")
+    '10'
+    >>> len(catalog.images)
+    5
+
+    Images of one version can differ in the arch or suffix, all of
+    them are kept, the last one is returned for the version:
+
+    >>> other = image("org.example.Node", "10")
+    >>> other.path = "org.example.Node-ppc64le-10"
+    >>> catalog.add(other)
+    >>> len(catalog), len(catalog.images)
+    (6, 6)
+    >>> catalog.versions("org.example.Node")
+    ['2', '10']
+    >>> catalog.get("org.example.Node", "10").path
+    'org.example.Node-ppc64le-10'
+    """
+    # stream -> {version: [images]}
+    _streams = None
+    # stream -> sorted versions, filled on demand
+    _versions = None
+    # shorthash -> image, filled on demand
+    _images = None
+
+    def __init__(self, images=()):
+        self._streams = {}
+        self._versions = {}
+        for image in images:
+            self.add(image)
+
+    def __len__(self):
+        return sum(len(images) for versions in self._streams.values()
+                   for images in versions.values())
+
+    def __contains__(self, stream):
+        return stream in self._streams
+
+    def add(self, image):
+        stream = image.stream()
+        versions = self._streams.setdefault(stream, {})
+        versions.setdefault(image.version, []).append(image)
+        self._versions.pop(stream, None)
+        self._images = None
+
+    def streams(self):
+        return sorted(self._streams)
+
+    def versions(self, stream):
+        """The versions of stream, oldest first
+        """
+        if stream not in self._versions:
+            self._versions[stream] = sorted_versions(
+                self._streams.get(stream, {}), "-")
+        return self._versions[stream]
+
+    def latest(self, stream):
+        return self.versions(stream)[-1]
+
+    def get(self, stream, version):
+        try:
+            return self._streams[stream][version][-1]
+        except KeyError:
+            raise KeyError((stream, version))
+
+    @property
+    def images(self):
+        """All images, by their shorthash
+        """
+        if self._images is None:
+            self._images = dict((img.shorthash(), img)
+                                for versions in self._streams.values()
+                                for images in versions.values()
+                                for img in images)
+        return self._images
+
+
 class SimpleIndexImageDiscoverer(ImageDiscoverer):
     """Remotely find images based on a simple index file
 
@@ -529,36 +739,98 @@ class SimpleIndexImageDiscoverer(ImageDiscoverer):
 
     >>> r = SimpleIndexImageDiscoverer(None)
 
-    >>> images = r._list_images(example.splitlines())
-    >>> sorted([i.vendorid for i in images.values()])
+    >>> catalog = ImageCatalog(r._parse(StringIO(example)))
+    >>> catalog.streams()
     ['<vendor>', 'org.example.Some', 'org.ovirt.node.Node']
+
+    Every arch of a version is listed:
+
+    >>> arches = StringIO(u'''
+    ... rootfs:org.example.Some:x86_64:2.0.squashfs
+    ... rootfs:org.example.Some:ppc64le:2.0.squashfs
+    ... ''')
+    >>> len(ImageCatalog(r._parse(arches)).images)
+    2
+
+    The checksums of the images can be kept next to the index, in the
+    format of sha256sum:
+
+    >>> sums = r._checksums(StringIO(u'''
+    ... 9f86d08188  rootfs:org.ovirt.node.Node:x86_64:2.20420102.0.squashfs
+    ... 60303ae22b *rootfs:org.example.Some:x86_64:2.0.squashfs
+    ... '''))
+    >>> images = list(r._parse(StringIO(example), sums))
+    >>> [i.sha256 for i in images]
+    [None, '9f86d08188', '60303ae22b']
     """
+    # The index the catalog was built from
+    _source = None
+    _catalog = None
 
     @property
     def _remote_indexfile(self):
         return self.remote.url + "/index"
 
-    def _list_images(self, lines):
-        filenames = []
-        images = {}
+    @property
+    def _remote_checksumfile(self):
+        return self._remote_indexfile + ".sha256"
+
+    def _parse(self, lines, checksums=None):
+        """Yield the images of an index, line by line
+        """
+        checksums = checksums or {}
         for line in lines:
-            if line and not line.startswith("#"):
-                filenames.append(line)
-        for filename in filenames:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
             try:
-                img = self._imageinfo_from_filename(filename)
-                images[img.shorthash()] = img
+                img = self._imageinfo_from_filename(line)
             except AssertionError as e:
                 log.info("Failed to parse imagename '%s': %s" %
-                         (filename, e))
-        log.debug("Found images: %s" % images)
-        return images
+                         (line, e))
+                continue
+            img.sha256 = checksums.get(line) or \
+                checksums.get(os.path.basename(line))
+            yield img
+
+    def _checksums(self, lines):
+        """Parse the output of sha256sum, returns {filename: sha256}
+        """
+        checksums = {}
+        for line in lines:
+            digest, sep, filename = line.strip().partition(" ")
+            if digest and filename:
+                checksums[filename.lstrip(" *")] = digest
+        return checksums
 
-    def list_images(self):
+    def _fetch_checksums(self):
+        try:
+            src = fetch.get(self._remote_checksumfile,
+                            sidecar_of=self._remote_indexfile)
+        except (IOError, OSError) as e:
+            log.debug("Failed to fetch the checksums: %s" % e)
+            return {}
+        if src is None:
+            log.debug("No checksums for the images")
+            return {}
+        return self._checksums(StringIO(src))
+
+    def catalog(self):
+        """The catalog of the remote index, built once per fetch
+        """
         log.debug("Requesting index from: %s" % self._remote_indexfile)
-        src = request_url(self._remote_indexfile).strip()
-        lines = src.splitlines()
-        return self._list_images(lines)
+        src = fetch.get(self._remote_indexfile)
+        if src is not self._source:
+            with tracing.span("catalog"):
+                checksums = self._fetch_checksums()
+                self._catalog = ImageCatalog(self._parse(StringIO(src),
+                                                         checksums))
+            self._source = src
+            log.debug("Found %d images" % len(self._catalog))
+        return self._catalog
+
+    def list_images(self):
+        return self.catalog().images
 
 
 class LiveimgExtractor():
@@ -573,30 +845,59 @@ class LiveimgExtractor():
         remainder = scaled % 512
         return int(scaled + (512 - remainder))
 
+    def _recommend_size_for_fsimage(self, path, scale=2.0):
+        size, free = ext_fs_usage(path)
+        scaled = max(size, (size - free) * scale)
+        remainder = scaled % 512
+        return int(scaled + (512 - remainder))
+
     def write(self, image):
         raise NotImplementedError
 
     def extract(self, image):
         new_base = None
         log.info("Extracting image '%s'" % image)
-        with tempfile.NamedTemporaryFile() as tmpfile:
-            image.download(tmpfile.name)
-            with mounted(tmpfile.name) as squashfs:
+        with tracing.span("extract", image=image), \
+                image.fetched() as imagefile:
+            with mounted(imagefile) as squashfs:
                 log.debug("Mounted squashfs")
                 liveimg = glob.glob(squashfs.target + "/*/*.img").pop()
                 log.debug("Found fsimage at '%s'" % liveimg)
-                with mounted(liveimg) as rootfs:
-                    size = self._recommend_size_for_tree(rootfs.target, 3.0)
-                    log.debug("Recommeneded base size: %s" % size)
-                    log.info("Starting base creation")
-                    add_tree = self.imgbase.add_base_with_tree
-                    new_base = add_tree(rootfs.target,
-                                        "%sB" % size,
-                                        name=image.vendorid,
-                                        version=image.version,
-                                        release="0")
-                    log.info("Files extracted")
+                if self.imgbase.config.base_import == "block":
+                    new_base = self._extract_blocks(liveimg, image)
+                else:
+                    new_base = self._extract_tree(liveimg, image)
         log.debug("Extraction done")
         return new_base
 
+    def _extract_tree(self, liveimg, image):
+        with mounted(liveimg) as rootfs:
+            with tracing.span("size estimation"):
+                size = self._recommend_size_for_tree(rootfs.target, 3.0)
+            log.debug("Recommeneded base size: %s" % size)
+            log.info("Starting base creation")
+            add_tree = self.imgbase.add_base_with_tree
+            with tracing.span("base creation"):
+                new_base = add_tree(rootfs.target,
+                                    "%sB" % size,
+                                    name=image.vendorid,
+                                    version=image.version,
+                                    release="0")
+            log.info("Files extracted")
+        return new_base
+
+    def _extract_blocks(self, liveimg, image):
+        size = self._recommend_size_for_fsimage(liveimg, 3.0)
+        log.debug("Recommeneded base size: %s" % size)
+        log.info("Starting base creation")
+        add_fsimage = self.imgbase.add_base_with_fsimage
+        with tracing.span("base creation"):
+            new_base = add_fsimage(liveimg,
+                                   "%sB" % size,
+                                   name=image.vendorid,
+                                   version=image.version,
+                                   release="0")
+        log.info("Filesystem image written")
+        return new_base
+
 # vim: sw=4 et sts=4:
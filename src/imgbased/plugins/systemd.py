@@ -1,7 +1,6 @@
 
-import subprocess
 import logging
-from ..utils import mounted
+from ..utils import mounted, spawn
 
 
 log = logging.getLogger(__package__)
@@ -46,6 +45,6 @@ def nspawn(imgbase, layer, cmd=""):
                "-D", mnt.target,
                "--machine", mname,
                "--read-only"] + cmds
-        subprocess.call(cmd)
+        spawn(cmd, capture=False, check=False)
 
 # vim: sw=4 et sts=4
@@ -3,7 +3,7 @@ import logging
 import os
 from ..lvm import LVM
 from ..utils import mounted, systemctl, File, mkfs, \
-    Rsync
+    tree_sync
 
 
 log = logging.getLogger(__package__)
@@ -108,7 +108,7 @@ WantedBy=local-fs.target
 
         # Populate
         with mounted(vol.path) as mount:
-            Rsync().sync(where + "/", mount.target.rstrip("/"))
+            tree_sync("copy").sync(where + "/", mount.target.rstrip("/"))
             pass
 
         log.info("Volume for '%s' was created successful" % where)
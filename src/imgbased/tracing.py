@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author(s): Fabian Deutsch <fabiand@redhat.com>
+#
+
+import os
+import json
+import time
+import logging
+import functools
+import threading
+
+
+log = logging.getLogger(__package__)
+
+
+class Span(object):
+    """A timed phase, spans can be nested
+    """
+    __slots__ = ("name", "args", "tid", "begin", "end", "children")
+
+    def __init__(self, name, args, tid):
+        self.name = name
+        self.args = args
+        self.tid = tid
+        self.begin = time.time()
+        self.end = None
+        self.children = []
+
+    def __repr__(self):
+        return "<Span %s %s />" % (self.name, self.duration)
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.begin
+
+
+class Tracer(object):
+    """Collects the spans of all threads
+
+    >>> tracer = Tracer()
+    >>> with tracer.span("extract", image="Image-1.0"):
+    ...     with tracer.span("download"):
+    ...         pass
+    ...     for n in range(3):
+    ...         with tracer.span("hook"):
+    ...             pass
+    >>> [s.name for s in tracer.roots[0].children]
+    ['download', 'hook', 'hook', 'hook']
+    >>> for line in tracer.summary().splitlines():
+    ...     print(line.split(" s  ", 1)[1])
+    extract
+      download
+      hook (3x)
+    >>> [(e["name"], e["ph"]) for e in tracer.chrome_trace()["traceEvents"]]
+    [('extract', 'X'), ('download', 'X'), ('hook', 'X'), ('hook', 'X'), \
+('hook', 'X')]
+    """
+    roots = None
+
+    _local = None
+    _lock = None
+
+    def __init__(self):
+        self.roots = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def span(self, name, **args):
+        return _SpanContext(self, name, args)
+
+    def _push(self, span):
+        stack = self._stack()
+        if stack:
+            stack[-1].children.append(span)
+        else:
+            with self._lock:
+                self.roots.append(span)
+        stack.append(span)
+
+    def _pop(self, span):
+        span.end = time.time()
+        self._stack().pop()
+
+    def summary(self):
+        """A tree of the spans, siblings with the same name are merged
+        """
+        lines = []
+
+        def walk(spans, depth):
+            merged = []
+            for span in spans:
+                for entry in merged:
+                    if entry[0] == span.name:
+                        entry[1].append(span)
+                        break
+                else:
+                    merged.append((span.name, [span]))
+            for name, group in merged:
+                total = sum(s.duration for s in group)
+                count = " (%dx)" % len(group) if len(group) > 1 else ""
+                lines.append("%10.3f s  %s%s%s" % (total, "  " * depth,
+                                                   name, count))
+                walk([c for s in group for c in s.children], depth + 1)
+        walk(self.roots, 0)
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """The spans in the Chrome trace event format
+
+        The file can be loaded in chrome://tracing or similar viewers.
+        """
+        events = []
+        pid = os.getpid()
+
+        def walk(spans):
+            for span in spans:
+                events.append({"name": span.name,
+                               "cat": "imgbased",
+                               "ph": "X",
+                               "ts": int(span.begin * 1000000),
+                               "dur": int(span.duration * 1000000),
+                               "pid": pid,
+                               "tid": span.tid,
+                               "args": dict((k, str(v)) for k, v
+                                            in span.args.items())})
+                walk(span.children)
+        walk(self.roots)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as dst:
+            json.dump(self.chrome_trace(), dst)
+
+
+class _SpanContext(object):
+    __slots__ = ("tracer", "span")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.span = Span(name, args, threading.current_thread().ident)
+
+    def __enter__(self):
+        self.span.begin = time.time()
+        self.tracer._push(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.span.args["error"] = repr(exc_value)
+        self.tracer._pop(self.span)
+
+
+class _NoSpan(object):
+    """Used while tracing is disabled, it does nothing
+    """
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_nospan = _NoSpan()
+
+# The active tracer, None if tracing is disabled
+_tracer = None
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def current():
+    return _tracer
+
+
+def span(name, **args):
+    """Time a phase, to be used as context manager
+
+    >>> with span("nothing"):
+    ...     pass
+    """
+    if _tracer is None:
+        return _nospan
+    return _tracer.span(name, **args)
+
+
+def traced(name=None):
+    """Decorator to time each call of a function as a span
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# vim: sw=4 et sts=4:
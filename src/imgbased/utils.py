@@ -5,7 +5,24 @@ import os
 import logging
 import re
 import glob
+import time
 import shlex
+import errno
+import stat
+import shutil
+import tempfile
+import collections
+import struct
+import mmap
+import fcntl
+import fnmatch
+import threading
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+from six.moves import queue
+from . import ledger
+from . import tracing
+from . import cassette
 try:
     from urllib.request import urlopen
 except ImportError:
@@ -26,20 +43,372 @@ def augtool(*args):
 def copy_files(dst, srcs, *args):
     """Copy files
 
-    Use the native copy command to also copy xattrs (for SELinux)
+    Regular files are copied in-process, including their mode and
+    xattrs (for SELinux and ACLs). Anything else, or if cp options are
+    given, is copied with the native copy command.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> File(tmpdir + "/a").write("Hi")
+    >>> os.chmod(tmpdir + "/a", 0o751)
+    >>> os.mkdir(tmpdir + "/dst")
+    >>> copy_files(tmpdir + "/dst", [tmpdir + "/a"])
+    >>> File(tmpdir + "/dst/a").read()
+    'Hi'
+    >>> oct(os.stat(tmpdir + "/dst/a").st_mode & 0o777)
+    '0o751'
+    >>> shutil.rmtree(tmpdir)
     """
-    args = list(args) + srcs + [dst]
-    cp = ExternalBinary().cp
-    return cp(args)
+    if args or ExternalBinary.dry or not _native_copy or \
+            not all(os.path.isfile(src) for src in srcs):
+        args = list(args) + srcs + [dst]
+        cp = ExternalBinary().cp
+        return cp(args)
+
+    for src in srcs:
+        target = dst
+        if os.path.isdir(dst):
+            target = os.path.join(dst, os.path.basename(src))
+        log.debug("Copying %s to %s" % (src, target))
+        _copy_file(src, target)
+
+
+# os.listxattr and friends are only available on Python 3
+_native_copy = hasattr(os, "listxattr")
+
+
+def _copy_file(src, dst):
+    """Copy the data, mode and xattrs of a regular file
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        _copy_data(fsrc.fileno(), fdst.fileno(),
+                   os.fstat(fsrc.fileno()).st_size)
+    shutil.copymode(src, dst)
+    _copy_xattrs(src, dst)
+
+
+def _copy_xattrs(src, dst, follow_symlinks=True):
+    """Make the xattrs of dst (including ACLs) the same as of src
+    """
+    try:
+        names = os.listxattr(src, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno != errno.ENOTSUP:
+            raise
+        return
+    for name in os.listxattr(dst, follow_symlinks=follow_symlinks):
+        if name not in names:
+            _xattr_op(os.removexattr, dst, name,
+                      follow_symlinks=follow_symlinks)
+    for name in names:
+        value = os.getxattr(src, name, follow_symlinks=follow_symlinks)
+        _xattr_op(os.setxattr, dst, name, value,
+                  follow_symlinks=follow_symlinks)
+
+
+def _xattr_op(func, path, *args, **kwargs):
+    try:
+        func(path, *args, **kwargs)
+    except OSError as e:
+        # e.g. user xattrs on symlinks, or security xattrs as non-root
+        if e.errno not in (errno.EPERM, errno.ENOTSUP):
+            raise
+        log.debug("Can not set xattr %s on %s: %s" % (args[0], path, e))
+
+
+def _copy_data(fdin, fdout, size):
+    """Copy size bytes in the kernel, without passing them through python
+
+    The current offsets of both files are used and advanced.
+    """
+    for func in (getattr(os, "copy_file_range", None),
+                 _sendfile if hasattr(os, "sendfile") else None):
+        if func is None:
+            continue
+        try:
+            while size > 0:
+                copied = func(fdin, fdout, size)
+                if copied == 0:
+                    return
+                size -= copied
+            return
+        except OSError as e:
+            # Not supported by the kernel or filesystem, try the next
+            if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                               errno.ENOTSUP):
+                raise
+    while size > 0:
+        chunk = os.read(fdin, min(size, 1024 * 1024))
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fdout, view):]
+        size -= len(chunk)
+
+
+def _sendfile(fdin, fdout, size):
+    return os.sendfile(fdout, fdin, None, size)
 
 
 def size_of_fstree(path):
     """Returns the size of the tree in bytes
 
-    The size of sparse files is used, not the allocated amount.
+    The size of sparse files is used, not the allocated amount. Like
+    du -sxb: Other filesystems are not entered, and hardlinked files
+    are only counted once.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> File(tmpdir + "/a").write("Hello")
+    >>> os.link(tmpdir + "/a", tmpdir + "/b")
+    >>> os.mkdir(tmpdir + "/d")
+    >>> File(tmpdir + "/d/sparse").write("")
+    >>> os.truncate(tmpdir + "/d/sparse", 1000)
+    >>> dirs = os.lstat(tmpdir).st_size + os.lstat(tmpdir + "/d").st_size
+    >>> size_of_fstree(tmpdir) - dirs
+    1005
+    >>> shutil.rmtree(tmpdir)
     """
-    du = ExternalBinary().du
-    return int(du(["-sxb", path]).split()[0])
+    top = os.lstat(path)
+    total = top.st_size
+    seen = set()
+    dirs = [path]
+    while dirs:
+        for name, st in _lstat_dir(dirs.pop()):
+            if st.st_dev != top.st_dev:
+                continue
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(name)
+    return total
+
+
+def _lstat_dir(path):
+    """Yields (path, lstat) for all entries of a directory
+    """
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            yield entry.path, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            name = os.path.join(path, name)
+            yield name, os.lstat(name)
+
+
+def write_sparse(src, dst, fresh=True, blocksize=4 * 1024 * 1024,
+                 granularity=64 * 1024):
+    """Write an image to a device, without writing the runs of zeros
+
+    src is a path to a file or device, or a stream (like stdin). A
+    stream is read in a separate thread into two alternating buffers,
+    so that the producer is not stalled by the writes.
+
+    The image is written in blocks of blocksize, zeros are detected
+    per granularity (the chunk size of a thin pool). If the
+    destination is fresh (reads as zeros, like a new thin volume),
+    then the zero runs are skipped, so they stay unallocated.
+    Otherwise they are zeroed with BLKZEROOUT, which also unmaps them
+    on thin volumes (and written on regular files).
+
+    Returns the number of bytes written.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> File(tmpdir + "/src").write(b"\\0" * 8192 + b"Hi" + b"\\0" * 8190,
+    ...                             "wb")
+    >>> File(tmpdir + "/dst").write("")
+    >>> write_sparse(tmpdir + "/src", tmpdir + "/dst", blocksize=8192,
+    ...              granularity=4096)
+    4096
+    >>> data = File(tmpdir + "/dst").read()
+    >>> len(data), data.strip("\\0")
+    (16384, 'Hi')
+    >>> with open(tmpdir + "/src", "rb") as stream:
+    ...     write_sparse(stream, tmpdir + "/dst", fresh=False,
+    ...                  blocksize=8192, granularity=4096)
+    16384
+    >>> shutil.rmtree(tmpdir)
+    """
+    assert blocksize % granularity == 0
+    zeros = b"\0" * granularity
+    begin = time.time()
+    written = 0
+    zeroed = 0
+    offset = 0
+
+    fd = os.open(dst, os.O_WRONLY)
+    try:
+        isblk = stat.S_ISBLK(os.fstat(fd).st_mode)
+
+        def write_zeros(start, end):
+            if fresh or end <= start:
+                return 0
+            if isblk:
+                fcntl.ioctl(fd, BLKZEROOUT,
+                            struct.pack("QQ", start, end - start))
+                return 0
+            return _pwrite(fd, memoryview(b"\0" * (end - start)), start)
+
+        for buf, length in _read_blocks(src, blocksize):
+            view = memoryview(buf)[:length]
+            # Runs of data are written at once, runs of zeros skipped
+            run_start = 0
+            run_is_data = None
+            for pos in range(0, length, granularity):
+                # Comparing bytes is much faster than memoryviews
+                chunk = view[pos:pos + granularity].tobytes()
+                is_data = chunk != zeros[:len(chunk)]
+                if is_data != run_is_data and run_is_data is not None:
+                    written += _write_run(fd, view, run_start, pos, offset,
+                                          run_is_data, write_zeros)
+                    zeroed += 0 if run_is_data else pos - run_start
+                    run_start = pos
+                run_is_data = is_data
+            if run_is_data is not None:
+                written += _write_run(fd, view, run_start, length, offset,
+                                      run_is_data, write_zeros)
+                zeroed += 0 if run_is_data else length - run_start
+            offset += length
+
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            os.ftruncate(fd, max(offset, os.fstat(fd).st_size))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    duration = max(time.time() - begin, 0.001)
+    log.info("Wrote %d MiB of %d MiB in %.1f s (%.1f MiB/s), "
+             "%d MiB were zeros" %
+             (written >> 20, offset >> 20, duration,
+              offset / duration / (1 << 20), zeroed >> 20))
+    return written
+
+
+# From linux/fs.h, zero a range of a block device
+BLKZEROOUT = 0x127f
+
+
+def _pwrite(fd, view, offset):
+    total = len(view)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+    return total
+
+
+def _write_run(fd, view, start, end, offset, is_data, write_zeros):
+    if is_data:
+        return _pwrite(fd, view[start:end], offset + start)
+    return write_zeros(offset + start, offset + end)
+
+
+def _read_blocks(src, blocksize):
+    """Yields (buffer, length) of the blocks of src
+
+    The buffers are page aligned and reused, a buffer must not be
+    used anymore once the next one was requested. Streams are read in
+    a separate thread, while the previous block is processed.
+    """
+    if hasattr(src, "read"):
+        for block in _read_blocks_threaded(src, blocksize):
+            yield block
+        return
+    buf = mmap.mmap(-1, blocksize)
+    with open(src, "rb", buffering=0) as fsrc:
+        while True:
+            length = _fill(fsrc, buf)
+            if not length:
+                break
+            yield buf, length
+
+
+def _fill(fsrc, buf):
+    """Read until buf is full, short reads happen with pipes
+    """
+    view = memoryview(buf)
+    length = 0
+    while length < len(buf):
+        n = fsrc.readinto(view[length:])
+        if not n:
+            break
+        length += n
+    return length
+
+
+def _read_blocks_threaded(stream, blocksize):
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(2):
+        free.put(mmap.mmap(-1, blocksize))
+    error = []
+
+    def reader():
+        try:
+            while True:
+                buf = free.get()
+                if buf is None:
+                    return
+                length = _fill(stream, buf)
+                full.put((buf, length))
+                if not length:
+                    return
+        except Exception as e:
+            error.append(e)
+            full.put((None, 0))
+
+    thread = threading.Thread(target=reader, name="image-reader")
+    thread.daemon = True
+    thread.start()
+    try:
+        previous = None
+        while True:
+            buf, length = full.get()
+            if previous is not None:
+                free.put(previous)
+            if not length:
+                break
+            yield buf, length
+            previous = buf
+    finally:
+        # Let the reader end, if we stop early
+        free.put(None)
+    thread.join()
+    if error:
+        raise error[0]
+
+
+def ext_fs_usage(path):
+    """The size and the free space of an ext2/3/4 filesystem in bytes
+
+    It is read from the superblock, the filesystem is not mounted.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> sb = bytearray(2048)
+    >>> sb[1024 + 4:1024 + 8] = struct.pack("<I", 1000)
+    >>> sb[1024 + 12:1024 + 16] = struct.pack("<I", 250)
+    >>> sb[1024 + 24:1024 + 28] = struct.pack("<I", 2)
+    >>> sb[1024 + 56:1024 + 58] = b"\\x53\\xef"
+    >>> File(tmpdir + "/img").write(bytes(sb), "wb")
+    >>> ext_fs_usage(tmpdir + "/img")
+    (4096000, 1024000)
+    >>> shutil.rmtree(tmpdir)
+    """
+    with open(path, "rb") as src:
+        src.seek(1024)
+        sb = src.read(1024)
+    if sb[56:58] != b"\x53\xef":
+        raise RuntimeError("No ext filesystem: %s" % path)
+    blocks, _, free = struct.unpack_from("<III", sb, 4)
+    blocksize = 1024 << struct.unpack_from("<I", sb, 24)[0]
+    incompat = struct.unpack_from("<I", sb, 0x60)[0]
+    if incompat & 0x80:
+        # 64bit feature, the upper halves of the counts are used
+        blocks |= struct.unpack_from("<I", sb, 0x150)[0] << 32
+        free |= struct.unpack_from("<I", sb, 0x158)[0] << 32
+    return blocks * blocksize, free * blocksize
 
 
 def request_url(url):
@@ -47,6 +416,18 @@ def request_url(url):
 
 
 def findmnt(options, path):
+    """Like findmnt -n -o options path, served from the mount table
+
+    Columns which are not known to MountInfo are looked up by
+    calling findmnt.
+    """
+    columns = options.upper().split(",")
+    if all(c in MountInfo.Entry.columns for c in columns):
+        entry = MountInfo().find(path)
+        if entry is None:
+            return None
+        return " ".join(entry.column(c) for c in columns)
+
     findmnt = ExternalBinary().findmnt
     try:
         return str(findmnt(["-n", "-o", options, path])).strip()
@@ -71,14 +452,185 @@ def memoize(obj):
 
 
 def uuid():
-    raw = File("/proc/sys/kernel/random/uuid").contents
-    return raw.replace("-", "").strip()
+    """A random uuid, without dashes
 
+    >>> len(uuid())
+    32
+    """
+    return uuid4().hex
 
-def call(*args, **kwargs):
+
+def spawn(args, capture=True, check=True, **kwargs):
+    """Run a command, return it's stdout if capture is set
+
+    All external commands should be run through this function, so
+    that they can be recorded (see ledger) and replayed (see cassette).
+
+    >>> spawn(["echo", "Hi"])
+    b'Hi\\n'
+    >>> spawn(["false"], check=False, capture=False)
+    >>> spawn(["false"])
+    Traceback (most recent call last):
+    ...
+    subprocess.CalledProcessError: Command '['false']' returned \
+non-zero exit status 1.
+    """
     kwargs["close_fds"] = True
+    if capture:
+        kwargs["stdout"] = subprocess.PIPE
+    log.debug("Spawning: %s %s" % (args, kwargs))
+    with tracing.span(os.path.basename(str(args[0])), argv=args):
+        tape = cassette.current()
+        if tape:
+            status, stdout = tape.run(args, lambda: _spawn(args, capture,
+                                                           **kwargs))
+        else:
+            status, stdout = _spawn(args, capture, **kwargs)
+    if check and status:
+        raise subprocess.CalledProcessError(status, args, stdout)
+    return stdout
+
+
+def _spawn(args, capture, **kwargs):
+    begin = time.time()
+    try:
+        proc = subprocess.Popen(args, **kwargs)
+    except OSError:
+        ledger.record(args, time.time() - begin, 0.0, 127, 0)
+        raise
+    stdout = None
+    if capture:
+        with proc.stdout:
+            stdout = proc.stdout.read()
+    cpu = _reap(proc)
+    ledger.record(args, time.time() - begin, cpu,
+                  proc.returncode, len(stdout or b""))
+    return proc.returncode, stdout
+
+
+def _reap(proc):
+    """Wait for a child, returns the cpu time it used
+
+    The child is reaped by us, and not by Popen, to get it's resource
+    usage.
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def spawn_lines(*commands, **kwargs):
+    """Run a pipeline of commands, yields the lines of it's stdout
+
+    The output is read lazily, line by line, so it is never held in
+    memory as a whole, and a slow consumer also slows the commands
+    down (the pipe is full). Each command reads the stdout of the
+    previous one, like in a shell pipe. The lines are decoded and the
+    line ending is removed.
+
+    The exit status of all commands is checked once all lines were
+    consumed. If the generator is closed early, the commands are
+    killed instead.
+
+    >>> list(spawn_lines(["printf", "b\\na\\n"], ["sort"]))
+    ['a', 'b']
+    >>> lines = spawn_lines(["yes"])
+    >>> next(lines)
+    'y'
+    >>> lines.close()
+    >>> list(spawn_lines(["sh", "-c", "echo Hi; exit 3"], ["cat"]))
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Command '['sh', '-c', 'echo Hi; exit 3']' \
+returned non-zero exit status 3.
+    >>> list(spawn_lines(["false"], check=False))
+    []
+    """
+    check = kwargs.pop("check", True)
+    log.debug("Streaming: %s %s" % (commands, kwargs))
+    statuses = []
+    tape = cassette.current()
+    if tape:
+        # A cassette holds the whole output anyway
+        argv = list(commands[0])
+        for args in commands[1:]:
+            argv += ["|"] + list(args)
+
+        def run():
+            lines = list(_spawn_lines(commands, statuses, **kwargs))
+            return (_pipe_status(statuses),
+                    "".join(line + "\n" for line in lines))
+        status, stdout = tape.run(argv, run, text=True)
+        for line in (stdout or "").splitlines():
+            yield line
+        statuses = [(argv, status)]
+    else:
+        lines = _spawn_lines(commands, statuses, **kwargs)
+        try:
+            for line in lines:
+                yield line
+        finally:
+            lines.close()
+    if check:
+        for args, status in statuses:
+            if status:
+                raise subprocess.CalledProcessError(status, args)
+
+
+def _pipe_status(statuses):
+    """The last failed exit status, like with bash's pipefail"""
+    return ([s for _, s in statuses if s] or [0])[-1]
+
+
+def _spawn_lines(commands, statuses, **kwargs):
+    """Yields the stdout lines, then appends (args, status) to statuses
+    """
+    begin = time.time()
+    procs = []
+    pipe = None
+    done = False
+    try:
+        for args in commands:
+            try:
+                proc = subprocess.Popen(args, stdin=pipe,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True, **kwargs)
+            except OSError:
+                ledger.record(args, time.time() - begin, 0.0, 127, 0)
+                raise
+            if pipe:
+                # Only the next command reads it, this way the previous
+                # one gets a SIGPIPE if the next one exits early.
+                pipe.close()
+            procs.append((args, proc))
+            pipe = proc.stdout
+        size = 0
+        for line in iter(pipe.readline, b""):
+            size += len(line)
+            yield line.decode("utf-8", "replace").rstrip("\n")
+        done = True
+    finally:
+        if pipe:
+            pipe.close()
+        for args, proc in procs:
+            if not done:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            cpu = _reap(proc)
+            ledger.record(args, time.time() - begin, cpu, proc.returncode,
+                          size if proc is procs[-1][1] else 0)
+            statuses.append((args, proc.returncode))
+
+
+def call(*args, **kwargs):
     log.debug("Calling: %s %s" % (args, kwargs))
-    return subprocess.check_output(*args, **kwargs).strip()
+    return spawn(*args, **kwargs).strip()
 
 
 def chroot(target_root):
@@ -115,42 +667,63 @@ def format_to_pattern(fmt):
 
 
 class mounted(object):
+    """Mount a source for the duration of a with block
+
+    If a MountManager is active, and no target is given, then the
+    mount is shared through the manager.
+    """
     source = None
     options = None
     target = None
 
     run = None
     tmpdir = None
+    manager = None
+    readonly = False
 
-    def __init__(self, source, options=None, target=None):
+    def __init__(self, source, options=None, target=None, readonly=False):
         self.run = ExternalBinary()
         self.source = source
         self.options = options
         self.target = target
+        self.readonly = readonly
+        if readonly:
+            self.options = readonly_options(source, options)
 
     def __enter__(self):
-        options = "-o%s" % self.options if self.options else None
+        if not self.readonly and _mount_manager:
+            # A kept read-only mount would make a writable one fail
+            _mount_manager.unmount_idle(self.source, keep=(self.options,))
+
+        if not self.target and _mount_manager:
+            self.manager = _mount_manager
+            self.target = self.manager.acquire(self.source, self.options)
+            return self
 
         if not self.target:
-            self.tmpdir = \
-                self.run.call(["mktemp", "-d", "--tmpdir", "mnt.XXXXX"])
+            self.tmpdir = "" if self.run.dry else \
+                tempfile.mkdtemp(prefix="mnt.")
             self.target = self.tmpdir
 
-        if not os.path.exists(self.target):
-            self.run.call(["mkdir", "-p", self.target])
+        if not os.path.exists(self.target) and not self.run.dry:
+            os.makedirs(self.target)
 
         cmd = ["mount"]
-        if options:
-            cmd.append(options)
+        if self.options:
+            cmd.append("-o%s" % self.options)
         cmd += [self.source, self.target]
         self.run.call(cmd)
 
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        if self.manager:
+            self.manager.release(self.source, self.options)
+            self.target = None
+            return exc_type is None
         self.run.call(["umount", self.target])
         if self.tmpdir:
-            self.run.call(["rmdir", self.tmpdir])
+            os.rmdir(self.tmpdir)
         return exc_type is None
 
     def path(self, subpath):
@@ -159,6 +732,204 @@ class mounted(object):
         return self.target + "/" + subpath
 
 
+class MountManager(object):
+    """Shares mounts between the users of a source during an operation
+
+    While a manager is active (within it's with block), mounted
+    hands out refcounted mounts through it. Once a mount is not used
+    anymore it is kept until the operation ends, so that the next user
+    of the same source does not need to mount it again. Only block
+    devices are kept, loop mounted files are unmounted right away.
+
+    >>> mm = MountManager()
+    >>> mm._mount = lambda source, options: "/mnt/" + source
+    >>> umounted = []
+    >>> mm._umount = umounted.append
+    >>> mm._keep = lambda source: source.startswith("lv")
+    >>> with mm:
+    ...     with mounted("lv1") as a, mounted("lv1") as b:
+    ...         (a.target, b.target)
+    ...     with mounted("lv1") as c:
+    ...         c.target
+    ...     with mounted("file.img") as d:
+    ...         umounted
+    ...     umounted
+    ('/mnt/lv1', '/mnt/lv1')
+    '/mnt/lv1'
+    []
+    ['/mnt/file.img']
+    >>> umounted
+    ['/mnt/file.img', '/mnt/lv1']
+
+    Idle mounts of a source can be dropped, e.g. before it is removed:
+
+    >>> with mm:
+    ...     with mounted("lv2") as a:
+    ...         mm.unmount("lv2")
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Mount of lv2 is still in use
+    >>> with mm:
+    ...     with mounted("lv2") as a:
+    ...         pass
+    ...     mm.unmount("lv2")
+    ...     umounted[-1]
+    '/mnt/lv2'
+
+    A source can not be mounted writable while it is kept mounted
+    read-only, so the idle mounts with other options are dropped:
+
+    >>> with mm:
+    ...     with mounted("lv3", "ro") as a:
+    ...         pass
+    ...     with mounted("lv3") as b:
+    ...         umounted[-1]
+    '/mnt/lv3'
+    """
+    # (source, options) -> [target, refcount], in mount order
+    _mounts = None
+    _depth = 0
+    _previous = None
+
+    def __init__(self):
+        self._mounts = collections.OrderedDict()
+
+    def __enter__(self):
+        global _mount_manager
+        if self._depth == 0:
+            self._previous = _mount_manager
+            _mount_manager = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _mount_manager
+        self._depth -= 1
+        if self._depth == 0:
+            _mount_manager = self._previous
+            self.unmount_all()
+
+    def acquire(self, source, options=None):
+        """Returns the target of a mount of source, mounts if needed
+        """
+        key = (source, options)
+        if key not in self._mounts:
+            self._mounts[key] = [self._mount(source, options), 0]
+        else:
+            log.debug("Reusing mount of %s" % source)
+        self._mounts[key][1] += 1
+        return self._mounts[key][0]
+
+    def release(self, source, options=None):
+        key = (source, options)
+        self._mounts[key][1] -= 1
+        if self._mounts[key][1] == 0 and not self._keep(source):
+            self._umount(self._mounts.pop(key)[0])
+
+    def unmount(self, source):
+        """Unmount the idle mounts of a source
+        """
+        for key in [k for k in self._mounts if k[0] == source]:
+            if self._mounts[key][1]:
+                raise RuntimeError("Mount of %s is still in use" % source)
+            self._umount(self._mounts.pop(key)[0])
+
+    def unmount_idle(self, source, keep=()):
+        """Unmount the idle mounts of a source before it is changed
+
+        Mounts with the options in keep are left alone, just like the
+        mounts which are still in use, the change will fail on them.
+        The source is compared by the device it resolves to.
+        """
+        device = os.path.realpath(source)
+        for key in [k for k in self._mounts
+                    if os.path.realpath(k[0]) == device and
+                    k[1] not in keep and not self._mounts[k][1]]:
+            log.debug("Dropping idle mount of %s" % key[0])
+            self._umount(self._mounts.pop(key)[0])
+
+    def unmount_all(self):
+        while self._mounts:
+            key, (target, refs) = self._mounts.popitem()
+            if refs:
+                log.warning("Unmounting %s which is still in use" %
+                            key[0])
+            self._umount(target)
+
+    def _keep(self, source):
+        try:
+            return stat.S_ISBLK(os.stat(source).st_mode)
+        except OSError:
+            return False
+
+    def _mount(self, source, options):
+        run = ExternalBinary()
+        target = "" if run.dry else tempfile.mkdtemp(prefix="mnt.")
+        cmd = ["mount"]
+        if options:
+            cmd.append("-o%s" % options)
+        run.call(cmd + [source, target])
+        return target
+
+    def _umount(self, target):
+        run = ExternalBinary()
+        run.call(["umount", target])
+        if target:
+            os.rmdir(target)
+
+
+# The active mount manager, None if every mount is private
+_mount_manager = None
+
+
+def release_mounts(source):
+    """Drop the idle shared mounts of a source, e.g. before LVM
+    deactivates or removes it
+    """
+    if _mount_manager:
+        _mount_manager.unmount_idle(source)
+
+
+def readonly_options(source, options=None):
+    """Mount options to mount a source read-only
+
+    ext and XFS journals are not replayed, as this would write to
+    the source. If the source is mounted already, then the options
+    are kept, because the read-only state of the filesystem can not
+    be changed by another mount.
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> File(tmpdir + "/ext").write(b"\\0" * 1080 + b"\\x53\\xef", "wb")
+    >>> readonly_options(tmpdir + "/ext")
+    'ro,noload'
+    >>> File(tmpdir + "/xfs").write("XFSB")
+    >>> readonly_options(tmpdir + "/xfs", "discard")
+    'discard,ro,norecovery'
+    >>> readonly_options(tmpdir + "/missing")
+    'ro'
+    >>> shutil.rmtree(tmpdir)
+    """
+    try:
+        st = os.stat(source)
+        if stat.S_ISBLK(st.st_mode):
+            devno = (os.major(st.st_rdev), os.minor(st.st_rdev))
+            if any(e.devno == devno for e in MountInfo().parse()):
+                log.debug("%s is mounted, can not mount it read-only" %
+                          source)
+                return options
+        with open(source, "rb") as src:
+            sb = src.read(1082)
+    except (IOError, OSError):
+        sb = b""
+    opts = options.split(",") if options else []
+    opts.append("ro")
+    if sb[1080:1082] == b"\x53\xef":
+        opts.append("noload")
+    elif sb[0:4] == b"XFSB":
+        opts.append("norecovery")
+    return ",".join(opts)
+
+
 def sorted_versions(versions, delim="."):
     return sorted(list(versions),
                   key=lambda s: list(map(int, s.split(delim))))
@@ -177,6 +948,13 @@ def nspawn(*args, **kwargs):
 class ExternalBinary(object):
     dry = False
 
+    # An optional executor for LVM commands, it needs to provide a
+    # call(args) method returning the stdout, like LvmShell does.
+    # If it is None, every LVM command forks it's own process.
+    # Executors with in_process set (like LvmSimulator) are also
+    # used in dry mode.
+    lvm = None
+
     def call(self, *args, **kwargs):
         log.debug("Calling binary: %s %s" % (args, kwargs))
         stdout = bytes()
@@ -185,26 +963,48 @@ class ExternalBinary(object):
             log.debug("Returned: %s" % stdout[0:1024])
         return stdout.decode(errors="replace").strip()
 
+    def _lvm(self, args, **kwargs):
+        if self.lvm and not kwargs and \
+                (not self.dry or getattr(self.lvm, "in_process", False)):
+            tape = cassette.current()
+            if tape is None:
+                return self.lvm.call(args)
+            status, stdout = tape.run(args, lambda: self._lvm_status(args),
+                                      text=True)
+            if status:
+                raise subprocess.CalledProcessError(status, args, stdout)
+            return stdout
+        return self.call(args, **kwargs)
+
+    def _lvm_status(self, args):
+        try:
+            return 0, self.lvm.call(args)
+        except subprocess.CalledProcessError as e:
+            return e.returncode, e.output
+
     def lvs(self, args, **kwargs):
-        return self.call(["lvs"] + args, **kwargs)
+        return self._lvm(["lvs"] + args, **kwargs)
 
     def vgs(self, args, **kwargs):
-        return self.call(["vgs"] + args, **kwargs)
+        return self._lvm(["vgs"] + args, **kwargs)
 
     def lvcreate(self, args, **kwargs):
-        return self.call(["lvcreate"] + args, **kwargs)
+        return self._lvm(["lvcreate"] + args, **kwargs)
 
     def lvremove(self, args, **kwargs):
-        return self.call(["lvremove"] + args, **kwargs)
+        return self._lvm(["lvremove"] + args, **kwargs)
+
+    def lvextend(self, args, **kwargs):
+        return self._lvm(["lvextend"] + args, **kwargs)
 
     def vgcreate(self, args, **kwargs):
-        return self.call(["vgcreate"] + args, **kwargs)
+        return self._lvm(["vgcreate"] + args, **kwargs)
 
     def lvchange(self, args, **kwargs):
-        return self.call(["lvchange"] + args, **kwargs)
+        return self._lvm(["lvchange"] + args, **kwargs)
 
     def vgchange(self, args, **kwargs):
-        return self.call(["vgchange"] + args, **kwargs)
+        return self._lvm(["vgchange"] + args, **kwargs)
 
     def find(self, args, **kwargs):
         return self.call(["find"] + args, **kwargs)
@@ -237,6 +1037,25 @@ class ExternalBinary(object):
         return self.call(["systemctl"] + args, **kwargs)
 
 
+class StreamingExternalBinary(ExternalBinary):
+    """Like ExternalBinary, but the stdout lines are yielded lazily
+
+    Meant for commands with a large output, which would otherwise be
+    held in memory as a whole. See spawn_lines.
+
+    >>> list(StreamingExternalBinary().find(["/proc/self/", "-maxdepth",
+    ...                                      "0"]))
+    ['/proc/self/']
+    >>> list(StreamingExternalBinary().call(["printf", "b\\na"], ["sort"]))
+    ['a', 'b']
+    """
+    def call(self, *args, **kwargs):
+        log.debug("Streaming binary: %s %s" % (args, kwargs))
+        if self.dry:
+            return iter([])
+        return spawn_lines(*args, **kwargs)
+
+
 class File():
     filename = None
 
@@ -432,6 +1251,100 @@ class Fstab(File):
             return targets
 
 
+class MountInfo(File):
+    """The mount table of the kernel, parsed from /proc/self/mountinfo
+
+    >>> MountInfo._testdata = '''
+    ... 22 1 253:3 / / rw,relatime shared:1 - ext4 /dev/mapper/vg-lv rw,discard
+    ... 40 22 8:1 / /boot rw,relatime shared:2 - ext4 /dev/sda1 rw
+    ... 41 22 0:38 / /mnt/with\\\\040space rw - tmpfs tmpfs rw
+    ... '''
+    >>> mi = MountInfo()
+    >>> mi._read = lambda: MountInfo._testdata
+    >>> mi.parse()
+    [<Entry / /dev/mapper/vg-lv 253:3 />, <Entry /boot /dev/sda1 8:1 />, \
+<Entry /mnt/with space tmpfs 0:38 />]
+    >>> root = mi.find("/")
+    >>> root.devno
+    (253, 3)
+    >>> root.column("OPTIONS")
+    'rw,relatime,discard'
+    >>> mi.find("/dev/sda1")
+    <Entry /boot /dev/sda1 8:1 />
+    >>> mi.find("/nowhere") is None
+    True
+    """
+    _testdata = None
+
+    class Entry():
+        columns = ["SOURCE", "TARGET", "FSTYPE", "OPTIONS", "MAJ:MIN"]
+
+        source = None
+        target = None
+        fstype = None
+        devno = None
+        vfs_options = None
+        fs_options = None
+
+        def __repr__(self):
+            major, minor = self.devno
+            return "<Entry %s %s %d:%d />" % (self.target, self.source,
+                                              major, minor)
+
+        @property
+        def options(self):
+            opts = self.vfs_options.split(",")
+            opts += [o for o in self.fs_options.split(",")
+                     if o not in opts and o not in ["ro", "rw"]]
+            return ",".join(opts)
+
+        def column(self, name):
+            return {"SOURCE": self.source,
+                    "TARGET": self.target,
+                    "FSTYPE": self.fstype,
+                    "OPTIONS": self.options,
+                    "MAJ:MIN": "%d:%d" % self.devno}[name]
+
+    def __init__(self, fn="/proc/self/mountinfo"):
+        self.filename = fn
+
+    def _read(self):
+        return self.contents
+
+    @staticmethod
+    def _unescape(field):
+        return re.sub(r"\\([0-7]{3})",
+                      lambda m: chr(int(m.group(1), 8)), field)
+
+    def parse(self):
+        entries = []
+        for line in self._read().splitlines():
+            if not line.strip():
+                continue
+            fields = line.split()
+            sep = fields.index("-")
+            entry = MountInfo.Entry()
+            entry.devno = tuple(map(int, fields[2].split(":")))
+            entry.target = self._unescape(fields[4])
+            entry.vfs_options = fields[5]
+            entry.fstype = fields[sep + 1]
+            entry.source = self._unescape(fields[sep + 2])
+            entry.fs_options = fields[sep + 3]
+            entries.append(entry)
+        return entries
+
+    def find(self, path):
+        """The mount with the target or source path
+
+        If something is mounted over, then the topmost mount is used.
+        """
+        found = None
+        for entry in self.parse():
+            if path in (entry.target, entry.source):
+                found = entry
+        return found
+
+
 class ShellVarFile(File):
     def parse(self, data=None):
         """Parse
@@ -481,12 +1394,14 @@ class PackageDb():
 
 
 class RpmPackageDb(PackageDb):
-    _rpm_cmd = lambda s, a: ExternalBinary().rpm(a)
+    _rpm_cmd = lambda s, a: StreamingExternalBinary().rpm(a)
 
     def _rpm(self, *args, **kwargs):
+        """Yields the lines of rpm's output
+        """
         if self.root:
             args += ("--root", self.root)
-        return self._rpm_cmd(list(args)).splitlines(False)
+        return self._rpm_cmd(list(args))
 
     def get_packages(self):
         return self._rpm("-qa")
@@ -521,14 +1436,20 @@ class systemctl():
 
 class Rsync():
     existing = False
+    # Delete files which are not in the source (excluded ones are kept)
+    delete = False
     exclude = None
+    # How files are compared: checksum (of the whole contents), mtime
+    # (size and mtime) or copy (always copy, for empty destinations)
+    compare = "checksum"
 
-    def __init__(self):
+    def __init__(self, compare=None):
         self.exclude = []
+        self.compare = compare or self.compare
 
     def _run(self, cmd):
         log.debug("Running: %s" % cmd)
-        subprocess.check_call(cmd)
+        spawn(cmd, capture=False)
 
     def sync(self, sourcetree, dst):
         assert os.path.isdir(sourcetree)
@@ -536,10 +1457,15 @@ class Rsync():
 
         cmd = ["ionice", "rsync"]
         cmd += ["-pogAXtlHrx"]
-        cmd += ["-Sc", "--no-i-r"]
+        cmd += ["-S", "--no-i-r"]
+        cmd += {"checksum": ["-c"],
+                "mtime": [],
+                "copy": ["--ignore-times"]}[self.compare]
         # cmd += ["--progress"]
         if self.existing:
             cmd += ["--existing"]
+        if self.delete:
+            cmd += ["--delete"]
         if self.exclude:
             for pat in self.exclude:
                 cmd += ["--exclude", pat]
@@ -548,6 +1474,338 @@ class Rsync():
         self._run(cmd)
 
 
+class TreeSync(object):
+    """Syncs a tree in-process, with a pool of worker threads
+
+    An alternative to Rsync, with the same interface and the same
+    semantics as rsync -pogAXtlHrxS: Ownership, permissions, ACLs,
+    xattrs, mtimes, symlinks, hardlinks and holes of sparse files are
+    kept, other filesystems are not entered and nothing is deleted.
+    Devices and other special files are skipped.
+
+    The directories of the first split_depth levels are synced first,
+    the subtrees below them are then synced by the workers.
+
+    >>> src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> os.makedirs(src + "/usr/lib")
+    >>> File(src + "/usr/lib/a").write("Hello")
+    >>> os.link(src + "/usr/lib/a", src + "/usr/b")
+    >>> os.symlink("lib/a", src + "/usr/c")
+    >>> File(src + "/sparse").write("")
+    >>> os.truncate(src + "/sparse", 1024 * 1024)
+    >>> File(src + "/skip.tmp").write("")
+    >>> os.utime(src + "/usr/lib", (0, 0))
+    >>> sync = TreeSync(compare="copy")
+    >>> sync.exclude = ["*.tmp"]
+    >>> sync.sync(src, dst)
+    >>> sorted(os.listdir(dst))
+    ['sparse', 'usr']
+    >>> File(dst + "/usr/b").read(), os.readlink(dst + "/usr/c")
+    ('Hello', 'lib/a')
+    >>> os.path.samefile(dst + "/usr/b", dst + "/usr/lib/a")
+    True
+    >>> os.stat(dst + "/sparse").st_size, os.stat(dst + "/sparse").st_blocks
+    (1048576, 0)
+    >>> os.stat(dst + "/usr/lib").st_mtime
+    0.0
+
+    Only files with a different content are copied again:
+
+    >>> File(src + "/usr/lib/a").write("World")
+    >>> sync.compare = "checksum"
+    >>> sync.sync(src, dst)
+    >>> File(dst + "/usr/b").read()
+    'World'
+    >>> os.path.samefile(dst + "/usr/b", dst + "/usr/lib/a")
+    True
+
+    With delete set, what is not in the source is removed:
+
+    >>> os.unlink(src + "/usr/c")
+    >>> shutil.rmtree(src + "/usr/lib")
+    >>> sync.delete = True
+    >>> sync.sync(src, dst)
+    >>> sorted(os.listdir(dst + "/usr"))
+    ['b']
+    >>> shutil.rmtree(src)
+    >>> shutil.rmtree(dst)
+    """
+    existing = False
+    delete = False
+    exclude = None
+    # See Rsync.compare
+    compare = "checksum"
+    workers = 4
+    split_depth = 2
+
+    _dev = None
+    _links = None
+    _lock = None
+
+    def __init__(self, compare=None):
+        self.exclude = []
+        self.compare = compare or self.compare
+
+    def sync(self, sourcetree, dst):
+        assert os.path.isdir(sourcetree)
+        assert os.path.isdir(dst)
+        assert self.compare in ("checksum", "mtime", "copy")
+        log.debug("Syncing %s to %s (%s)" % (sourcetree, dst, self.compare))
+
+        top = os.lstat(sourcetree)
+        self._dev = top.st_dev
+        # (st_dev, st_ino) -> (first dst path, event once it exists)
+        self._links = {}
+        self._lock = threading.Lock()
+
+        created = []
+        pending = [(sourcetree, dst, "")]
+        for depth in range(self.split_depth):
+            subdirs = []
+            for args in pending:
+                subdirs += self._sync_dir(*args)
+            created += subdirs
+            pending = [(s, d, rel) for s, d, rel, st in subdirs]
+
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(self._sync_tree, pending, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Deepest first, writing the contents changes the mtime
+        for src, target, rel, st in reversed(created):
+            self._copy_meta(src, st, target)
+        self._copy_meta(sourcetree, top, dst)
+
+    def _sync_tree(self, args):
+        for src, target, rel, st in self._sync_dir(*args):
+            self._sync_tree((src, target, rel))
+            self._copy_meta(src, st, target)
+
+    def _sync_dir(self, srcdir, dstdir, rel):
+        """Sync the entries of a directory, returns the subdirectories
+
+        The subdirectories are created, but not their contents.
+        """
+        subdirs = []
+        names = set()
+        for src, st in _lstat_dir(srcdir):
+            name = os.path.basename(src)
+            names.add(name)
+            relname = rel + "/" + name
+            isdir = stat.S_ISDIR(st.st_mode)
+            if self._excluded(relname, isdir):
+                continue
+            target = os.path.join(dstdir, name)
+            try:
+                dst_st = os.lstat(target)
+            except OSError:
+                dst_st = None
+            if self.existing and dst_st is None:
+                continue
+            if dst_st and stat.S_ISDIR(dst_st.st_mode) != isdir:
+                if not isdir:
+                    log.warning("Not replacing directory %s" % target)
+                    continue
+                os.unlink(target)
+                dst_st = None
+
+            if isdir:
+                if dst_st is None:
+                    os.mkdir(target, 0o700)
+                if st.st_dev != self._dev:
+                    # A mount point, like rsync -x it is kept empty
+                    self._copy_meta(src, st, target)
+                    continue
+                subdirs.append((src, target, relname, st))
+            elif stat.S_ISREG(st.st_mode):
+                self._sync_file(src, st, target, dst_st)
+            elif stat.S_ISLNK(st.st_mode):
+                self._sync_symlink(src, st, target, dst_st)
+            else:
+                log.debug("Skipping special file %s" % src)
+        if self.delete:
+            self._delete_extra(dstdir, rel, names)
+        return subdirs
+
+    def _delete_extra(self, dstdir, rel, names):
+        for target, st in list(_lstat_dir(dstdir)):
+            name = os.path.basename(target)
+            isdir = stat.S_ISDIR(st.st_mode)
+            if name in names or self._excluded(rel + "/" + name, isdir):
+                continue
+            log.debug("Deleting %s" % target)
+            if isdir:
+                shutil.rmtree(target)
+            else:
+                os.unlink(target)
+
+    def _excluded(self, relname, isdir):
+        """Roughly like rsync's exclude patterns
+
+        >>> sync = TreeSync()
+        >>> sync.exclude = ["*.rpmnew", "/etc/fedora-release*", "log/"]
+        >>> [sync._excluded(p, False) for p in ["/etc/a.rpmnew",
+        ...  "/etc/fedora-release", "/usr/etc/fedora-release", "/log"]]
+        [True, True, False, False]
+        >>> sync._excluded("/var/log", True)
+        True
+        """
+        for pat in self.exclude:
+            if pat.endswith("/"):
+                if not isdir:
+                    continue
+                pat = pat.rstrip("/")
+            if pat.startswith("/"):
+                matched = fnmatch.fnmatchcase(relname, pat)
+            elif "/" in pat:
+                matched = fnmatch.fnmatchcase(relname, "*/" + pat)
+            else:
+                matched = fnmatch.fnmatchcase(os.path.basename(relname),
+                                              pat)
+            if matched:
+                return True
+        return False
+
+    def _sync_file(self, src, st, target, dst_st):
+        if st.st_nlink == 1:
+            self._copy_file(src, st, target, dst_st)
+            return
+
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            first = self._links.get(key)
+            if first is None:
+                self._links[key] = (target, threading.Event())
+        if first is None:
+            try:
+                self._copy_file(src, st, target, dst_st)
+            finally:
+                self._links[key][1].set()
+            return
+
+        first_target, created = first
+        created.wait()
+        if dst_st and os.path.samefile(first_target, target):
+            return
+        tmp = self._tmpname(target) if dst_st else target
+        os.link(first_target, tmp)
+        if tmp != target:
+            os.rename(tmp, target)
+
+    def _copy_file(self, src, st, target, dst_st):
+        if dst_st and self._unchanged(src, st, target, dst_st):
+            self._copy_meta(src, st, target)
+            return
+
+        # Existing files are replaced, like rsync does
+        tmp = self._tmpname(target) if dst_st else target
+        fdin = os.open(src, os.O_RDONLY)
+        try:
+            fdout = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                            0o600)
+            try:
+                _copy_sparse(fdin, fdout, st.st_size)
+            finally:
+                os.close(fdout)
+        finally:
+            os.close(fdin)
+        self._copy_meta(src, st, tmp)
+        if tmp != target:
+            os.rename(tmp, target)
+
+    def _unchanged(self, src, st, target, dst_st):
+        if self.compare == "copy" or st.st_size != dst_st.st_size:
+            return False
+        if self.compare == "mtime":
+            return st.st_mtime_ns == dst_st.st_mtime_ns
+        with open(src, "rb") as a, open(target, "rb") as b:
+            while True:
+                chunk = a.read(1024 * 1024)
+                if chunk != b.read(1024 * 1024):
+                    return False
+                if not chunk:
+                    return True
+
+    def _sync_symlink(self, src, st, target, dst_st):
+        link = os.readlink(src)
+        if dst_st is None or not stat.S_ISLNK(dst_st.st_mode) or \
+                os.readlink(target) != link:
+            tmp = self._tmpname(target) if dst_st else target
+            os.symlink(link, tmp)
+            if tmp != target:
+                os.rename(tmp, target)
+        self._copy_meta(src, st, target)
+
+    def _tmpname(self, target):
+        dirname, name = os.path.split(target)
+        return os.path.join(dirname, ".%s.%s" % (name, uuid4().hex[:6]))
+
+    def _copy_meta(self, src, st, target):
+        islink = stat.S_ISLNK(st.st_mode)
+        try:
+            os.lchown(target, st.st_uid, st.st_gid)
+        except OSError as e:
+            # Like rsync, the owner is only kept if we may change it
+            if e.errno != errno.EPERM:
+                raise
+        if not islink:
+            os.chmod(target, stat.S_IMODE(st.st_mode))
+        # After chown, which drops security.capability
+        _copy_xattrs(src, target, follow_symlinks=False)
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+
+
+def _copy_sparse(fdin, fdout, size):
+    """Copy the data of a file, holes are kept
+    """
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fdin, offset, os.SEEK_DATA)
+            hole = os.lseek(fdin, data, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                break
+            if e.errno != errno.EINVAL:
+                raise
+            # Holes are not supported by the filesystem
+            data, hole = offset, size
+        os.lseek(fdin, data, os.SEEK_SET)
+        os.lseek(fdout, data, os.SEEK_SET)
+        _copy_data(fdin, fdout, hole - data)
+        offset = hole
+    os.ftruncate(fdout, size)
+
+
+# The engine used by tree_sync, see use_sync_engine
+sync_engines = {"rsync": Rsync,
+                "native": TreeSync}
+_sync_engine = Rsync
+
+
+def use_sync_engine(name):
+    """Select how trees are synced, see sync_engines
+
+    The native engine needs Python 3.
+    """
+    global _sync_engine
+    if name not in sync_engines:
+        raise RuntimeError("Unknown sync engine: %s" % name)
+    log.debug("Using sync engine: %s" % name)
+    _sync_engine = sync_engines[name]
+
+
+def tree_sync(compare=None):
+    """A syncer of the selected engine, see Rsync.compare
+    """
+    return _sync_engine(compare)
+
+
 class IDMap():
     from_etc = None
     to_etc = None
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+#
+# Count the LVM round trips of layer and base operations, using the
+# in-process LVM simulator. Every LVM command commits metadata and
+# waits for udev, so each extra call is noticeable on real hosts.
+#
+
+import sys
+import time
+import argparse
+
+from imgbased.imgbase import ImageLayers
+from imgbased.lvm import LVM
+from imgbased.lvmsim import LvmSimulator
+from imgbased.utils import ExternalBinary
+
+
+# The number of LVM calls the operations need today, --check fails
+# if an operation needs more
+BUDGET = {"add_base": 7,
+          "add_layer": 7,
+          "update": 12,
+          "remove_layer": 6,
+          "remove_base": 12}
+
+
+def setup(latency_scale):
+    ExternalBinary.dry = True
+    imgbase = ImageLayers()
+    imgbase.dry = True
+    sim = LVM.use_backend(LvmSimulator(latency_scale=latency_scale))
+
+    sim.call(["vgcreate", "HostVG", "/dev/sim0"])
+    sim.call(["vgchange", "--addtag", imgbase.vg_tag, "HostVG"])
+    sim.call(["lvcreate", "--thin", "--size", "100G", "HostVG/pool"])
+    sim.call(["lvchange", "--addtag", imgbase.thinpool_tag, "HostVG/pool"])
+
+    # The booted layer is not simulated
+    def current_layer():
+        return None
+    imgbase.current_layer = current_layer
+    return imgbase, sim
+
+
+def operations(imgbase):
+    def add_base():
+        imgbase.add_base("10G", "Image")
+
+    def add_layer():
+        imgbase.add_layer(imgbase.latest_base())
+
+    def update():
+        imgbase.add_base("10G", "Image")
+        add_layer()
+
+    def remove_layer():
+        imgbase.remove_layer(imgbase.latest_layer().nvr)
+
+    def remove_base():
+        imgbase.remove_base(imgbase.naming.bases()[0].nvr)
+
+    return [("add_base", add_base),
+            ("add_layer", add_layer),
+            ("update", update),
+            ("remove_layer", remove_layer),
+            ("remove_base", remove_base)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency-scale", type=float, default=0,
+                        help="Scale the simulated LVM latencies, 1 is "
+                        "roughly a real host")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if an operation exceeds its budget")
+    args = parser.parse_args()
+
+    imgbase, sim = setup(args.latency_scale)
+    exceeded = []
+    for name, func in operations(imgbase):
+        sim.reset()
+        begin = time.time()
+        func()
+        took = time.time() - begin
+        counts = sim.counts()
+        total = sum(counts.values())
+        detail = ", ".join("%s=%d" % kv for kv in sorted(counts.items()))
+        print("%-14s %3d LVM calls %10.3f ms  (%s)" %
+              (name, total, took * 1000, detail))
+        if total > BUDGET[name]:
+            exceeded.append(name)
+
+    print(imgbase.layout())
+    if args.check and exceeded:
+        print("Over budget: %s" % ", ".join(exceeded))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+#
+# Time the naming scheme with synthetic LV name lists of 10k-100k
+# entries, e.g. many short lived layers per base on CI hosts.
+#
+
+import sys
+import timeit
+import argparse
+
+from imgbased.naming import NvrLikeNaming
+
+
+def synthetic_names(num, layers_per_base=99):
+    """Names of num LVs, every base is followed by it's layers
+    """
+    names = []
+    version = 0
+    while len(names) < num:
+        names.append("Image-%d.0" % version)
+        for release in range(1, layers_per_base + 1):
+            names.append("Image-%d.%d" % (version, release))
+        version += 1
+    # LVM does not report them in any particular order
+    return list(reversed(names[:num]))
+
+
+def cold(naming, func):
+    """Run func on a naming with an empty tree cache
+    """
+    def run():
+        naming.invalidate()
+        func()
+    return run
+
+
+def bench(num, repeat):
+    naming = NvrLikeNaming()
+    naming.names = synthetic_names(num)
+
+    def consume_layout():
+        for line in naming.layout_lines():
+            pass
+
+    cases = [("tree() cold", cold(naming, naming.tree)),
+             ("tree() cached", naming.tree),
+             ("layers() cold", cold(naming, naming.layers)),
+             ("layers() cached", naming.layers),
+             ("suggest_next_layer()",
+              lambda: naming.suggest_next_layer(naming.last_layer())),
+             ("layout() cold", cold(naming, consume_layout)),
+             ("layout() cached", consume_layout)]
+
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("%7d names  %-22s %10.3f ms" % (num, name, best * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated numbers of LV names")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for num in map(int, args.sizes.split(",")):
+        bench(num, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())